@@ -4,10 +4,13 @@ Fallback methods for when AI services are unavailable
 import logging
 import random
 
+from metrics import rule_based_replies
+
 logger = logging.getLogger(__name__)
 
-def get_rule_based_response(user_message):
+def get_rule_based_response(user_message, source="chat"):
     """Generate a simple rule-based response when AI services fail"""
+    rule_based_replies.inc(source=source)
     user_message = user_message.lower()
     
     # Greeting patterns
@@ -45,6 +48,17 @@ def get_rule_based_response(user_message):
     
     return random.choice(default_responses)
 
+class AnalysisFailure(str):
+    """
+    The apology a service's analyze_image returns instead of an analysis
+    It still reads as text for callers that show it, but is never cached or
+    treated as a description; check with analysis_succeeded().
+    """
+
+def analysis_succeeded(description):
+    """True if analyze_image returned a real description"""
+    return bool(description) and not isinstance(description, AnalysisFailure)
+
 def analyze_image_basic(format_name=None, width=None, height=None):
     """Generate a simple image analysis when AI services fail"""
     
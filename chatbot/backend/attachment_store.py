@@ -0,0 +1,181 @@
+"""
+Content-addressed store for uploaded images and documents
+
+An upload is written to disk once, under the SHA-256 of its bytes, and
+referred to afterwards by a short id ("<digest>.<ext>") that the
+attachments route serves as a file. Responses carry that id instead of
+the whole upload base64-encoded, and because the bytes behind an id never
+change the route can let browsers cache it indefinitely.
+
+A file's modification time records when it was last uploaded or served.
+A background sweep removes files unused for ATTACHMENT_RETENTION_SECONDS
+and, while the store is over ATTACHMENT_MAX_BYTES, the least recently
+used ones, so attachments of deleted threads (no longer fetched) age out.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import time
+
+from config import ATTACHMENT_DIR, ATTACHMENT_RETENTION_SECONDS, ATTACHMENT_MAX_BYTES, ATTACHMENT_SWEEP_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Content types kept under their own extension; anything else is served as a download
+EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+    "image/bmp": ".bmp",
+    "application/pdf": ".pdf",
+    "text/plain": ".txt",
+    "application/msword": ".doc",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": ".docx",
+}
+MEDIA_TYPES = {extension: media_type for media_type, extension in EXTENSIONS.items()}
+DEFAULT_EXTENSION = ".bin"
+
+ATTACHMENT_ID = re.compile(r"^([0-9a-f]{64})(\.[a-z]+)$")
+
+# A file's last use is recorded at most this often, so serving it is not a write per request
+TOUCH_INTERVAL_SECONDS = 24 * 3600
+# Temporary files left behind by an interrupted write are removed after this long
+STALE_TEMP_SECONDS = 3600
+
+
+class AttachmentStore:
+    """Writes uploads to <root>/<digest[:2]>/<digest>.<ext>, skipping bytes it already holds"""
+
+    def __init__(self, root=ATTACHMENT_DIR, retention=ATTACHMENT_RETENTION_SECONDS, max_bytes=ATTACHMENT_MAX_BYTES):
+        self.root = root
+        self.retention = retention
+        self.max_bytes = max_bytes
+        self.files = 0
+        self.bytes = 0
+        self.removed = 0
+        self.removed_bytes = 0
+
+    def save(self, contents, content_type=None):
+        """Store the bytes (if new) and return their attachment id"""
+        extension = EXTENSIONS.get((content_type or "").split(";")[0].strip().lower(), DEFAULT_EXTENSION)
+        attachment_id = hashlib.sha256(contents).hexdigest() + extension
+        path = self._path(attachment_id)
+        if os.path.exists(path):
+            self._touch(path)
+            return attachment_id
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file and rename, so a concurrent reader never sees a partial file
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(contents)
+            os.replace(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        logger.info(f"Stored attachment {attachment_id} ({len(contents) / 1024:.1f} KB)")
+        return attachment_id
+
+    def open(self, attachment_id):
+        """Return (path, media_type) for a stored attachment, or None"""
+        match = ATTACHMENT_ID.match(attachment_id)
+        if not match:
+            return None
+        path = self._path(attachment_id)
+        if not os.path.isfile(path):
+            return None
+        self._touch(path)
+        return path, MEDIA_TYPES.get(match.group(2), "application/octet-stream")
+
+    def sweep(self):
+        """Remove expired attachments, then the least recently used while over max_bytes"""
+        now = time.time()
+        files = []
+        removed = removed_bytes = 0
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if name.endswith(".tmp"):
+                    if now - stat.st_mtime > STALE_TEMP_SECONDS and self._remove(path, stat.st_mtime):
+                        removed_bytes += stat.st_size
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        kept = len(files)
+        for used_at, size, path in files:
+            if now - used_at <= self.retention and total <= self.max_bytes:
+                break
+            if self._remove(path, used_at):
+                removed += 1
+                removed_bytes += size
+                total -= size
+                kept -= 1
+
+        self.files = kept
+        self.bytes = total
+        self.removed += removed
+        self.removed_bytes += removed_bytes
+        if removed:
+            logger.info(f"Removed {removed} attachments ({removed_bytes / 1024 / 1024:.1f} MB), {kept} kept")
+        return removed
+
+    async def run_sweeper(self, interval=ATTACHMENT_SWEEP_INTERVAL):
+        """Sweep the store every interval forever (started from the app lifespan)"""
+        while True:
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception as e:
+                logger.error(f"Error sweeping attachments: {str(e)}")
+            await asyncio.sleep(interval)
+
+    def stats(self):
+        """Sizes as of the last sweep"""
+        return {
+            "files": self.files,
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "retention_seconds": self.retention,
+            "removed": self.removed,
+            "removed_bytes": self.removed_bytes
+        }
+
+    def _touch(self, path):
+        try:
+            if time.time() - os.path.getmtime(path) > TOUCH_INTERVAL_SECONDS:
+                os.utime(path)
+        except OSError as e:
+            logger.warning(f"Could not record use of {path}: {str(e)}")
+
+    def _remove(self, path, used_at):
+        """Delete a file unless it was used since it was listed"""
+        try:
+            if os.path.getmtime(path) != used_at:
+                return False
+            os.remove(path)
+            return True
+        except OSError as e:
+            logger.warning(f"Could not remove attachment {path}: {str(e)}")
+            return False
+
+    def _path(self, attachment_id):
+        return os.path.join(self.root, attachment_id[:2], attachment_id)
+
+
+def attachment_etag(attachment_id):
+    return f'"{attachment_id.split(".")[0]}"'
+
+
+# Shared instance used by the upload and attachment routes
+attachment_store = AttachmentStore()
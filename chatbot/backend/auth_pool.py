@@ -0,0 +1,122 @@
+"""
+Bounded worker pool for login-path CPU and blocking I/O
+
+bcrypt verification is deliberately slow and Google ID-token verification
+may fetch certificates synchronously; run inline in an async route either
+one stalls every request on the worker. Both run here instead, on a small
+dedicated thread pool (bcrypt and the socket reads release the GIL), so a
+login burst queues behind itself rather than behind chat traffic. Work
+beyond the workers plus AUTH_POOL_MAX_WAITING is rejected immediately.
+
+Per-operation counts, errors, rejections and queue/run times are kept for
+the stats endpoint.
+"""
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import AUTH_POOL_WORKERS, AUTH_POOL_MAX_WAITING
+
+logger = logging.getLogger(__name__)
+
+
+class AuthPoolBusy(Exception):
+    """More login work is queued than the pool accepts"""
+
+
+class OperationStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.run_seconds = 0.0
+        self.max_run_seconds = 0.0
+
+    def record(self, wait, run, failed):
+        self.calls += 1
+        self.errors += failed
+        self.wait_seconds += wait
+        self.max_wait_seconds = max(self.max_wait_seconds, wait)
+        self.run_seconds += run
+        self.max_run_seconds = max(self.max_run_seconds, run)
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.wait_seconds / self.calls * 1000, 2) if self.calls else 0.0,
+            "max_wait_ms": round(self.max_wait_seconds * 1000, 2),
+            "avg_run_ms": round(self.run_seconds / self.calls * 1000, 2) if self.calls else 0.0,
+            "max_run_ms": round(self.max_run_seconds * 1000, 2)
+        }
+
+
+class AuthPool:
+    """Thread pool with an admission limit and per-operation timing"""
+
+    def __init__(self, workers=AUTH_POOL_WORKERS, max_waiting=AUTH_POOL_MAX_WAITING):
+        self.workers = workers
+        self.max_waiting = max_waiting
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = 0  # Submitted and not yet finished (running or queued)
+        self._operations = {}
+
+    async def run(self, operation, func, *args, **kwargs):
+        """Run func(*args, **kwargs) on the pool and return its result; raises AuthPoolBusy when full"""
+        with self._lock:
+            stats = self._operations.setdefault(operation, OperationStats())
+            if self._pending >= self.workers + self.max_waiting:
+                stats.rejected += 1
+                logger.warning(f"Auth pool full ({self._pending} pending), rejecting {operation}")
+                raise AuthPoolBusy("Too many logins in progress")
+            self._pending += 1
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="auth")
+
+        submitted = time.perf_counter()
+
+        def timed():
+            started = time.perf_counter()
+            failed = True
+            try:
+                result = func(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                finished = time.perf_counter()
+                with self._lock:
+                    stats.record(started - submitted, finished - started, failed)
+
+        future = self._executor.submit(timed)
+        # Released when the work finishes or is cancelled before it starts
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    def _release(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "max_waiting": self.max_waiting,
+                "pending": self._pending,
+                "operations": {name: stats.as_dict() for name, stats in self._operations.items()}
+            }
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Shared instance used by the login routes
+auth_pool = AuthPool()
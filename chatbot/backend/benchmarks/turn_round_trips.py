@@ -0,0 +1,146 @@
+"""
+Count database round trips and commits per chat turn
+
+Drives send_message (blocking and streamed) and update_message through the
+FastAPI test client against a scratch SQLite database and counts the SQL
+statements and commits each turn issues. The model call is replaced by a
+canned reply so only the database work is measured.
+
+    python benchmarks/turn_round_trips.py
+    python benchmarks/turn_round_trips.py --turns 50 --async-engine
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--turns", type=int, default=20, help="turns measured per scenario")
+parser.add_argument("--async-engine", action="store_true", help="use the async engine (DB_ASYNC_ENABLED)")
+args = parser.parse_args()
+
+# The app modules read their settings at import
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="chatbot-bench-"), "turns.db")
+os.environ["DB_ASYNC_ENABLED"] = "true" if args.async_engine else "false"
+os.environ["PROVIDER_WARMUP_ENABLED"] = "false"
+for key in ("OPENAI_API_KEY", "GEMINI_API_KEY", "CLAUDE_API_KEY", "SECRET_KEY"):
+    os.environ.setdefault(key, "benchmark")
+os.environ.setdefault("ALGORITHM", "HS256")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logging  # noqa: E402
+
+from fastapi.testclient import TestClient  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+import chat_endpoint  # noqa: E402
+import database  # noqa: E402
+from auth import create_access_token  # noqa: E402
+from models import User  # noqa: E402
+from conversation_cache import conversation_cache  # noqa: E402
+
+logging.disable(logging.CRITICAL)
+
+REPLY = "Canned reply for the round trip benchmark."
+
+
+async def canned_stream():
+    yield REPLY
+
+
+async def fake_open_reply_stream(model, formatted_history):
+    return "openai", canned_stream()
+
+
+# Only the database work is measured
+chat_endpoint.open_reply_stream = fake_open_reply_stream
+
+
+class Counter:
+    def __init__(self):
+        self.statements = 0
+        self.commits = 0
+
+    def reset(self):
+        self.statements = 0
+        self.commits = 0
+
+
+counter = Counter()
+
+
+def attach(engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def count_statement(*_):
+        counter.statements += 1
+
+    @event.listens_for(engine, "commit")
+    def count_commit(*_):
+        counter.commits += 1
+
+
+attach(database.engine)
+if database.async_engine is not None:
+    attach(database.async_engine.sync_engine)
+
+
+def run_scenario(client, name, turn, cold_cache):
+    statements = commits = 0
+    for index in range(args.turns):
+        if cold_cache:
+            conversation_cache.clear()
+        counter.reset()
+        turn(index)
+        statements += counter.statements
+        commits += counter.commits
+    print(f"{name:<40} {statements / args.turns:6.1f} statements  {commits / args.turns:4.1f} commits per turn")
+
+
+def main():
+    database.Base.metadata.create_all(bind=database.engine)
+    with database.engine.begin() as conn:
+        conn.execute(User.__table__.insert(), {"id": 1, "email": "bench@example.com", "username": "Bench"})
+    # The first request resolves the token; the rest are served by the principal cache
+    token = create_access_token({"sub": "bench@example.com"})
+    client = TestClient(chat_endpoint.app, headers={"Authorization": f"Bearer {token}"})
+    thread = client.post("/chat/create_thread/", json={"title": "Benchmark"}).json()
+    thread_id = thread["id"]
+
+    def send(index, **params):
+        response = client.post(
+            f"/chat/{thread_id}/message/",
+            json={"message": f"Question {index}", "model": "openai"},
+            params=params
+        )
+        response.raise_for_status()
+        return response
+
+    def send_stream(index):
+        with client.stream(
+            "POST", f"/chat/{thread_id}/message/",
+            json={"message": f"Question {index}", "model": "openai"},
+            params={"stream": True}
+        ) as response:
+            for _ in response.iter_lines():
+                pass
+
+    def edit(index):
+        last_user_message = send(index, response_mode="delta").json()[0]
+        counter.reset()
+        client.put(
+            f"/chat/{thread_id}/message/{last_user_message['id']}/",
+            json={"message": f"Edited question {index}", "model": "openai"},
+            params={"response_mode": "delta"}
+        ).raise_for_status()
+
+    print(f"{'async' if database.async_engine is not None else 'sync (threadpool)'} sessions, {args.turns} turns per scenario\n")
+    for cold_cache in (True, False):
+        cache = "cold cache" if cold_cache else "warm cache"
+        run_scenario(client, f"send_message, delta ({cache})", lambda i: send(i, response_mode="delta"), cold_cache)
+        run_scenario(client, f"send_message, full list ({cache})", lambda i: send(i), cold_cache)
+        run_scenario(client, f"send_message, streamed ({cache})", send_stream, cold_cache)
+        run_scenario(client, f"update_message, delta ({cache})", edit, cold_cache)
+
+
+if __name__ == "__main__":
+    main()
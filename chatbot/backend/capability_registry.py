@@ -0,0 +1,122 @@
+"""
+Persistent registry of the model and payload format that last worked
+
+Entries are keyed by provider and capability ("gemini", "vision") and saved
+to a JSON file so they survive restarts. Services try the remembered option
+first, so a steady-state call costs one upstream request, and only walk their
+full fallback list when it fails. Entries older than the TTL are still used
+but re-validated in the background, which also lets a preferred model that
+has recovered take over again.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+from config import CAPABILITY_REGISTRY_PATH, CAPABILITY_TTL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class CapabilityRegistry:
+    """Remembered (model, payload_format) per provider capability"""
+
+    def __init__(self, path=CAPABILITY_REGISTRY_PATH, ttl=CAPABILITY_TTL_SECONDS):
+        self.path = path
+        self.ttl = ttl
+        self._entries = self._load()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get(self, provider, capability):
+        """Return {"model", "payload_format", "verified_at"} or None"""
+        with self._lock:
+            entry = self._entries.get(f"{provider}:{capability}")
+            return dict(entry) if entry else None
+
+    def is_stale(self, entry):
+        return entry is None or time.time() - entry.get("verified_at", 0) > self.ttl
+
+    def remembered(self, provider, capability, discover=None):
+        """
+        Return the remembered entry, starting a background re-validation if it
+        is older than the TTL. discover is a blocking callable that walks the
+        provider's options and returns the first working (model, payload_format)
+        or None.
+        """
+        entry = self.get(provider, capability)
+        if entry and discover and self.is_stale(entry):
+            self.refresh_in_background(provider, capability, discover)
+        return entry
+
+    def ordered(self, provider, capability, options, discover=None):
+        """Put the remembered (model, payload_format) in front of the default options"""
+        entry = self.remembered(provider, capability, discover)
+        if not entry:
+            return list(options)
+        best = (entry["model"], entry.get("payload_format"))
+        return [best] + [option for option in options if tuple(option) != best]
+
+    def confirm(self, provider, capability, model, payload_format=None):
+        """Record a working option; only writes when it changed or has gone stale"""
+        entry = self.get(provider, capability)
+        if entry and entry["model"] == model and entry.get("payload_format") == payload_format and not self.is_stale(entry):
+            return
+        self.record(provider, capability, model, payload_format)
+
+    def record(self, provider, capability, model, payload_format=None):
+        with self._lock:
+            self._entries[f"{provider}:{capability}"] = {
+                "model": model,
+                "payload_format": payload_format,
+                "verified_at": time.time()
+            }
+            self._save()
+        logger.info(f"Remembering {model} ({payload_format or 'default'} format) for {provider} {capability}")
+
+    def refresh_in_background(self, provider, capability, discover):
+        """Run discover on a daemon thread (at most one refresh per capability)"""
+        key = f"{provider}:{capability}"
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                found = discover()
+                if found:
+                    self.record(provider, capability, *found)
+                else:
+                    logger.warning(f"Re-validation found no working option for {provider} {capability}")
+            except Exception as e:
+                logger.error(f"Error re-validating {provider} {capability}: {str(e)}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=refresh, name=f"capability-refresh-{key}", daemon=True).start()
+
+    def _load(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, "r") as f:
+                    return json.load(f)
+        except Exception as e:
+            logger.warning(f"Could not read capability registry {self.path}: {str(e)}")
+        return {}
+
+    def _save(self):
+        # Write to a temp file first so a crash never leaves half a registry behind
+        temp_path = f"{self.path}.tmp"
+        try:
+            with open(temp_path, "w") as f:
+                json.dump(self._entries, f, indent=2)
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            logger.warning(f"Could not save capability registry {self.path}: {str(e)}")
+
+
+# Shared registry used by the services
+capability_registry = CapabilityRegistry()
@@ -1,18 +1,39 @@
-from fastapi import FastAPI, HTTPException, Depends, Body, APIRouter, UploadFile, File, Form
-from sqlalchemy.orm import Session
-from typing import List, Optional
-from database import SessionLocal
-from models import User, ChatThread, Message
-from schemas import ChatRequest, ChatResponse, ChatThreadCreate, ChatThread as ChatThreadSchema, Message as MessageSchema
+from fastapi import FastAPI, HTTPException, Depends, Body, APIRouter, UploadFile, File, Form, Header, Query, Request, Response
+from fastapi.responses import StreamingResponse, FileResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, delete, func, or_, and_
+from typing import List, Optional, Union
+from database import get_async_db, async_session_scope
+from models import ChatThread, Message
+from schemas import ChatRequest, ChatResponse, ChatThreadCreate, ChatThread as ChatThreadSchema, Message as MessageSchema, ChatThreadListItem, ChatThreadLists, ChatThreadPage, MessagePage, MessageSearchResults, Principal
+from auth import get_current_user
 import openai
 import logging
-from openai_service import OpenAIService
-from gemini_service import GeminiService
-from services.claude_service import ClaudeService
+from context_window import build_context_window, attach_summary, update_rolling_summary
+from conversation_cache import conversation_cache, history_entry
+from message_search import search_messages
+from hedging import hedged_stream
+from circuit_breaker import circuit_breakers
+from providers import providers
+from response_cache import response_cache, replay
+from content_cache import content_cache
+from image_analyzer import prepare_image
+from alternatives import analysis_succeeded
+from document_store import DocumentExtractionError, load_pages, stored_analysis, save_analysis
+from attachment_store import attachment_store, attachment_etag
+from auth_pool import auth_pool
+from google_verifier import google_verifier
+from principal_cache import principal_cache
+from logging_config import log_payload
+from metrics import fallbacks, error_fallback_replies
+from config import CONTEXT_SUMMARY_ENABLED, PAGE_SIZE_MAX, ATTACHMENT_MAX_AGE_SECONDS
 import os
+import asyncio
+import contextlib
 import traceback
 import json
 import re  # Add this import for regex operations
+from datetime import datetime
 import base64
 from io import BytesIO
 from PIL import Image
@@ -28,25 +49,14 @@ CLAUDE_API_KEY = os.getenv("CLAUDE_API_KEY")
 
 openai.api_key = OPENAI_API_KEY
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Stored when no provider produced a reply
+ERROR_FALLBACK_REPLY = "I apologize, but I'm having trouble generating a response right now. Please try again later."
+
+# Logging is configured by logging_config.setup_logging at startup
 logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
-# Initialize AI services with the correct API keys
-openai_service = OpenAIService(OPENAI_API_KEY)
-gemini_service = GeminiService(GEMINI_API_KEY )
-claude_service = ClaudeService()
-
-# Dependency to get DB session
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
 # Helper function to format message for frontend
 def format_message_for_frontend(msg):
     return {
@@ -56,6 +66,214 @@ def format_message_for_frontend(msg):
         "created_at": str(msg.created_at) if hasattr(msg, 'created_at') else None,
     }
 
+# Helper function to read a thread's history from the database
+async def read_history(db, thread_id):
+    rows = (await db.execute(select(Message).where(Message.thread_id == thread_id).order_by(Message.id))).scalars().all()
+    return [history_entry(msg) for msg in rows]
+
+# Helper function to load a thread's history through the conversation cache
+async def load_history(db, thread_id):
+    """Return the thread's history entries, reading the database only on a cache miss"""
+    history = conversation_cache.get(thread_id)
+    if history is None:
+        history = await read_history(db, thread_id)
+        conversation_cache.put(thread_id, history)
+    return history
+
+# Helper function to write the assistant's reply at the end of a turn
+async def save_assistant_message(db, thread_id, content, model):
+    """Insert and commit the reply in one transaction, returning it formatted for the frontend
+    
+    The id and created_at are known once the INSERT is flushed, so the
+    response is built from the object instead of refreshing it after commit.
+    """
+    bot_message_entry = Message(
+        thread_id=thread_id,
+        role="assistant",
+        sender="assistant",
+        content=content,
+        model=model  # Store which model generated this response
+    )
+    db.add(bot_message_entry)
+    await db.flush()
+    formatted = format_message_for_frontend(bot_message_entry)
+    entry = history_entry(bot_message_entry)
+    await db.commit()
+    conversation_cache.append(thread_id, entry)
+    return formatted
+
+# Helper function to build the bounded prompt for a chat turn
+def assemble_context(chat_thread, history, model):
+    """Fit the thread history entries into the model's token budget
+    
+    Turns that fall out of the window and are not yet covered by the
+    thread's rolling summary are folded into it; the caller's next commit
+    persists the updated summary.
+    """
+    formatted_history = [{"role": entry["role"], "content": entry["content"]} for entry in history]
+    window, first_index = build_context_window(formatted_history, model)
+    
+    if CONTEXT_SUMMARY_ENABLED and first_index > 0:
+        covered_id = chat_thread.summary_message_id or 0
+        dropped = [formatted_history[i] for i, entry in enumerate(history[:first_index]) if entry["id"] > covered_id]
+        if dropped:
+            chat_thread.summary = update_rolling_summary(chat_thread.summary, dropped)
+            chat_thread.summary_message_id = history[first_index - 1]["id"]
+            logger.debug(f"Folded {len(dropped)} messages into summary of thread {chat_thread.id}")
+        window = attach_summary(window, chat_thread.summary)
+    
+    return window
+
+# Helper functions for opaque keyset pagination cursors
+def encode_cursor(position):
+    return base64.urlsafe_b64encode(json.dumps(position).encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+# Helper function to reload a thread, messages included, for ChatThreadSchema responses
+async def refresh_thread(db, chat_thread):
+    """Load the messages relationship explicitly - lazy loading is not allowed on an async session"""
+    await db.refresh(chat_thread)
+    await db.refresh(chat_thread, ["messages"])
+
+# Helper function to check for the opt-in delta response mode
+def wants_delta_response(response_mode=None, header_mode=None):
+    """True when the client asked for only the new messages instead of the whole thread"""
+    return (response_mode or header_mode or "").lower() == "delta"
+
+# Helper function to pick the AI service for a model name
+def get_chat_service(model):
+    """Return the service for the requested model, defaulting to OpenAI"""
+    if model in ("gemini", "claude"):
+        return providers.get(model)
+    return providers.get("openai")
+
+# Helper function to encode a Server-Sent Event
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# Helper function to read the chat model named in a request body
+def requested_model(request):
+    """The lower-cased model, defaulting to OpenAI; an unknown model is a 400, not a silent fallback"""
+    model = (request.get("model") or "openai").lower()
+    if model not in providers.factories:
+        raise HTTPException(status_code=400, detail=f"Unknown model: {model}")
+    return model
+
+# Helper function to list the providers raced for a reply, requested model first
+def reply_candidates(model):
+    """The requested model plus the fallback it is hedged against, if configured
+
+    Their circuits are checked by hedged_stream as each one is started.
+    """
+    fallback = "openai" if model != "openai" else "claude"
+    return [(name, get_chat_service(name)) for name in (model, fallback) if providers.is_available(name)]
+
+# Helper function to start the hedged provider streams for a reply
+async def open_reply_stream(model, formatted_history):
+    """Return (model label, text stream) from the response cache or whichever provider answered first"""
+    cache_key = None
+    if response_cache.enabled and providers.is_available(model):
+        cache_key = response_cache.key_for(model, get_chat_service(model), formatted_history)
+        cached_reply = await response_cache.get(cache_key)
+        if cached_reply is not None:
+            logger.info(f"Serving cached {model} reply")
+            return f"{model} (cached)", replay(cached_reply)
+    
+    candidates = reply_candidates(model)
+    if not candidates:
+        raise RuntimeError("No provider is configured")
+    label, stream = await hedged_stream(candidates, formatted_history)
+    if label == candidates[0][0] and label != model:
+        # The requested model was skipped, so its replacement is a fallback
+        label = f"{label} (fallback)"
+    if label != model:
+        served, _, kind = label.partition(" (")
+        fallbacks.inc(requested=model, served=served, kind=kind.rstrip(")"))
+    if cache_key and label == model:
+        # Only the requested model's own complete replies are reused
+        stream = response_cache.recording(cache_key, stream)
+    return label, stream
+
+# Helper function to generate a complete reply through the hedged providers
+async def generate_hedged_reply(model, formatted_history):
+    """Return (model label, reply text) from whichever provider answered first"""
+    label, stream = await open_reply_stream(model, formatted_history)
+    chunks = [text async for text in stream]
+    return label, "".join(chunks)
+
+# Helper function to probe a provider whose circuit is open
+def provider_probe(name):
+    async def probe():
+        async for _ in get_chat_service(name).stream_response([{"role": "user", "content": "ping"}]):
+            return
+        raise RuntimeError(f"{name} probe returned no text")
+    return probe
+
+for provider_name in ("openai", "gemini", "claude"):
+    circuit_breakers.register_probe(provider_name, provider_probe(provider_name))
+
+# Helper function to store a streamed reply in its own session
+async def store_streamed_reply(thread_id, content, model):
+    async with async_session_scope() as db:
+        return await save_assistant_message(db, thread_id, content, model)
+
+async def stream_bot_reply(thread_id, model, formatted_history, user_message):
+    """Forward provider tokens as Server-Sent Events, then store the assistant message
+    
+    The reply is stored even if the client disconnects mid-stream, with
+    whatever text had arrived by then, so the thread never ends on two
+    user turns in a row.
+    """
+    yield format_sse("start", {"model": model, "user_message": user_message})
+    
+    chunks = []
+    used_model = None
+    stream = None
+    
+    try:
+        try:
+            label, stream = await open_reply_stream(model, formatted_history)
+            logger.info(f"Streaming response with {label}")
+            used_model = label
+            try:
+                async for text in stream:
+                    chunks.append(text)
+                    yield format_sse("token", {"text": text})
+            except Exception as e:
+                # Tokens already reached the client, so keep the partial reply instead of switching models
+                logger.error(f"Streaming with {label} failed: {str(e)}")
+                yield format_sse("error", {"detail": "The response stream was interrupted"})
+        except Exception as e:
+            logger.error(f"No provider could stream a response: {str(e)}")
+        
+        if used_model is None:
+            used_model = "error-fallback"
+            chunks = [ERROR_FALLBACK_REPLY]
+            yield format_sse("token", {"text": chunks[0]})
+    finally:
+        if stream is not None:
+            # Stop the provider request if the client went away mid-reply
+            with contextlib.suppress(Exception):
+                await stream.aclose()
+        if not chunks:
+            used_model = "error-fallback"
+            chunks = [ERROR_FALLBACK_REPLY]
+        if used_model == "error-fallback":
+            # Counted here so a disconnect before the first token is counted too
+            error_fallback_replies.inc(route="stream")
+        # Shielded so a cancelled request still writes the assistant message
+        save = asyncio.ensure_future(store_streamed_reply(thread_id, "".join(chunks), used_model))
+        bot_message = await asyncio.shield(save)
+    logger.debug(f"Added streamed bot message with model {used_model}")
+    
+    yield format_sse("done", {"model": used_model, "message": bot_message})
+
 # Helper function for title generation
 def generate_title_from_message(message_content):
     """Generate a reasonable title from a user message."""
@@ -81,55 +299,41 @@ def generate_title_from_message(message_content):
 
 # Remove /chat_api prefix from routes since we're mounting the app under /chat_api in main.py
 @app.post("/chat/", response_model=ChatResponse)
-async def chat_with_gpt(request: ChatRequest, db: Session = Depends(get_db)):
+async def chat_with_gpt(request: ChatRequest, user: Principal = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     try:
-        user_id = request.user_id
+        user_id = user.id
         user_message = request.message
 
-        # Retrieve or create user
-        user = db.query(User).filter(User.id == user_id).first()
-        if not user:
-            user = User(id=user_id, email=f"user{user_id}@example.com", username=f"User{user_id}")
-            db.add(user)
-            db.commit()
-            db.refresh(user)
-            logger.debug(f"Created new user: {user}")
-
         # Retrieve or create chat thread
-        chat_thread = db.query(ChatThread).filter(ChatThread.user_id == user_id).first()
+        chat_thread = (await db.execute(select(ChatThread).where(ChatThread.user_id == user_id))).scalars().first()
         if not chat_thread:
             chat_thread = ChatThread(user_id=user_id, title="Chat Thread")
             db.add(chat_thread)
-            db.commit()
-            db.refresh(chat_thread)
-            logger.debug(f"Created new chat thread: {chat_thread}")
+            await db.flush()
+            logger.debug(f"Created new chat thread: {chat_thread.id}")
+        thread_id = chat_thread.id
+
+        # Retrieve chat history before this turn's message is written
+        history = await load_history(db, thread_id)
 
-        # Append user message to chat history
-        user_message_entry = Message(thread_id=chat_thread.id, sender="user", content=user_message)
+        # Append user message to chat history; the thread and message commit together
+        user_message_entry = Message(thread_id=thread_id, sender="user", content=user_message)
         db.add(user_message_entry)
-        db.commit()
-        db.refresh(user_message_entry)
-        logger.debug(f"Added user message: {user_message_entry}")
-
-        # Retrieve chat history
-        chat_history = db.query(Message).filter(Message.thread_id == chat_thread.id).all()
-        formatted_history = [{"role": "user" if msg.sender == "user" else "assistant", "content": msg.content} for msg in chat_history]
-
-        # Call OpenAI API
-        response = openai.ChatCompletion.create(
-            model="gpt-4o-mini",
-            messages=formatted_history,
-            max_tokens=500
-        )
+        await db.flush()
+        user_entry = history_entry(user_message_entry)
+        history = history + [user_entry]
+        formatted_history = [{"role": entry["role"], "content": entry["content"]} for entry in history]
+        context = assemble_context(chat_thread, history, "openai")
+        await db.commit()
+        conversation_cache.append(thread_id, user_entry)
+        logger.debug(f"Added user message: {user_entry['id']}")
 
-        bot_reply = response["choices"][0]["message"]["content"]
+        # Call OpenAI with only the part of the history that fits the budget
+        bot_reply = await get_chat_service("openai").generate_response_async(context)
 
         # Append bot response to chat history
-        bot_message_entry = Message(thread_id=chat_thread.id, sender="assistant", content=bot_reply)
-        db.add(bot_message_entry)
-        db.commit()
-        db.refresh(bot_message_entry)
-        logger.debug(f"Added bot message: {bot_message_entry}")
+        bot_message = await save_assistant_message(db, thread_id, bot_reply, None)
+        logger.debug(f"Added bot message: {bot_message['id']}")
 
         return ChatResponse(
             user_id=user_id,
@@ -142,26 +346,17 @@ async def chat_with_gpt(request: ChatRequest, db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/chat/create_thread/", response_model=ChatThreadSchema)
-async def create_chat_thread(request: ChatThreadCreate, db: Session = Depends(get_db)):
+async def create_chat_thread(request: ChatThreadCreate, user: Principal = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     try:
         logger.debug(f"Creating thread with data: {request}")
-        user_id = request.user_id
+        user_id = user.id
         title = request.title
 
-        # Retrieve or create user
-        user = db.query(User).filter(User.id == user_id).first()
-        if not user:
-            user = User(id=user_id, email=f"user{user_id}@example.com", username=f"User{user_id}")
-            db.add(user)
-            db.commit()
-            db.refresh(user)
-            logger.debug(f"Created new user: {user}")
-
         # Create new chat thread
         chat_thread = ChatThread(user_id=user_id, title=title)
         db.add(chat_thread)
-        db.commit()
-        db.refresh(chat_thread)
+        await db.commit()
+        await refresh_thread(db, chat_thread)
         logger.debug(f"Created new chat thread: {chat_thread}")
 
         return chat_thread
@@ -170,342 +365,513 @@ async def create_chat_thread(request: ChatThreadCreate, db: Session = Depends(ge
         logger.error(f"Stack trace: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Error creating thread: {str(e)}")
 
-@app.get("/chat/", response_model=List[ChatThreadSchema])
-async def get_chat_threads(user_id: int, search: str = None, show_deleted: bool = False, db: Session = Depends(get_db)):
+@app.get("/chat/", response_model=Union[ChatThreadLists, ChatThreadPage, List[ChatThreadListItem]])
+async def get_chat_threads(
+    search: str = None,
+    show_deleted: bool = False,
+    include_deleted: bool = False,
+    limit: Optional[int] = Query(None, ge=1, le=PAGE_SIZE_MAX),
+    cursor: Optional[str] = None,
+    user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """List a user's threads with a preview of each thread's last message
+    
+    Everything comes from a single query. With include_deleted=true both
+    lists are returned at once as {"active": [...], "deleted": [...]}.
+    With limit set, results are paged newest first on (created_at, id):
+    the response carries next_cursor, which is passed back as cursor.
+    """
     try:
-        logger.debug(f"Fetching threads for user_id: {user_id}, show_deleted: {show_deleted}, search: {search}")
+        user_id = user.id
+        logger.debug(f"Fetching threads for user_id: {user_id}, show_deleted: {show_deleted}, include_deleted: {include_deleted}, search: {search}")
         
-        # Basic query
-        query = db.query(ChatThread).filter(ChatThread.user_id == user_id)
+        # Id of the newest message in each of the user's threads
+        last_message_ids = (
+            select(Message.thread_id, func.max(Message.id).label("last_id"))
+            .join(ChatThread, ChatThread.id == Message.thread_id)
+            .where(ChatThread.user_id == user_id)
+            .group_by(Message.thread_id)
+            .subquery()
+        )
+        
+        # Basic query - threads joined to a 100 character preview of their last message
+        query = (
+            select(
+                ChatThread.id,
+                ChatThread.title,
+                ChatThread.user_id,
+                ChatThread.is_deleted,
+                ChatThread.created_at,
+                func.substr(Message.content, 1, 100).label("last_message")
+            )
+            .outerjoin(last_message_ids, last_message_ids.c.thread_id == ChatThread.id)
+            .outerjoin(Message, Message.id == last_message_ids.c.last_id)
+            .where(ChatThread.user_id == user_id)
+        )
         
         # Handle deleted filter - explicitly check for True/False
-        if show_deleted is True:
-            query = query.filter(ChatThread.is_deleted.is_(True))
-        else:
-            query = query.filter(ChatThread.is_deleted.is_(False))
+        if not include_deleted:
+            if show_deleted is True:
+                query = query.where(ChatThread.is_deleted.is_(True))
+            else:
+                query = query.where(ChatThread.is_deleted.is_(False))
             
         # Add search filter if provided
         if search:
-            query = query.filter(ChatThread.title.ilike(f"%{search}%"))
+            query = query.where(ChatThread.title.ilike(f"%{search}%"))
+        
+        # Resume after the last thread of the previous page
+        if cursor:
+            position = decode_cursor(cursor)
+            try:
+                cursor_created_at = datetime.fromisoformat(position["created_at"])
+                cursor_id = int(position["id"])
+            except (KeyError, TypeError, ValueError):
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+            query = query.where(or_(
+                ChatThread.created_at < cursor_created_at,
+                and_(ChatThread.created_at == cursor_created_at, ChatThread.id < cursor_id)
+            ))
             
-        # Order by creation date
-        query = query.order_by(ChatThread.created_at.desc())
+        # Order by creation date, id breaks ties so pages never overlap
+        query = query.order_by(ChatThread.created_at.desc(), ChatThread.id.desc())
         
-        # Execute query
-        chat_threads = query.all()
-        logger.debug(f"Found {len(chat_threads)} threads")
+        # Execute query - one extra row tells us whether another page exists
+        if limit:
+            query = query.limit(limit + 1)
+        rows = (await db.execute(query)).all()
+        logger.debug(f"Found {len(rows)} threads")
+        
+        next_cursor = None
+        if limit and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor({"created_at": rows[-1].created_at.isoformat(), "id": rows[-1].id})
         
         # Prepare response data
-        result = []
-        for thread in chat_threads:
-            thread_data = {
-                "id": thread.id,
-                "title": thread.title,
-                "user_id": thread.user_id,
-                "is_deleted": thread.is_deleted,
-                "created_at": str(thread.created_at)
-            }
-            
-            # Get last message if exists
-            last_message = db.query(Message).filter(
-                Message.thread_id == thread.id
-            ).order_by(Message.id.desc()).first()
-            
-            if last_message:
-                thread_data["lastMessage"] = last_message.content[:100]
-            
-            result.append(thread_data)
+        result = [
+            ChatThreadListItem(
+                id=row.id,
+                title=row.title,
+                user_id=row.user_id,
+                is_deleted=row.is_deleted,
+                created_at=row.created_at,
+                lastMessage=row.last_message
+            )
+            for row in rows
+        ]
         
+        if include_deleted:
+            return ChatThreadLists(
+                active=[thread for thread in result if not thread.is_deleted],
+                deleted=[thread for thread in result if thread.is_deleted],
+                next_cursor=next_cursor
+            )
+        if limit:
+            return ChatThreadPage(items=result, next_cursor=next_cursor)
         return result
         
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logger.error(f"Error in get_chat_threads: {str(e)}")
         logger.error(f"Traceback: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Error fetching threads: {str(e)}")
 
-@app.get("/chat/{thread_id}/messages/")
-async def get_messages(thread_id: int, user_id: int, db: Session = Depends(get_db)):
+@app.get("/chat/search/", response_model=MessageSearchResults)
+async def search_chat_messages(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=PAGE_SIZE_MAX),
+    user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Full-text search over the content of a user's messages
+    
+    Results are ranked best first; each carries its thread id and title
+    and a snippet with the matched terms wrapped in <mark> tags.
+    """
     try:
-        chat_thread = db.query(ChatThread).filter(ChatThread.id == thread_id, ChatThread.user_id == user_id).first()
+        logger.debug(f"Searching messages for user_id: {user.id}, q: {q}")
+        items = await search_messages(db, user.id, q, limit)
+        logger.debug(f"Found {len(items)} matching messages")
+        return MessageSearchResults(query=q, items=items)
+    except Exception as e:
+        logger.error(f"Error in search_chat_messages: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        raise HTTPException(status_code=500, detail=f"Error searching messages: {str(e)}")
+
+@app.get("/chat/{thread_id}/messages/", response_model=Union[MessagePage, List[dict]])
+async def get_messages(
+    thread_id: int,
+    limit: Optional[int] = Query(None, ge=1, le=PAGE_SIZE_MAX),
+    cursor: Optional[str] = None,
+    user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Return a thread's messages in chronological order
+    
+    With limit set, only the newest page is returned along with
+    next_cursor; passing that back as cursor fetches the page of older
+    messages before it.
+    """
+    try:
+        chat_thread = (await db.execute(
+            select(ChatThread).where(ChatThread.id == thread_id, ChatThread.user_id == user.id)
+        )).scalars().first()
         if not chat_thread:
             raise HTTPException(status_code=404, detail="Chat thread not found")
         
-        messages = db.query(Message).filter(Message.thread_id == thread_id).all()
+        if not limit:
+            messages = (await db.execute(
+                select(Message).where(Message.thread_id == thread_id).order_by(Message.id)
+            )).scalars().all()
+            logger.debug(f"Returning {len(messages)} messages for thread {thread_id}")
+            return [format_message_for_frontend(msg) for msg in messages]
+        
+        # Walk backwards from the newest message (or from the cursor)
+        query = select(Message).where(Message.thread_id == thread_id)
+        if cursor:
+            position = decode_cursor(cursor)
+            try:
+                query = query.where(Message.id < int(position["id"]))
+            except (KeyError, TypeError, ValueError):
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+        messages = (await db.execute(query.order_by(Message.id.desc()).limit(limit + 1))).scalars().all()
         
-        # Format messages for frontend
-        formatted_messages = [format_message_for_frontend(msg) for msg in messages]
-        logger.debug(f"Returning formatted messages: {formatted_messages}")
+        next_cursor = None
+        if len(messages) > limit:
+            messages = messages[:limit]
+            next_cursor = encode_cursor({"id": messages[-1].id})
         
-        return formatted_messages
+        logger.debug(f"Returning {len(messages)} messages for thread {thread_id}")
+        return MessagePage(
+            items=[format_message_for_frontend(msg) for msg in reversed(messages)],
+            next_cursor=next_cursor
+        )
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logger.error(f"Error in get_messages: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error fetching messages: {str(e)}")
 
 @app.post("/chat/{thread_id}/message/")
-async def send_message(thread_id: int, request: dict = Body(...), db: Session = Depends(get_db)):
-    """Send a message and get a response from the selected AI model"""
+async def send_message(
+    thread_id: int,
+    request: dict = Body(...),
+    stream: bool = False,
+    response_mode: Optional[str] = None,
+    x_response_mode: Optional[str] = Header(None),
+    user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Send a message and get a response from the selected AI model
+    
+    With stream=true (query parameter or body field) the reply is sent as
+    Server-Sent Events: start, token..., done.
+    With response_mode=delta (or an X-Response-Mode: delta header) only the
+    new user and assistant messages are returned instead of the whole thread.
+    """
     
     try:
-        user_id = request.get("user_id")
+        user_id = user.id
         user_message = request.get("message")
-        model = request.get("model", "openai").lower()  # Default to OpenAI if not specified
+        model = requested_model(request)
         update_title = request.get("update_title", False)
         suggested_title = request.get("suggested_title", None)
+        stream = stream or bool(request.get("stream", False))
 
         # Log the selected model with more visibility
-        logger.info(f"⭐ MESSAGE REQUEST with MODEL: {model} ⭐")
+        logger.info(f"Message request for thread {thread_id} with model {model}")
 
-        # Retrieve chat thread
-        chat_thread = db.query(ChatThread).filter(ChatThread.id == thread_id, ChatThread.user_id == user_id).first()
+        # Retrieve chat thread and its history before this turn's message is written
+        chat_thread = (await db.execute(select(ChatThread).where(
+            ChatThread.id == thread_id,
+            ChatThread.user_id == user_id
+        ))).scalars().first()
         if not chat_thread:
             raise HTTPException(status_code=404, detail="Chat thread not found")
+        history = await load_history(db, thread_id)
 
-        # Append user message to chat history
-        user_message_entry = Message(thread_id=chat_thread.id, sender="user", content=user_message)
+        # Append user message to chat history; the flush assigns its id
+        user_message_entry = Message(thread_id=thread_id, sender="user", content=user_message)
         db.add(user_message_entry)
-        db.commit()
-        db.refresh(user_message_entry)
-        logger.debug(f"Added user message: {user_message_entry}")
+        await db.flush()
+        user_message_payload = format_message_for_frontend(user_message_entry)
+        user_entry = history_entry(user_message_entry)
 
         # Check if we need to update the thread title
         if update_title or (chat_thread.title in ["New Chat", "New Conversation"]):
             new_title = suggested_title if suggested_title else generate_title_from_message(user_message)
             chat_thread.title = new_title
-            db.commit()
             logger.debug(f"Updated thread title to: {new_title}")
 
-        # Retrieve updated chat history
-        chat_history = db.query(Message).filter(Message.thread_id == chat_thread.id).all()
-        formatted_history = [{"role": "user" if msg.sender == "user" else "assistant", "content": msg.content} for msg in chat_history]
+        # Keep only what fits the model's budget; the title and any summary update share one UPDATE
+        history = history + [user_entry]
+        formatted_history = assemble_context(chat_thread, history, model)
+
+        # Commit the user's side of the turn before the model call so no transaction stays open during it
+        await db.commit()
+        conversation_cache.append(thread_id, user_entry)
+        logger.debug(f"Added user message: {user_entry['id']}")
+
+        if stream:
+            return StreamingResponse(
+                stream_bot_reply(thread_id, model, formatted_history, user_message_payload),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
 
         # Generate response with appropriate model
-        logger.info(f"🔴 GENERATING RESPONSE WITH MODEL: {model.upper()} 🔴")
+        logger.debug(f"Generating response with {model}")
         bot_reply = None
         
         try:
-            if model == "gemini":
-                logger.info("Using Gemini service for response generation")
-                bot_reply = gemini_service.generate_response(formatted_history)
-            elif model == "claude":
-                logger.info("Using Claude service for response generation")
-                bot_reply = claude_service.generate_response(formatted_history)
-                logger.info("Claude response first 50 chars: " + bot_reply[:50])
-            else:
-                logger.info("Using OpenAI service for response generation")
-                bot_reply = openai_service.generate_response(formatted_history)
+            # The requested model races its fallback if it is slow to produce a first token
+            model, bot_reply = await generate_hedged_reply(model, formatted_history)
                 
             # Verify the response model matches the requested model
-            if model == "claude" and not any(marker in bot_reply.lower() for marker in ["claude", "anthropic", "as claude", "i'm claude"]):
-                logger.warning("⚠️ Claude response does not identify as Claude - forcing identification")
+            if model in ("claude", "claude (cached)") and not any(marker in bot_reply.lower() for marker in ["claude", "anthropic", "as claude", "i'm claude"]):
+                logger.warning("Claude response does not identify as Claude - forcing identification")
                 bot_reply = "As Claude, I'd like to answer your question: " + bot_reply
                 
-            logger.info(f"✅ Successfully generated response with {model}")
+            logger.info(f"Generated response with {model}")
         except Exception as e:
-            logger.error(f"❌ Error generating response with {model} model: {str(e)}")
-            # Fall back to alternative model if first choice fails
-            try:
-                # Try a different model if the requested one fails
-                if model != "openai":
-                    logger.info("Falling back to OpenAI service")
-                    bot_reply = openai_service.generate_response(formatted_history)
-                    model = "openai (fallback)"
-                else:
-                    # Try Claude as secondary fallback since it might be more reliable than Gemini
-                    logger.info("Falling back to Claude service")
-                    bot_reply = claude_service.generate_response(formatted_history)
-                    model = "claude (fallback)"
-            except Exception as fallback_error:
-                logger.error(f"Fallback model also failed: {str(fallback_error)}")
-                # Use rule-based fallback
-                bot_reply = "I apologize, but I'm having trouble generating a response right now. Please try again later."
-                model = "error-fallback"
+            logger.error(f"Error generating response with {model} model: {str(e)}")
+            # Use rule-based fallback
+            bot_reply = ERROR_FALLBACK_REPLY
+            model = "error-fallback"
+            error_fallback_replies.inc(route="message")
 
         # Record bot response with model information
-        bot_message_entry = Message(
-            thread_id=chat_thread.id, 
-            role="assistant", 
-            sender="assistant",
-            content=bot_reply,
-            model=model  # Store which model generated this response
-        )
-        db.add(bot_message_entry)
-        db.commit()
-        db.refresh(bot_message_entry)
-        logger.info(f"🟢 Added bot message with model {model}")
+        bot_message = await save_assistant_message(db, thread_id, bot_reply, model)
+        logger.debug(f"Added bot message with model {model}")
+
+        if wants_delta_response(response_mode, x_response_mode):
+            return [user_message_payload, bot_message]
 
         # Get all messages including the new ones
-        all_messages = db.query(Message).filter(Message.thread_id == thread_id).all()
+        all_messages = (await db.execute(
+            select(Message).where(Message.thread_id == thread_id).order_by(Message.id)
+        )).scalars().all()
         formatted_messages = [format_message_for_frontend(msg) for msg in all_messages]
         
         return formatted_messages
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logger.error(f"Error in send_message: {str(e)}")
         logger.error(f"Full traceback: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.put("/chat/{thread_id}/update/")
-async def update_thread(thread_id: int, request: ChatThreadCreate, db: Session = Depends(get_db)):
+async def update_thread(thread_id: int, request: ChatThreadCreate, user: Principal = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     try:
-        chat_thread = db.query(ChatThread).filter(
+        chat_thread = (await db.execute(select(ChatThread).where(
             ChatThread.id == thread_id,
-            ChatThread.user_id == request.user_id
-        ).first()
+            ChatThread.user_id == user.id
+        ))).scalars().first()
         
         if not chat_thread:
             raise HTTPException(status_code=404, detail="Chat thread not found")
             
         # Clean the title but don't truncate it
         chat_thread.title = request.title.strip()
-        db.commit()
-        db.refresh(chat_thread)
+        await db.commit()
+        await refresh_thread(db, chat_thread)
         return chat_thread
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logger.error(f"Error updating thread: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.put("/chat/{thread_id}/message/{message_id}/")
-async def update_message(thread_id: int, message_id: int, request: dict = Body(...), db: Session = Depends(get_db)):
+async def update_message(
+    thread_id: int,
+    message_id: int,
+    request: dict = Body(...),
+    response_mode: Optional[str] = None,
+    x_response_mode: Optional[str] = Header(None),
+    user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Edit a user message, drop everything after it and regenerate the reply
+    
+    With response_mode=delta (or an X-Response-Mode: delta header) only the
+    edited message and the new assistant message are returned.
+    """
     try:
+        model = requested_model(request)
+        
         # Verify the message belongs to the user and thread
-        message = db.query(Message).filter(
+        message = (await db.execute(select(Message).join(ChatThread, ChatThread.id == Message.thread_id).where(
             Message.id == message_id,
             Message.thread_id == thread_id,
+            ChatThread.user_id == user.id,
             Message.sender == "user"  # Only allow editing user messages
-        ).first()
+        ))).scalars().first()
         
         if not message:
             raise HTTPException(status_code=404, detail="Message not found or cannot be edited")
             
         # Delete all messages that come after this message
-        db.query(Message).filter(
+        await db.execute(delete(Message).where(
             Message.thread_id == thread_id,
             Message.id > message_id
-        ).delete()
+        ))
         
         # Update the user message content
-        message.content = request.get("message")
-        db.commit()
-        db.refresh(message)
+        edited_content = request.get("message")
+        message.content = edited_content
         
-        # Get all messages up to this point for the AI context
-        chat_history = db.query(Message).filter(
-            Message.thread_id == thread_id,
-            Message.id <= message_id
-        ).order_by(Message.id).all()
+        # An edit inside the summarized range makes the rolling summary stale
+        chat_thread = await db.get(ChatThread, thread_id)
+        if chat_thread.summary_message_id and message_id <= chat_thread.summary_message_id:
+            chat_thread.summary = None
+            chat_thread.summary_message_id = None
         
-        # Format messages for OpenAI API
-        formatted_history = [
-            {"role": "user" if msg.sender == "user" else "assistant", "content": msg.content}
-            for msg in chat_history
-        ]
+        await db.flush()
+        edited_message = format_message_for_frontend(message)
         
-        # Generate new assistant response based on selected model with better error handling
-        model = request.get("model", "openai")  # Get model preference, default to OpenAI
+        # Later messages are gone, so the cached history is no longer valid
+        conversation_cache.invalidate(thread_id)
+        
+        # Get all messages up to this point for the AI context, read inside the same transaction
+        history = await read_history(db, thread_id)
+        
+        # Keep only the part of the history that fits the model's budget
+        formatted_history = assemble_context(chat_thread, history, model)
+        
+        # The edit, the truncation and any summary change commit together before the model call
+        await db.commit()
+        conversation_cache.put(thread_id, history)
         logger.info(f"Updating message with model: {model}")
         
         try:
-            if model == "gemini":
-                logger.info("Using Gemini service for response generation")
-                bot_reply = gemini_service.generate_response(formatted_history)
-            elif model == "claude":
-                logger.info("Using Claude service for response generation")
-                bot_reply = claude_service.generate_response(formatted_history)
-            else:
-                logger.info("Using OpenAI service for response generation")
-                bot_reply = openai_service.generate_response(formatted_history)
+            model, bot_reply = await generate_hedged_reply(model, formatted_history)
         except Exception as e:
             logger.error(f"Error generating response with {model} model: {str(e)}")
-            # Fall back to alternative model if first choice fails
-            try:
-                if model == "gemini":
-                    logger.info("Falling back to OpenAI service")
-                    bot_reply = openai_service.generate_response(formatted_history)
-                    model = "openai (fallback)"
-                else:
-                    logger.info("Falling back to Claude service")
-                    bot_reply = claude_service.generate_response(formatted_history)
-                    model = "claude (fallback)"
-            except Exception as fallback_error:
-                logger.error(f"Fallback model also failed: {str(fallback_error)}")
-                from alternatives import get_rule_based_response
-                # Get the last user message
-                last_user_message = message.content
-                bot_reply = get_rule_based_response(last_user_message)
-                model = "rule-based (fallback)"
+            from alternatives import get_rule_based_response
+            bot_reply = get_rule_based_response(edited_content, source="edit")
+            model = "rule-based (fallback)"
         
         # Add the new bot response with model information
-        new_bot_message = Message(
-            thread_id=thread_id,
-            role="assistant",
-            sender="assistant",
-            content=bot_reply,
-            model=model  # Store which model generated this response
-        )
-        db.add(new_bot_message)
-        db.commit()
-        db.refresh(new_bot_message)
+        new_bot_message = await save_assistant_message(db, thread_id, bot_reply, model)
+        
+        if wants_delta_response(response_mode, x_response_mode):
+            return [edited_message, new_bot_message]
         
         # Get all updated messages in order
-        all_messages = db.query(Message).filter(
-            Message.thread_id == thread_id
-        ).order_by(Message.id).all()
+        all_messages = (await db.execute(
+            select(Message).where(Message.thread_id == thread_id).order_by(Message.id)
+        )).scalars().all()
         
         return [format_message_for_frontend(msg) for msg in all_messages]
         
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logger.error(f"Error updating message: {str(e)}")
         logger.error(f"Full traceback: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.delete("/chat/{thread_id}/delete/")
-async def delete_thread(thread_id: int, user_id: int, db: Session = Depends(get_db)):
+async def delete_thread(thread_id: int, user: Principal = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     try:
-        chat_thread = db.query(ChatThread).filter(
+        chat_thread = (await db.execute(select(ChatThread).where(
             ChatThread.id == thread_id,
-            ChatThread.user_id == user_id
-        ).first()
+            ChatThread.user_id == user.id
+        ))).scalars().first()
         
         if not chat_thread:
             raise HTTPException(status_code=404, detail="Chat thread not found")
             
         # Instead of deleting, set the is_deleted flag
         chat_thread.is_deleted = True
-        db.commit()
+        await db.commit()
+        conversation_cache.invalidate(thread_id)
         
         return {"message": "Thread marked as deleted"}
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logger.error(f"Error deleting thread: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/chat/{thread_id}/restore/")
-async def restore_thread(thread_id: int, user_id: int, db: Session = Depends(get_db)):
+async def restore_thread(thread_id: int, user: Principal = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     try:
-        chat_thread = db.query(ChatThread).filter(
+        chat_thread = (await db.execute(select(ChatThread).where(
             ChatThread.id == thread_id,
-            ChatThread.user_id == user_id,
+            ChatThread.user_id == user.id,
             ChatThread.is_deleted.is_(True)
-        ).first()
+        ))).scalars().first()
         
         if not chat_thread:
             raise HTTPException(status_code=404, detail="Deleted thread not found")
             
         # Explicitly set is_deleted to False
         chat_thread.is_deleted = False
-        db.commit()
-        db.refresh(chat_thread)
+        await db.commit()
+        await refresh_thread(db, chat_thread)
+        conversation_cache.invalidate(thread_id)
         
         return chat_thread
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logger.error(f"Error restoring thread: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Helper function to store an upload and describe it for the analysis responses
+async def store_attachment(request, contents, content_type):
+    attachment_id = await asyncio.to_thread(attachment_store.save, contents, content_type)
+    return {
+        "attachment_id": attachment_id,
+        "attachment_url": str(request.url_for("get_attachment", attachment_id=attachment_id))
+    }
+
+@app.get("/attachments/{attachment_id}")
+async def get_attachment(attachment_id: str, if_none_match: Optional[str] = Header(None)):
+    """Serve a stored upload; its bytes never change, so browsers may cache it for good"""
+    stored = attachment_store.open(attachment_id)
+    if stored is None:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    path, media_type = stored
+    headers = {
+        "Cache-Control": f"public, max-age={ATTACHMENT_MAX_AGE_SECONDS}, immutable",
+        "ETag": attachment_etag(attachment_id),
+        "X-Content-Type-Options": "nosniff"
+    }
+    if if_none_match and headers["ETag"] in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers)
+
 @app.get("/")
 def root():
     return {"message": "FastAPI Chatbot is running!"}
 
+@app.get("/stats/")
+def get_stats():
+    """Runtime statistics for the in-process caches, provider circuits and login pool"""
+    return {
+        "conversation_cache": conversation_cache.stats(),
+        "response_cache": response_cache.stats(),
+        "content_cache": content_cache.stats(),
+        "attachments": attachment_store.stats(),
+        "circuit_breakers": circuit_breakers.stats(),
+        "auth_pool": auth_pool.stats(),
+        "google_certs": google_verifier.stats(),
+        "principal_cache": principal_cache.stats()
+    }
+
 @app.post("/analyze_image/")
-async def analyze_image(image: UploadFile = File(...), model: str = Form("gemini")):
-    """Analyze an image using Gemini or OpenAI with improved error handling"""
+async def analyze_image(request: Request, image: UploadFile = File(...), model: str = Form("gemini"), user: Principal = Depends(get_current_user)):
+    """Analyze an image using Gemini or OpenAI with improved error handling
+    
+    The upload is kept in the attachment store and referred to by
+    attachment_id/attachment_url rather than echoed back base64-encoded.
+    """
     try:
         # Read image file
         contents = await image.read()
@@ -514,35 +880,12 @@ async def analyze_image(image: UploadFile = File(...), model: str = Form("gemini
         file_size = len(contents) / 1024
         file_type = image.content_type or "unknown"
         logger.info(f"Image upload received: {image.filename}, {file_size:.1f} KB, type: {file_type}")
+        attachment = await store_attachment(request, contents, file_type)
         
         # Import utilities
-        import base64
         import traceback
-        from PIL import Image
-        from io import BytesIO
-        from main import image_analyzer
-        
-        # Validate and optimize the image
-        try:
-            # Check if it's a valid image
-            img = Image.open(BytesIO(contents))
-            width, height = img.size
-            format_name = img.format
-            logger.info(f"Valid image: {width}x{height} {format_name}")
-            
-            # Convert to RGB if needed
-            if img.mode in ('RGBA', 'LA'):
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                background.paste(img, mask=img.split()[3])
-                img = background
-                
-                # Convert back to bytes
-                output = BytesIO()
-                img.save(output, format="JPEG", quality=90)
-                contents = output.getvalue()
-                logger.info("Converted image to RGB format")
-        except Exception as img_err:
-            logger.error(f"Invalid image format: {str(img_err)}")
+        # The analyzer decodes, downscales and re-encodes the image for each provider
+        image_analyzer = providers.image_analyzer()
         
         # Try first with specified model
         preferred_model = model.lower()
@@ -550,17 +893,17 @@ async def analyze_image(image: UploadFile = File(...), model: str = Form("gemini
         
         try:
             # Process image with appropriate timeout
-            image_base64, analysis = await image_analyzer.analyze_image(
+            analysis = await image_analyzer.analyze_image(
                 contents,
                 preferred_model=preferred_model
             )
             
             # Check if we got a proper analysis
-            if "error" not in analysis and analysis.get("description") and "couldn't analyze" not in analysis.get("description", ""):
+            if "error" not in analysis and not analysis.get("fallback"):
                 logger.info(f"Image analyzed successfully with {preferred_model}")
             else:
                 logger.warning(f"{preferred_model} analysis failed, trying fallback with OpenAI")
-                image_base64, analysis = await image_analyzer.analyze_image(
+                analysis = await image_analyzer.analyze_image(
                     contents,
                     preferred_model="openai"
                 )
@@ -578,11 +921,11 @@ async def analyze_image(image: UploadFile = File(...), model: str = Form("gemini
             if "text" not in analysis:
                 analysis["text"] = ""
                 
-            logger.info(f"Returning analysis: {analysis['description'][:100]}...")
+            log_payload(logger, "Returning image analysis", analysis["description"], limit=100)
             
             # Explicitly structure the response in the expected format
             return {
-                "image_base64": image_base64,
+                **attachment,
                 "analysis": {
                     "description": analysis["description"],
                     "labels": analysis["labels"],
@@ -598,14 +941,15 @@ async def analyze_image(image: UploadFile = File(...), model: str = Form("gemini
             
             # Try direct Gemini analysis as a last resort
             try:
-                from gemini_service import GeminiService
-                
-                gemini = GeminiService()
-                image_base64 = base64.b64encode(contents).decode('utf-8')
-                description = gemini.analyze_image(image_base64)
+                gemini = providers.get("gemini")
+                prepared = await asyncio.to_thread(prepare_image, contents)
+                image_base64 = await asyncio.to_thread(prepared.base64_for, "gemini")
+                description = await asyncio.to_thread(gemini.analyze_image, image_base64)
+                if not analysis_succeeded(description):
+                    raise RuntimeError(description or "empty description")
                 
                 return {
-                    "image_base64": image_base64,
+                    **attachment,
                     "analysis": {
                         "description": description,
                         "labels": ["image"],
@@ -618,9 +962,8 @@ async def analyze_image(image: UploadFile = File(...), model: str = Form("gemini
                 logger.error(f"Direct Gemini analysis failed: {str(gemini_err)}")
         
         # Return a fallback response if all methods fail
-        image_base64 = base64.b64encode(contents).decode('utf-8')
         return {
-            "image_base64": image_base64,
+            **attachment,
             "analysis": {
                 "description": "I can see your image, but I'm currently experiencing technical issues with the image analysis service. Please try again later.",
                 "labels": ["image"],
@@ -637,11 +980,15 @@ async def analyze_image(image: UploadFile = File(...), model: str = Form("gemini
         raise HTTPException(status_code=500, detail=f"Image processing failed: {str(e)}")
 
 @app.post("/upload-image/")
-async def upload_image(file: UploadFile = File(...), model: str = Form(...), db: Session = Depends(get_db)):
+async def upload_image(file: UploadFile = File(...), model: str = Form(...), user: Principal = Depends(get_current_user)):
     try:
         # Read image data
         image_data = await file.read()
-        encoded_image = base64.b64encode(image_data).decode('utf-8')
+        try:
+            prepared = await asyncio.to_thread(prepare_image, image_data)
+        except Exception as img_err:
+            logger.error(f"Invalid image format: {str(img_err)}")
+            raise HTTPException(status_code=400, detail="Invalid image file")
         
         # Process with the appropriate model
         analysis = None
@@ -649,21 +996,37 @@ async def upload_image(file: UploadFile = File(...), model: str = Form(...), db:
         
         logger.info(f"Processing image with model: {model}")
         
+        # A picture described before by this model is answered from the store
+        digest = prepared.digest
+        stored = await asyncio.to_thread(content_cache.get, "image_description", digest, model)
+        if stored is not None:
+            logger.info(f"Using stored {model} description for image {digest[:12]}")
+            return {
+                "success": True,
+                "analysis": stored["analysis"],
+                "filename": file.filename
+            }
+        
+        # Downscaled, metadata-free JPEG within the provider's budget
+        encoded_image = await asyncio.to_thread(prepared.base64_for, model)
+        
         if model == "gemini":
             logger.info("Using Gemini for image analysis")
-            analysis = gemini_service.analyze_image(encoded_image)
+            analysis = await asyncio.to_thread(providers.get("gemini").analyze_image, encoded_image)
         elif model == "claude":
             logger.info("Using Claude for image analysis")
-            analysis = claude_service.analyze_image(encoded_image)
+            analysis = await asyncio.to_thread(providers.get("claude").analyze_image, encoded_image)
         else:
             logger.warning(f"Unsupported model for image analysis: {model}")
             raise HTTPException(status_code=400, detail="Selected model doesn't support image analysis")
         
         # Check if analysis was successful
-        if not analysis or "error" in analysis.lower():
+        if not analysis_succeeded(analysis):
             logger.warning(f"Analysis failed: {analysis}")
             raise HTTPException(status_code=500, detail=f"Failed to analyze image: {analysis}")
         
+        await asyncio.to_thread(content_cache.put, "image_description", digest, model, {"analysis": analysis})
+        
         return {
             "success": True,
             "analysis": analysis,
@@ -679,11 +1042,19 @@ async def upload_image(file: UploadFile = File(...), model: str = Form(...), db:
 
 @app.post("/analyze_document/")
 async def analyze_document(
+    request: Request,
     document: UploadFile = File(...),
     model: str = Form("gemini"),
-    filename: str = Form(None)
+    filename: str = Form(None),
+    question: str = Form(None),
+    user: Principal = Depends(get_current_user)
 ):
-    """Analyze a document (PDF, DOC, TXT) with AI model capabilities"""
+    """Analyze a document (PDF, DOC, TXT) with AI model capabilities
+    
+    The extracted text and each model's analysis are stored by content
+    hash, so re-uploading the same file skips parsing and, for a model
+    (and question) that already answered, the model call as well.
+    """
     try:
         # Read document file
         contents = await document.read()
@@ -693,47 +1064,12 @@ async def analyze_document(
         file_type = document.content_type or "unknown"
         logger.info(f"Document upload received: {filename or document.filename}, {file_size:.1f} KB, type: {file_type}")
         
-        # Process different document types
-        text_content = ""
-        
-        if file_type == "application/pdf":
-            # For PDF files
-            try:
-                from PyPDF2 import PdfReader
-                from io import BytesIO
-                
-                pdf = PdfReader(BytesIO(contents))
-                for page in pdf.pages:
-                    text_content += page.extract_text() + "\n\n"
-            except Exception as e:
-                logger.error(f"PDF extraction error: {str(e)}")
-                raise HTTPException(status_code=400, detail=f"Cannot process PDF: {str(e)}")
-                
-        elif file_type.startswith("text/"):
-            # For text files
-            try:
-                text_content = contents.decode('utf-8')
-            except UnicodeDecodeError:
-                try:
-                    text_content = contents.decode('latin-1')
-                except:
-                    raise HTTPException(status_code=400, detail="Unable to decode text file")
-        
-        elif "word" in file_type:
-            # For Word documents
-            try:
-                import docx
-                from io import BytesIO
-                
-                doc = docx.Document(BytesIO(contents))
-                text_content = "\n".join([para.text for para in doc.paragraphs])
-            except Exception as e:
-                logger.error(f"Word document extraction error: {str(e)}")
-                raise HTTPException(status_code=400, detail=f"Cannot process Word document: {str(e)}")
-        
-        else:
-            # Unsupported document type
-            raise HTTPException(status_code=400, detail=f"Unsupported document type: {file_type}")
+        # Extract the text page by page (parsing is CPU-bound, so keep it off the event loop)
+        try:
+            digest, pages = await asyncio.to_thread(load_pages, contents, file_type)
+        except DocumentExtractionError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        text_content = "\n\n".join(pages)
         
         # Summarize text content if too long
         if len(text_content) > 8000:
@@ -744,35 +1080,33 @@ async def analyze_document(
         # Use selected AI model to analyze the document
         try:
             # Choose the appropriate AI service based on model parameter
-            analysis = None
+            model = model.lower() if model.lower() in ("gemini", "claude") else "openai"
+            analysis = await asyncio.to_thread(stored_analysis, digest, model, question)
             
-            if model == "gemini":
-                analysis = gemini_service.generate_response([
-                    {"role": "user", "content": f"Please analyze this document: {summary_text}"}
-                ])
-            elif model == "claude":
-                analysis = claude_service.generate_response([
-                    {"role": "user", "content": f"Please analyze this document: {summary_text}"}
-                ])
+            if analysis is None:
+                prompt = f"Please analyze this document: {summary_text}"
+                if question:
+                    prompt = f"Answer this question about the document below: {question}\n\nDocument: {summary_text}"
+                label, analysis = await generate_hedged_reply(model, [{"role": "user", "content": prompt}])
+                # A fallback provider's answer is returned but not stored as this model's
+                if label == model:
+                    await asyncio.to_thread(save_analysis, digest, model, analysis, question)
             else:
-                analysis = openai_service.generate_response([
-                    {"role": "user", "content": f"Please analyze this document: {summary_text}"}
-                ])
+                logger.info(f"Using stored {model} analysis of document {digest[:12]}")
             
             # Extract key points
             key_points = extract_key_points(analysis)
             
             # Return in same format as image analysis for consistency
-            doc_base64 = base64.b64encode(contents).decode('utf-8')
-            
             return {
-                "image_base64": doc_base64,  # Using same field name for consistency
+                **await store_attachment(request, contents, file_type),
                 "analysis": {
                     "description": analysis,
                     "labels": key_points[:3],  # Top 3 points as labels
                     "text": summary_text[:500] + "..." if len(summary_text) > 500 else summary_text,
                     "objects": [],  # No objects in documents
-                    "document_type": file_type
+                    "document_type": file_type,
+                    "pages": len(pages)
                 },
                 "success": True  # Additional field for backward compatibility
             }
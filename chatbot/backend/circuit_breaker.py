@@ -0,0 +1,183 @@
+"""
+Circuit breakers for the AI providers
+
+One breaker per provider ("gemini") and per provider model
+("gemini/gemini-1.5-flash"). A breaker opens when the error rate over a
+rolling window crosses the threshold, so routing skips the provider without
+paying for a request. After a cooldown it goes half-open and lets a single
+trial through (or a background probe runs); a success closes it again.
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+
+from config import (
+    CIRCUIT_WINDOW_SECONDS, CIRCUIT_MIN_REQUESTS, CIRCUIT_ERROR_RATE,
+    CIRCUIT_OPEN_SECONDS, CIRCUIT_PROBE_INTERVAL
+)
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker over a rolling error-rate window"""
+
+    def __init__(self, name, window_seconds=CIRCUIT_WINDOW_SECONDS, min_requests=CIRCUIT_MIN_REQUESTS,
+                 error_rate=CIRCUIT_ERROR_RATE, open_seconds=CIRCUIT_OPEN_SECONDS):
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.open_seconds = open_seconds
+        self._outcomes = deque()  # (timestamp, succeeded)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._trial_started = None
+        self._lock = threading.Lock()
+        self.times_opened = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def allow_request(self):
+        """True if a request may be sent; in half-open state only one trial at a time"""
+        now = time.monotonic()
+        with self._lock:
+            state = self._current_state(now)
+            if state == CLOSED:
+                return True
+            if state == OPEN:
+                return False
+            # A trial whose outcome was never reported (e.g. a cancelled race) expires
+            if self._trial_started is None or now - self._trial_started > self.open_seconds:
+                self._trial_started = now
+                return True
+            return False
+
+    def probe_due(self):
+        """True if the breaker is open and its cooldown has passed"""
+        return self.state == HALF_OPEN
+
+    def record_success(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._current_state(now) == HALF_OPEN:
+                logger.info(f"Circuit for {self.name} closed after a successful trial")
+                self._state = CLOSED
+                self._outcomes.clear()
+                self._trial_started = None
+            self._outcomes.append((now, True))
+            self._trim(now)
+
+    def record_failure(self):
+        now = time.monotonic()
+        with self._lock:
+            state = self._current_state(now)
+            if state == HALF_OPEN:
+                self._open(now, "trial request failed")
+                return
+            self._outcomes.append((now, False))
+            self._trim(now)
+            if state == CLOSED and len(self._outcomes) >= self.min_requests:
+                failures = sum(1 for _, succeeded in self._outcomes if not succeeded)
+                if failures / len(self._outcomes) >= self.error_rate:
+                    self._open(now, f"{failures}/{len(self._outcomes)} requests failed")
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            failures = sum(1 for _, succeeded in self._outcomes if not succeeded)
+            return {
+                "state": self._current_state(now),
+                "requests": len(self._outcomes),
+                "failures": failures,
+                "times_opened": self.times_opened
+            }
+
+    def _current_state(self, now):
+        if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._trial_started = None
+        return self._state
+
+    def _open(self, now, reason):
+        logger.warning(f"Circuit for {self.name} opened: {reason}")
+        self._state = OPEN
+        self._opened_at = now
+        self._trial_started = None
+        self._outcomes.clear()
+        self.times_opened += 1
+
+    def _trim(self, now):
+        while self._outcomes and now - self._outcomes[0][0] > self.window_seconds:
+            self._outcomes.popleft()
+
+
+class CircuitBreakerRegistry:
+    """Breakers by name, plus the background probes for providers that are down"""
+
+    def __init__(self):
+        self._breakers = {}
+        self._probes = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            breaker = self._breakers.get(name)
+            if breaker is None:
+                breaker = self._breakers[name] = CircuitBreaker(name)
+            return breaker
+
+    def allow_request(self, name):
+        return self.get(name).allow_request()
+
+    def record_success(self, name):
+        self.get(name).record_success()
+
+    def record_failure(self, name):
+        self.get(name).record_failure()
+
+    def register_probe(self, name, probe):
+        """probe is an async callable that raises if the provider is still down"""
+        self._probes[name] = probe
+
+    async def probe_open_circuits(self):
+        """Send one probe to every provider whose breaker is waiting for a trial"""
+        for name, probe in list(self._probes.items()):
+            breaker = self.get(name)
+            if not breaker.probe_due() or not breaker.allow_request():
+                continue
+            try:
+                await asyncio.wait_for(probe(), timeout=CIRCUIT_OPEN_SECONDS)
+                breaker.record_success()
+                logger.info(f"Background probe for {name} succeeded")
+            except Exception as e:
+                breaker.record_failure()
+                logger.warning(f"Background probe for {name} failed: {str(e)}")
+
+    async def run_probes(self, interval=CIRCUIT_PROBE_INTERVAL):
+        """Probe open circuits forever (started from the app lifespan)"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.probe_open_circuits()
+            except Exception as e:
+                logger.error(f"Error probing open circuits: {str(e)}")
+
+    def stats(self):
+        with self._lock:
+            breakers = dict(self._breakers)
+        return {name: breaker.stats() for name, breaker in sorted(breakers.items())}
+
+
+# Shared registry used by the chat routes and the services
+circuit_breakers = CircuitBreakerRegistry()
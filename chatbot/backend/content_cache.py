@@ -0,0 +1,136 @@
+"""
+Persistent content-addressed store for analysis results
+
+Results are keyed by (namespace, digest, variant): the namespace names the
+kind of result ("image_analysis"), the digest identifies the content (a
+SHA-256 of the normalized bytes) and the variant whatever else shaped the
+result, such as the model. Entries live in a small SQLite file next to the
+app, so re-uploads and retries survive restarts, and the least recently
+used ones are evicted once the entry or byte limit is exceeded.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from config import CONTENT_CACHE_ENABLED, CONTENT_CACHE_PATH, CONTENT_CACHE_MAX_ENTRIES, CONTENT_CACHE_MAX_BYTES
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    namespace TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    used_at REAL NOT NULL,
+    PRIMARY KEY (namespace, digest, variant)
+);
+CREATE INDEX IF NOT EXISTS ix_results_used_at ON results (used_at);
+"""
+
+
+class ContentCache:
+    """LRU-bounded (namespace, digest, variant) -> JSON value store in a SQLite file"""
+
+    def __init__(self, path=CONTENT_CACHE_PATH, max_entries=CONTENT_CACHE_MAX_ENTRIES,
+                 max_bytes=CONTENT_CACHE_MAX_BYTES, enabled=CONTENT_CACHE_ENABLED):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._conn = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, namespace, digest, variant=""):
+        """Return the stored value, or None on a miss"""
+        if not self.enabled or not digest:
+            return None
+        try:
+            with self._lock:
+                conn = self._connect()
+                row = conn.execute(
+                    "SELECT value FROM results WHERE namespace = ? AND digest = ? AND variant = ?",
+                    (namespace, digest, variant)
+                ).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                conn.execute(
+                    "UPDATE results SET used_at = ? WHERE namespace = ? AND digest = ? AND variant = ?",
+                    (time.time(), namespace, digest, variant)
+                )
+                conn.commit()
+                self.hits += 1
+            return json.loads(row[0])
+        except Exception as e:
+            logger.warning(f"Content cache lookup failed: {str(e)}")
+            return None
+
+    def put(self, namespace, digest, variant, value):
+        """Store a JSON-serializable value, evicting least recently used entries over the limits"""
+        if not self.enabled or not digest:
+            return
+        try:
+            encoded = json.dumps(value)
+            now = time.time()
+            with self._lock:
+                conn = self._connect()
+                conn.execute(
+                    "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (namespace, digest, variant, encoded, len(encoded), now, now)
+                )
+                self._evict(conn)
+                conn.commit()
+        except Exception as e:
+            logger.warning(f"Content cache store failed: {str(e)}")
+
+    def stats(self):
+        entries = size = 0
+        if self.enabled:
+            try:
+                with self._lock:
+                    entries, size = self._connect().execute("SELECT count(*), coalesce(sum(size), 0) FROM results").fetchone()
+            except Exception as e:
+                logger.warning(f"Content cache stats failed: {str(e)}")
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": entries,
+            "bytes": size,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions
+        }
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+            # WAL lets several worker processes share the file
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    def _evict(self, conn):
+        entries, size = conn.execute("SELECT count(*), coalesce(sum(size), 0) FROM results").fetchone()
+        while entries > self.max_entries or size > self.max_bytes:
+            row = conn.execute("SELECT namespace, digest, variant, size FROM results ORDER BY used_at LIMIT 1").fetchone()
+            if row is None:
+                break
+            conn.execute("DELETE FROM results WHERE namespace = ? AND digest = ? AND variant = ?", row[:3])
+            entries -= 1
+            size -= row[3]
+            self.evictions += 1
+
+
+# Shared instance used by the image and document analysis paths
+content_cache = ContentCache()
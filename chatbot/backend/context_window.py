@@ -0,0 +1,162 @@
+"""
+Bounded context window assembly for the AI services
+
+Packs the most recent turns of a conversation into a per-model token
+budget so prompt size stays flat however long a thread gets. Turns that
+fall out of the window can be folded into a short rolling summary that is
+stored on the ChatThread and sent in front of the window.
+"""
+import logging
+import re
+
+from config import CONTEXT_TOKEN_BUDGETS, CONTEXT_SUMMARY_ENABLED, CONTEXT_SUMMARY_TOKENS
+
+logger = logging.getLogger(__name__)
+
+# Rough per-message cost of role markers and separators
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Longest excerpt of a single turn kept in the rolling summary
+SUMMARY_EXCERPT_CHARS = 160
+
+SUMMARY_PREFIX = "Summary of our earlier conversation:"
+
+
+def estimate_tokens(text):
+    """Cheap token estimate (about 4 characters per token for English text)"""
+    if not text:
+        return 0
+    return len(text) // 4 + 1
+
+
+def estimate_message_tokens(message):
+    content = message.get("content", "")
+    if not isinstance(content, str):
+        content = str(content)
+    return estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+
+
+def budget_for_model(model):
+    """Prompt token budget for a provider name ("openai") or model id ("gpt-4o-mini")"""
+    name = (model or "").lower()
+    if name.startswith("gpt") or "openai" in name:
+        return CONTEXT_TOKEN_BUDGETS["openai"]
+    if "gemini" in name:
+        return CONTEXT_TOKEN_BUDGETS["gemini"]
+    if "claude" in name:
+        return CONTEXT_TOKEN_BUDGETS["claude"]
+    return min(CONTEXT_TOKEN_BUDGETS.values())
+
+
+def _truncate_to_budget(message, budget):
+    """Cut a single oversized message down so it fits the budget on its own"""
+    max_chars = max((budget - MESSAGE_OVERHEAD_TOKENS) * 4, 0)
+    content = message.get("content", "")
+    if len(content) <= max_chars:
+        return message
+    return {**message, "content": content[:max_chars] + "... [truncated]"}
+
+
+def pack_recent_turns(history, budget):
+    """
+    Keep the newest messages whose estimated size fits the budget
+    Returns (window, first_index) where first_index is the position in
+    history of the oldest message that was kept
+    """
+    if not history:
+        return [], 0
+
+    used = 0
+    first_index = len(history)
+    for index in range(len(history) - 1, -1, -1):
+        cost = estimate_message_tokens(history[index])
+        if used + cost > budget:
+            break
+        used += cost
+        first_index = index
+
+    # Always send the latest message, even if it alone is over budget
+    if first_index == len(history):
+        first_index = len(history) - 1
+        return [_truncate_to_budget(history[-1], budget)], first_index
+
+    # Providers expect the conversation to open with a user turn
+    while first_index < len(history) - 1 and history[first_index].get("role") != "user":
+        first_index += 1
+
+    return list(history[first_index:]), first_index
+
+
+def fit_to_budget(history, model):
+    """
+    Trim a conversation to the model's budget (used by the services as a last guard)
+    A rolling summary attached to the first message is pinned: turns are
+    dropped before it is, and it is re-attached to whichever message opens
+    the trimmed window.
+    """
+    summary, history = split_summary(history)
+    budget = budget_for_model(model)
+    if summary:
+        budget -= estimate_tokens(f"{SUMMARY_PREFIX}\n{summary}\n\n")
+    window, first_index = pack_recent_turns(history, budget)
+    if first_index:
+        logger.info(f"Context window for {model}: kept {len(window)} of {len(history)} messages")
+    return attach_summary(window, summary)
+
+
+def build_context_window(history, model):
+    """
+    Pack a chat turn's history, leaving room for the rolling summary
+    Space for the summary is reserved whenever summaries are enabled, so
+    the window boundary does not depend on the summary length.
+    Returns (window, first_index) like pack_recent_turns.
+    """
+    budget = budget_for_model(model)
+    if CONTEXT_SUMMARY_ENABLED:
+        budget -= CONTEXT_SUMMARY_TOKENS
+    return pack_recent_turns(history, budget)
+
+
+def attach_summary(window, summary):
+    """Prefix the summary onto the first (user) message of the window"""
+    if not window or not summary:
+        return window
+    first = window[0]
+    return [{**first, "content": f"{SUMMARY_PREFIX}\n{summary}\n\n{first.get('content', '')}"}] + window[1:]
+
+
+def split_summary(history):
+    """Return (summary, history) with a summary added by attach_summary taken off the first message"""
+    if not history:
+        return None, history
+    content = history[0].get("content", "")
+    if not isinstance(content, str) or not content.startswith(f"{SUMMARY_PREFIX}\n"):
+        return None, history
+    summary, _, first_content = content[len(SUMMARY_PREFIX) + 1:].partition("\n\n")
+    return summary, [{**history[0], "content": first_content}] + list(history[1:])
+
+
+def _excerpt(text):
+    clean = re.sub(r"\s+", " ", text or "").strip()
+    first_sentence = re.split(r"(?<=[.!?])\s", clean, maxsplit=1)[0]
+    if len(first_sentence) > SUMMARY_EXCERPT_CHARS:
+        return first_sentence[:SUMMARY_EXCERPT_CHARS - 3] + "..."
+    return first_sentence
+
+
+def update_rolling_summary(summary, dropped_turns, max_tokens=CONTEXT_SUMMARY_TOKENS):
+    """
+    Fold turns that left the window into the summary
+    Each turn contributes one short excerpt line; the oldest lines are
+    dropped once the summary exceeds max_tokens so it stays bounded.
+    """
+    lines = summary.split("\n") if summary else []
+    for turn in dropped_turns:
+        excerpt = _excerpt(turn.get("content", ""))
+        if excerpt:
+            speaker = "User" if turn.get("role") == "user" else "Assistant"
+            lines.append(f"- {speaker}: {excerpt}")
+
+    while len(lines) > 1 and estimate_tokens("\n".join(lines)) > max_tokens:
+        lines.pop(0)
+    return "\n".join(lines) or None
@@ -0,0 +1,149 @@
+"""
+Per-process LRU cache of conversation histories keyed by thread_id
+
+Each entry is the ordered list of {"id", "role", "content"} dicts the chat
+routes feed into the context window. New turns are appended as they are
+written, so a warm thread never re-reads its history from the database.
+Edits, deletes and restores invalidate the thread instead of patching it.
+
+The invalidation only reaches the process that made the change. The cache
+therefore assumes a single worker process serves a given thread: with
+several uvicorn workers behind a non-sticky balancer, an edit or delete
+handled by one worker leaves the others serving the old history. Run one
+worker, route each thread to the same worker, or set
+CONVERSATION_CACHE_ENABLED=False.
+"""
+import logging
+import threading
+from collections import OrderedDict
+
+from config import CONVERSATION_CACHE_ENABLED, CONVERSATION_CACHE_MAX_THREADS, CONVERSATION_CACHE_MAX_BYTES
+
+logger = logging.getLogger(__name__)
+
+# Rough per-message cost of the dict and its keys on top of the content itself
+ENTRY_OVERHEAD_BYTES = 200
+
+
+def history_entry(message):
+    """Convert a Message row into a cached history entry"""
+    return {
+        "id": message.id,
+        "role": "user" if message.sender == "user" else "assistant",
+        "content": message.content or ""
+    }
+
+
+def _entry_size(entry):
+    return len(entry["content"]) + ENTRY_OVERHEAD_BYTES
+
+
+class ConversationCache:
+    """Bounded LRU of thread histories with hit/miss accounting"""
+
+    def __init__(self, max_threads=CONVERSATION_CACHE_MAX_THREADS, max_bytes=CONVERSATION_CACHE_MAX_BYTES, enabled=CONVERSATION_CACHE_ENABLED):
+        self.max_threads = max_threads
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._threads = OrderedDict()  # thread_id -> (entries, size in bytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, thread_id):
+        """Return a copy of the cached history, or None on a miss"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            cached = self._threads.get(thread_id)
+            if cached is None:
+                self.misses += 1
+                return None
+            self._threads.move_to_end(thread_id)
+            self.hits += 1
+            return list(cached[0])
+
+    def put(self, thread_id, entries):
+        """Store the full history of a thread"""
+        if not self.enabled:
+            return
+        entries = list(entries)
+        size = sum(_entry_size(entry) for entry in entries)
+        with self._lock:
+            self._discard(thread_id)
+            if size > self.max_bytes:
+                # Never let one huge thread flush everything else
+                return
+            self._threads[thread_id] = (entries, size)
+            self._bytes += size
+            self._evict()
+
+    def append(self, thread_id, *new_entries):
+        """Add freshly written messages to a cached thread (no-op if not cached)"""
+        if not self.enabled:
+            return
+        with self._lock:
+            cached = self._threads.get(thread_id)
+            if cached is None:
+                return
+            entries, size = cached
+            for entry in new_entries:
+                if entries and entry["id"] <= entries[-1]["id"]:
+                    # Out-of-order write from a concurrent request - reload next time
+                    self._discard(thread_id)
+                    self.invalidations += 1
+                    return
+                entries.append(entry)
+                size += _entry_size(entry)
+                self._bytes += _entry_size(entry)
+            self._threads[thread_id] = (entries, size)
+            self._threads.move_to_end(thread_id)
+            self._evict()
+
+    def invalidate(self, thread_id):
+        """Forget a thread after an edit, delete or restore"""
+        with self._lock:
+            if self._discard(thread_id):
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._threads.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "threads": len(self._threads),
+                "bytes": self._bytes,
+                "max_threads": self.max_threads,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+    def _discard(self, thread_id):
+        cached = self._threads.pop(thread_id, None)
+        if cached is None:
+            return False
+        self._bytes -= cached[1]
+        return True
+
+    def _evict(self):
+        while self._threads and (len(self._threads) > self.max_threads or self._bytes > self.max_bytes):
+            thread_id, (_, size) = self._threads.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            logger.debug(f"Evicted conversation cache entry for thread {thread_id}")
+
+
+# Shared instance used by the chat routes
+conversation_cache = ConversationCache()
@@ -0,0 +1,43 @@
+"""
+Run the Alembic schema migrations from the application
+
+Databases created by Base.metadata.create_all before migrations existed
+have the tables but no alembic_version table. They are stamped at the
+initial revision first so the later migrations apply on top of them.
+"""
+import logging
+import os
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import inspect
+
+from config import DATABASE_URL
+from database import engine
+
+logger = logging.getLogger(__name__)
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Revision matching the schema create_all produced before migrations existed
+BASELINE_REVISION = "0001"
+
+
+def alembic_config():
+    config = Config(os.path.join(BACKEND_DIR, "alembic.ini"))
+    config.set_main_option("script_location", os.path.join(BACKEND_DIR, "migrations"))
+    config.set_main_option("sqlalchemy.url", DATABASE_URL.replace("%", "%%"))
+    # Keep the application's logging setup
+    config.attributes["configure_logger"] = False
+    return config
+
+
+def upgrade_database(revision="head"):
+    """Bring the database schema up to date"""
+    config = alembic_config()
+    tables = set(inspect(engine).get_table_names())
+    if "alembic_version" not in tables and "chat_threads" in tables:
+        logger.info(f"Existing schema without migration history, stamping revision {BASELINE_REVISION}")
+        command.stamp(config, BASELINE_REVISION)
+    command.upgrade(config, revision)
+    logger.info(f"Database schema is at {revision}")
@@ -0,0 +1,86 @@
+"""
+Content-addressed store of extracted document text and model analyses
+
+Documents are identified by the SHA-256 of their bytes. The text of each
+page is extracted once per (document, declared type) and kept in the
+content cache, as is every model's analysis of it (per question, when one
+is asked), so a re-upload or a follow-up question about the same file
+skips PDF/DOCX parsing and, when already answered, the model call too.
+"""
+import hashlib
+import logging
+from io import BytesIO
+
+from content_cache import content_cache
+
+logger = logging.getLogger(__name__)
+
+TEXT_NAMESPACE = "document_text"
+ANALYSIS_NAMESPACE = "document_analysis"
+
+
+class DocumentExtractionError(Exception):
+    """The document could not be read as its declared type"""
+
+
+def document_digest(contents):
+    return hashlib.sha256(contents).hexdigest()
+
+
+def extract_pages(contents, file_type):
+    """Return the document's text as a list of pages (a single page for non-PDF types)"""
+    if file_type == "application/pdf":
+        try:
+            from PyPDF2 import PdfReader
+            pdf = PdfReader(BytesIO(contents))
+            return [page.extract_text() or "" for page in pdf.pages]
+        except Exception as e:
+            logger.error(f"PDF extraction error: {str(e)}")
+            raise DocumentExtractionError(f"Cannot process PDF: {str(e)}")
+
+    if file_type.startswith("text/"):
+        for encoding in ("utf-8", "latin-1"):
+            try:
+                return [contents.decode(encoding)]
+            except UnicodeDecodeError:
+                continue
+        raise DocumentExtractionError("Unable to decode text file")
+
+    if "word" in file_type:
+        try:
+            import docx
+            doc = docx.Document(BytesIO(contents))
+            return ["\n".join(para.text for para in doc.paragraphs)]
+        except Exception as e:
+            logger.error(f"Word document extraction error: {str(e)}")
+            raise DocumentExtractionError(f"Cannot process Word document: {str(e)}")
+
+    raise DocumentExtractionError(f"Unsupported document type: {file_type}")
+
+
+def load_pages(contents, file_type):
+    """Return (digest, pages), parsing the document only the first time its bytes are seen"""
+    digest = document_digest(contents)
+    stored = content_cache.get(TEXT_NAMESPACE, digest, file_type)
+    if stored is not None:
+        logger.info(f"Using stored text of document {digest[:12]} ({len(stored['pages'])} pages)")
+        return digest, stored["pages"]
+    pages = extract_pages(contents, file_type)
+    content_cache.put(TEXT_NAMESPACE, digest, file_type, {"pages": pages})
+    return digest, pages
+
+
+def analysis_variant(model, question=None):
+    if not question:
+        return model
+    return f"{model}:{hashlib.sha256(question.strip().encode('utf-8')).hexdigest()[:16]}"
+
+
+def stored_analysis(digest, model, question=None):
+    """The model's earlier analysis of this document (and question), or None"""
+    stored = content_cache.get(ANALYSIS_NAMESPACE, digest, analysis_variant(model, question))
+    return stored["analysis"] if stored else None
+
+
+def save_analysis(digest, model, analysis, question=None):
+    content_cache.put(ANALYSIS_NAMESPACE, digest, analysis_variant(model, question), {"analysis": analysis})
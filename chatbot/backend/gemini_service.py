@@ -4,7 +4,15 @@ import json
 import os
 import traceback
 import time
-from alternatives import get_rule_based_response
+import base64
+from io import BytesIO
+from alternatives import AnalysisFailure, get_rule_based_response
+from http_clients import get_async_client, iter_sse_data, run_sync
+from circuit_breaker import circuit_breakers
+from capability_registry import capability_registry
+from context_window import fit_to_budget
+from metrics import ProviderCall, fallbacks
+from model_fallback import stream_models, with_identity
 
 from dotenv import load_dotenv
 
@@ -20,6 +28,25 @@ CLAUDE_API_KEY = os.getenv("CLAUDE_API_KEY")
 GOOGLE_CLIENT_ID=os.getenv("GOOGLE_CLIENT_ID")
 GOOGLE_CLIENT_SECRET=os.getenv("GOOGLE_CLIENT_SECRET")
 
+# Chat models in order of preference
+GEMINI_CHAT_MODELS = [
+    "gemini-2.0-flash",
+    "gemini-pro",
+    "gemini-1.5-flash",
+    "gemini-1.0-pro"
+]
+
+# (model, payload format) pairs that support image inputs, in order of preference
+GEMINI_VISION_OPTIONS = [
+    ("gemini-1.5-pro", "parts"),
+    ("gemini-pro-vision", "parts"),
+    ("gemini-1.0-pro-vision", "parts"),
+    ("gemini-1.5-pro", "role")  # Role-based format works with some API versions
+]
+
+# Sampling settings for chat replies
+GEMINI_GENERATION_CONFIG = {"temperature": 0.7, "maxOutputTokens": 800, "topP": 0.95}
+
 class GeminiService:
     """Service class to handle Google Gemini API interactions"""
     
@@ -29,7 +56,12 @@ class GeminiService:
         
         # Set default API version and model based on the working curl example
         self.api_version = "v1beta"
-        self.model = "gemini-2.0-flash"  # Use the model from the curl example
+        self.model = GEMINI_CHAT_MODELS[0]  # Use the model from the curl example
+        
+        # Start from the model that worked last time, if any
+        remembered = capability_registry.remembered("gemini", "chat")
+        if remembered:
+            self.model = remembered["model"]
         
         logger.info(f"Gemini service initializing with API version: {self.api_version}, model: {self.model}")
         logger.info(f"Using API key: {self.api_key[:5]}...{self.api_key[-4:]}")
@@ -37,8 +69,12 @@ class GeminiService:
         # Initialize requests session for connection pooling
         self.session = requests.Session()
         
-        # Test the connection on startup
-        self._test_connection()
+        # The connection test runs in the provider warm-up, not here
+    
+    @property
+    def generation_config(self):
+        """Everything besides the prompt that shapes a reply"""
+        return {"api_version": self.api_version, "model": self.model, **GEMINI_GENERATION_CONFIG}
     
     def _test_connection(self):
         """Test the API connection silently"""
@@ -69,6 +105,7 @@ class GeminiService:
             
             if response.status_code == 200:
                 logger.info("✅ Gemini API connection successful")
+                capability_registry.confirm("gemini", "chat", self.model)
                 return True
             else:
                 logger.warning(f"⚠️ Gemini API connection failed with status code: {response.status_code}")
@@ -92,11 +129,7 @@ class GeminiService:
     def _try_fallback_model(self):
         """Try connection with fallback models if the main one fails"""
         # List of fallback models to try
-        fallback_models = [
-            "gemini-pro",
-            "gemini-1.5-flash",
-            "gemini-1.0-pro"
-        ]
+        fallback_models = [m for m in GEMINI_CHAT_MODELS if m != self.model]
         
         for model in fallback_models:
             try:
@@ -121,6 +154,7 @@ class GeminiService:
                 if response.status_code == 200:
                     logger.info(f"✅ Fallback model {model} works! Using this instead.")
                     self.model = model
+                    capability_registry.confirm("gemini", "chat", model)
                     return True
             except Exception as e:
                 logger.warning(f"Fallback model {model} failed: {str(e)}")
@@ -129,54 +163,86 @@ class GeminiService:
         logger.error("❌ All Gemini models failed, will use rule-based fallbacks")
         return False
     
+    def _discover_chat_model(self):
+        """Return the first chat model that answers, in order of preference (used for re-validation)"""
+        payload = {"contents": [{"parts": [{"text": "Hello"}]}]}
+        for model in GEMINI_CHAT_MODELS:
+            url = f"https://generativelanguage.googleapis.com/{self.api_version}/models/{model}:generateContent?key={self.api_key}"
+            try:
+                response = self.session.post(url, headers={"Content-Type": "application/json"}, json=payload, timeout=10)
+                if response.status_code == 200:
+                    return model, None
+            except Exception as e:
+                logger.warning(f"Re-validation of {model} failed: {str(e)}")
+        return None
+    
+    def _build_payload(self, conversation_history):
+        """Build the generateContent payload and return it with the latest user message"""
+        # Keep the prompt inside this model's token budget
+        conversation_history = fit_to_budget(conversation_history, self.model)
+        
+        # Format the conversation history to match Gemini API structure
+        # The API expects a specific format for the conversation
+        formatted_parts = []
+        
+        # Add the conversation history
+        user_message = ""
+        for msg in conversation_history:
+            role = msg.get('role', '')
+            content = msg.get('content', '')
+            
+            # Store the most recent user message for simpler prompt if needed
+            if role == 'user':
+                user_message = content
+            
+            # Add to formatted parts
+            formatted_parts.append({
+                "text": f"{role}: {content}\n"
+            })
+        
+        # Add final instruction to identify as Gemini
+        formatted_parts.append({
+            "text": "Please respond as Gemini AI developed by Google."
+        })
+        
+        # Create the exact payload structure from the curl example
+        payload = {
+            "contents": [
+                {
+                    "parts": formatted_parts
+                }
+            ],
+            "generationConfig": dict(GEMINI_GENERATION_CONFIG)
+        }
+        return payload, user_message
+    
     def generate_response(self, conversation_history):
+        """Synchronous wrapper around generate_response_async for non-async callers"""
+        return run_sync(self.generate_response_async(conversation_history))
+    
+    async def generate_response_async(self, conversation_history):
         """Generate a response using Google Gemini API with the correct API structure"""
         # Check for valid API key
         if not self.api_key:
             logger.error("Invalid or missing Gemini API key")
             return "I apologize, but I can't connect to Gemini due to an invalid API key."
             
+        # Pick up the remembered model (re-validated in the background once stale)
+        remembered = capability_registry.remembered("gemini", "chat", self._discover_chat_model)
+        if remembered:
+            self.model = remembered["model"]
+            
         try:
             # Log that we're using Gemini
             logger.info(f"Using Gemini model: {self.model}")
             
-            # Format the conversation history to match Gemini API structure
-            # The API expects a specific format for the conversation
-            formatted_parts = []
+            payload, user_message = self._build_payload(conversation_history)
             
-            # Add the conversation history
-            user_message = ""
-            for msg in conversation_history:
-                role = msg.get('role', '')
-                content = msg.get('content', '')
-                
-                # Store the most recent user message for simpler prompt if needed
-                if role == 'user':
-                    user_message = content
-                
-                # Add to formatted parts
-                formatted_parts.append({
-                    "text": f"{role}: {content}\n"
-                })
-            
-            # Add final instruction to identify as Gemini
-            formatted_parts.append({
-                "text": "Please respond as Gemini AI developed by Google."
-            })
-            
-            # Create the exact payload structure from the curl example
-            payload = {
-                "contents": [
-                    {
-                        "parts": formatted_parts
-                    }
-                ],
-                "generationConfig": {
-                    "temperature": 0.7,
-                    "maxOutputTokens": 800,
-                    "topP": 0.95
-                }
-            }
+            # Go straight to the fallback models while this one's circuit is open
+            breaker = circuit_breakers.get(f"gemini/{self.model}")
+            if not breaker.allow_request():
+                logger.warning(f"Circuit for gemini/{self.model} is open, using fallback models")
+                return await self._generate_with_fallback(user_message)
             
             # Use the exact URL format from the curl example
             url = f"https://generativelanguage.googleapis.com/{self.api_version}/models/{self.model}:generateContent?key={self.api_key}"
@@ -184,68 +250,118 @@ class GeminiService:
             # Log the request without the key
             logger.info(f"Sending request to: {url.split('?')[0]}")
             
-            headers = {"Content-Type": "application/json"}
-            
-            # Make the API call with proper timeout
+            # Make the API call on the pooled async client with proper timeout
+            client = get_async_client("gemini")
             request_time = time.time()
-            response = self.session.post(url, headers=headers, json=payload, timeout=30)
+            with ProviderCall("gemini", self.model) as call:
+                try:
+                    response = await client.post(url, json=payload, timeout=30)
+                except Exception:
+                    breaker.record_failure()
+                    raise
+                call.record_response(response)
+                if response.status_code == 200:
+                    call.usage(**self._extract_usage(response.json()))
             response_time = time.time() - request_time
             
             logger.info(f"Gemini API responded in {response_time:.2f}s with status: {response.status_code}")
             
             # Process successful response
             if response.status_code == 200:
-                result = response.json()
-                
-                # Extract text from response
-                text = ""
-                
-                if 'candidates' in result and result['candidates'] and 'content' in result['candidates'][0]:
-                    content = result['candidates'][0]['content']
-                    if 'parts' in content:
-                        for part in content['parts']:
-                            if 'text' in part:
-                                text += part['text']
+                breaker.record_success()
+                capability_registry.confirm("gemini", "chat", self.model)
+                text = self._extract_text(response.json())
                 
                 # Ensure response identifies as Gemini
                 if "gemini" not in text.lower() and "google" not in text.lower():
                     text = "I am Gemini, Google's AI assistant.\n\n" + text
                 
-                logger.info(f"✅ Gemini response generated ({len(text)} chars)")
+                logger.info(f"Gemini response generated ({len(text)} chars)")
                 return text
             else:
-                logger.error(f"❌ Gemini API request failed: {response.status_code}")
+                breaker.record_failure()
+                logger.error(f"Gemini API request failed: {response.status_code}")
                 try:
                     error_info = response.json()
                     logger.error(f"Error details: {json.dumps(error_info)[:300]}")
                     
                     # Try with fallback model if appropriate
                     if "NOT_FOUND" in str(error_info) or "INVALID_ARGUMENT" in str(error_info):
-                        return self._generate_with_fallback(user_message)
+                        return await self._generate_with_fallback(user_message)
                 except:
                     logger.error(f"Raw response: {response.text[:200]}")
                 
-                return "I'm Gemini, but I encountered an API issue. Let me try a different approach..." + self._generate_with_fallback(user_message)
+                return "I'm Gemini, but I encountered an API issue. Let me try a different approach..." + await self._generate_with_fallback(user_message)
         
         except Exception as e:
             logger.error(f"Error in Gemini service: {str(e)}")
             logger.error(traceback.format_exc())
-            return "I'm Gemini, but I encountered an unexpected error. " + get_rule_based_response(conversation_history[-1]['content'] if conversation_history else "Help me")
+            return "I'm Gemini, but I encountered an unexpected error. " + get_rule_based_response(conversation_history[-1]['content'] if conversation_history else "Help me", source="gemini")
     
-    def _generate_with_fallback(self, user_message):
-        """Generate a response using fallback models"""
-        # List of fallback models to try in order
-        fallback_models = [
-            "gemini-pro",
-            "gemini-1.5-flash",
-            "gemini-1.0-pro"
-        ]
+    async def stream_response(self, conversation_history):
+        """Stream response text chunks, falling back through the chat models like generate_response_async"""
+        if not self.api_key:
+            raise ValueError("Invalid or missing Gemini API key")
+        
+        # Pick up the remembered model (re-validated in the background once stale)
+        remembered = capability_registry.remembered("gemini", "chat", self._discover_chat_model)
+        if remembered:
+            self.model = remembered["model"]
+        
+        payload, _ = self._build_payload(conversation_history)
+        models = [self.model] + [m for m in GEMINI_CHAT_MODELS if m != self.model]
+        stream = stream_models("gemini", models, lambda model: self._stream_model(model, payload))
+        async for text in with_identity(stream, ("gemini", "google"), "I am Gemini, Google's AI assistant.\n\n"):
+            yield text
+    
+    async def _stream_model(self, model, payload):
+        """Stream one model's reply from the streamGenerateContent endpoint"""
+        url = f"https://generativelanguage.googleapis.com/{self.api_version}/models/{model}:streamGenerateContent?alt=sse&key={self.api_key}"
+        logger.info(f"Streaming from: {url.split('?')[0]}")
         
-        # Skip the current model if it's in the fallback list
-        fallback_models = [m for m in fallback_models if m != self.model]
+        client = get_async_client("gemini")
+        with ProviderCall("gemini", model) as call:
+            async with client.stream("POST", url, json=payload, timeout=30) as response:
+                call.record_response(response)
+                if response.status_code != 200:
+                    await response.aread()
+                    raise RuntimeError(f"Gemini streaming request failed: {response.status_code} {response.text[:200]}")
+                async for data in iter_sse_data(response):
+                    chunk = json.loads(data)
+                    call.usage(**self._extract_usage(chunk))
+                    text = self._extract_text(chunk)
+                    if text:
+                        call.first_token()
+                        yield text
+    
+    def _extract_usage(self, result):
+        """Token counts from a response's usageMetadata (running totals in a stream)"""
+        usage = result.get('usageMetadata') or {}
+        return {"input_tokens": usage.get('promptTokenCount'), "output_tokens": usage.get('candidatesTokenCount')}
+    
+    def _extract_text(self, result):
+        """Concatenate the text parts of the first candidate in a Gemini response"""
+        text = ""
+        if 'candidates' in result and result['candidates'] and 'content' in result['candidates'][0]:
+            content = result['candidates'][0]['content']
+            if 'parts' in content:
+                for part in content['parts']:
+                    if 'text' in part:
+                        text += part['text']
+        return text
+    
+    async def _generate_with_fallback(self, user_message):
+        """Generate a response using fallback models"""
+        # Try the other chat models in order, skipping the one that just failed
+        fallback_models = [m for m in GEMINI_CHAT_MODELS if m != self.model]
+        client = get_async_client("gemini")
         
         # Try each fallback model
         for model in fallback_models:
+            breaker = circuit_breakers.get(f"gemini/{model}")
+            if not breaker.allow_request():
+                logger.info(f"Skipping fallback model {model}: circuit is open")
+                continue
             try:
                 logger.info(f"Trying fallback model: {model}")
                 
@@ -268,35 +384,36 @@ class GeminiService:
                     }
                 }
                 
-                headers = {"Content-Type": "application/json"}
-                response = self.session.post(url, headers=headers, json=payload, timeout=20)
+                with ProviderCall("gemini", model) as call:
+                    response = await client.post(url, json=payload, timeout=20)
+                    call.record_response(response)
+                    if response.status_code == 200:
+                        call.usage(**self._extract_usage(response.json()))
                 
                 if response.status_code == 200:
-                    result = response.json()
-                    
-                    # Extract text from response
-                    text = ""
-                    if 'candidates' in result and result['candidates'] and 'content' in result['candidates'][0]:
-                        for part in result['candidates'][0]['content']['parts']:
-                            if 'text' in part:
-                                text += part['text']
+                    breaker.record_success()
+                    text = self._extract_text(response.json())
                     
                     # Ensure response identifies as Gemini
                     if "gemini" not in text.lower() and "google" not in text.lower():
                         text = "I am Gemini, Google's AI assistant.\n\n" + text
                     
                     # Update the model for future requests
-                    logger.info(f"✅ Fallback response generated with {model}")
+                    logger.info(f"Fallback response generated with {model}")
+                    fallbacks.inc(requested=f"gemini/{self.model}", served=f"gemini/{model}", kind="model")
                     self.model = model
+                    capability_registry.confirm("gemini", "chat", model)
                     
                     return text
+                breaker.record_failure()
             except Exception as e:
+                breaker.record_failure()
                 logger.warning(f"Fallback attempt with {model} failed: {str(e)}")
                 continue
         
         # If all fallbacks fail, use rule-based response
         logger.error("All fallback attempts failed, using rule-based response")
-        return get_rule_based_response(user_message)
+        return get_rule_based_response(user_message, source="gemini")
     
     def analyze_image(self, image_data, prompt="Analyze this image in detail"):
         """Analyze image using Google Gemini Vision API with robust fallbacks"""
@@ -305,7 +422,7 @@ class GeminiService:
             
             # Make sure we have valid image data
             if not image_data:
-                return "I cannot analyze an empty image."
+                return AnalysisFailure("I cannot analyze an empty image.")
                 
             # Convert to base64 if it isn't already
             if isinstance(image_data, bytes):
@@ -313,171 +430,104 @@ class GeminiService:
             else:
                 image_base64 = image_data
                 
-            # Find a working model - these are the current models that support vision
-            models_to_try = [
-                "gemini-1.5-pro",  # This is the latest model that supports image inputs
-                "gemini-pro-vision",
-                "gemini-1.0-pro-vision",
-            ]
+            # The option that worked last time goes first, so a steady-state call is one request
+            options = capability_registry.ordered("gemini", "vision", GEMINI_VISION_OPTIONS, self._discover_vision_option)
             
-            logger.info(f"Will try these models: {', '.join(models_to_try)}")
+            logger.info(f"Will try these options: {', '.join(f'{m} ({f})' for m, f in options)}")
             
-            for model in models_to_try:
-                try:
-                    logger.info(f"Attempting image analysis with {model}")
-                    
-                    # Build URL with the model
-                    url = f"https://generativelanguage.googleapis.com/{self.api_version}/models/{model}:generateContent?key={self.api_key}"
-                    
-                    # Build payload in the correct format for each model version
-                    if "1.5" in model:
-                        # Format for newer 1.5 models
-                        payload = {
-                            "contents": [{
-                                "parts": [
-                                    {"text": prompt},
-                                    {
-                                        "inline_data": {
-                                            "mime_type": "image/jpeg",
-                                            "data": image_base64
-                                        }
-                                    }
-                                ]
-                            }],
-                            "generationConfig": {
-                                "temperature": 0.3,
-                                "topK": 32,
-                                "topP": 1,
-                                "maxOutputTokens": 1024
-                            }
-                        }
-                    else:
-                        # Format for older models
-                        payload = {
-                            "contents": [{
-                                "parts": [
-                                    {"text": prompt},
-                                    {
-                                        "inline_data": {
-                                            "mime_type": "image/jpeg",
-                                            "data": image_base64
-                                        }
-                                    }
-                                ]
-                            }],
-                            "generationConfig": {
-                                "temperature": 0.4,
-                                "maxOutputTokens": 800
-                            }
-                        }
-                    
-                    headers = {"Content-Type": "application/json"}
-                    
-                    logger.info(f"Sending request to {model}")
-                    
-                    # Make the API call with extended timeout
-                    response = self.session.post(url, headers=headers, json=payload, timeout=45)
-                    
-                    if response.status_code == 200:
-                        result = response.json()
-                        
-                        # Extract text from response
-                        if 'candidates' in result and result['candidates']:
-                            candidate = result['candidates'][0]
-                            if 'content' in candidate and 'parts' in candidate['content']:
-                                parts = candidate['content']['parts']
-                                text = ""
-                                for part in parts:
-                                    if 'text' in part:
-                                        text += part['text']
-                                
-                                if text:
-                                    # Ensure response identifies as Gemini
-                                    if "gemini" not in text.lower() and "google" not in text.lower():
-                                        text = f"As Gemini, I've analyzed this image:\n\n{text}"
-                                    
-                                    logger.info(f"✅ Successfully analyzed image with {model}")
-                                    return text
-                                else:
-                                    logger.warning(f"Empty text response from {model}")
-                            else:
-                                logger.warning(f"Unexpected response format from {model}: {candidate}")
-                        else:
-                            logger.warning(f"No candidates in response from {model}")
-                    else:
-                        logger.warning(f"{model} returned status {response.status_code}")
-                        try:
-                            error_json = response.json()
-                            logger.warning(f"Error details: {json.dumps(error_json)}")
-                        except:
-                            logger.warning(f"Raw error response: {response.text[:200]}")
-                
-                except Exception as e:
-                    logger.error(f"Error with {model}: {str(e)}")
-            
-            # Special handling for role-based payload format (alternative format)
-            try:
-                logger.info("Trying alternative payload format for Gemini Vision")
-                
-                # Use gemini-1.5-pro as it's more likely to work with role-based format
-                model = "gemini-1.5-pro"
-                url = f"https://generativelanguage.googleapis.com/{self.api_version}/models/{model}:generateContent?key={self.api_key}"
-                
-                # Role-based format (works with some API versions)
-                alt_payload = {
-                    "contents": [
-                        {
-                            "role": "user",
-                            "parts": [
-                                {
-                                    "text": "Please analyze this image in detail and describe what you see."
-                                }, 
-                                {
-                                    "inline_data": {
-                                        "mime_type": "image/jpeg",
-                                        "data": image_base64
-                                    }
-                                }
-                            ]
-                        }
-                    ],
-                    "generationConfig": {
-                        "temperature": 0.2,
-                        "maxOutputTokens": 1024
-                    }
-                }
-                
-                response = self.session.post(
-                    url, 
-                    headers={"Content-Type": "application/json"}, 
-                    json=alt_payload, 
-                    timeout=60
-                )
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    if 'candidates' in result and result['candidates']:
-                        text = ""
-                        for part in result['candidates'][0]['content']['parts']:
-                            if 'text' in part:
-                                text += part['text']
-                        
-                        if text:
-                            if "gemini" not in text.lower() and "google" not in text.lower():
-                                text = "As Gemini, I've analyzed this image:\n\n" + text
-                            logger.info("✅ Gemini image analysis successful with alternative payload")
-                            return text
-                else:
-                    logger.warning(f"Alternative payload attempt failed with status {response.status_code}")
+            for model, payload_format in options:
+                text = self._request_vision(model, payload_format, prompt, image_base64)
+                if text:
+                    # Ensure response identifies as Gemini
+                    if "gemini" not in text.lower() and "google" not in text.lower():
+                        text = f"As Gemini, I've analyzed this image:\n\n{text}"
                     
-            except Exception as e:
-                logger.error(f"Alternative payload approach failed: {str(e)}")
+                    logger.info(f"Successfully analyzed image with {model} ({payload_format} format)")
+                    capability_registry.confirm("gemini", "vision", model, payload_format)
+                    return text
             
             # If all attempts fail, return a helpful message
             logger.error("All Gemini vision models failed to analyze the image")
-            return "As Gemini, I can see you've shared an image, but I'm having technical difficulties analyzing it in detail. The image analysis service is currently experiencing issues. I can still help with text-based questions though!"
+            return AnalysisFailure("As Gemini, I can see you've shared an image, but I'm having technical difficulties analyzing it in detail. The image analysis service is currently experiencing issues. I can still help with text-based questions though!")
                 
         except Exception as e:
             logger.error(f"Gemini image analysis error: {str(e)}")
             logger.error(traceback.format_exc())
-            return "As Gemini, I can see this is an image, but I couldn't analyze it in detail due to a technical issue. Our image analysis service is having temporary problems."
+            return AnalysisFailure("As Gemini, I can see this is an image, but I couldn't analyze it in detail due to a technical issue. Our image analysis service is having temporary problems.")
+    
+    def _vision_payload(self, model, payload_format, prompt, image_base64):
+        """Build the generateContent payload for one vision option"""
+        parts = [
+            {"text": prompt},
+            {
+                "inline_data": {
+                    "mime_type": "image/jpeg",
+                    "data": image_base64
+                }
+            }
+        ]
+        if payload_format == "role":
+            return {
+                "contents": [{"role": "user", "parts": parts}],
+                "generationConfig": {
+                    "temperature": 0.2,
+                    "maxOutputTokens": 1024
+                }
+            }
+        if "1.5" in model:
+            # Format for newer 1.5 models
+            return {
+                "contents": [{"parts": parts}],
+                "generationConfig": {
+                    "temperature": 0.3,
+                    "topK": 32,
+                    "topP": 1,
+                    "maxOutputTokens": 1024
+                }
+            }
+        # Format for older models
+        return {
+            "contents": [{"parts": parts}],
+            "generationConfig": {
+                "temperature": 0.4,
+                "maxOutputTokens": 800
+            }
+        }
+    
+    def _request_vision(self, model, payload_format, prompt, image_base64):
+        """Send one vision request and return the text, or None if it did not work"""
+        try:
+            logger.info(f"Attempting image analysis with {model} ({payload_format} format)")
+            url = f"https://generativelanguage.googleapis.com/{self.api_version}/models/{model}:generateContent?key={self.api_key}"
+            payload = self._vision_payload(model, payload_format, prompt, image_base64)
+            
+            # Make the API call with extended timeout
+            response = self.session.post(url, headers={"Content-Type": "application/json"}, json=payload, timeout=60 if payload_format == "role" else 45)
+            
+            if response.status_code != 200:
+                logger.warning(f"{model} returned status {response.status_code}")
+                try:
+                    logger.warning(f"Error details: {json.dumps(response.json())}")
+                except:
+                    logger.warning(f"Raw error response: {response.text[:200]}")
+                return None
+            
+            text = self._extract_text(response.json())
+            if not text:
+                logger.warning(f"Empty text response from {model}")
+            return text or None
+        except Exception as e:
+            logger.error(f"Error with {model}: {str(e)}")
+            return None
+    
+    def _discover_vision_option(self):
+        """Return the first vision option that works on a tiny probe image (used for re-validation)"""
+        from PIL import Image
+        buffer = BytesIO()
+        Image.new("RGB", (8, 8), (200, 30, 30)).save(buffer, "JPEG")
+        probe_image = base64.b64encode(buffer.getvalue()).decode('utf-8')
+        
+        for model, payload_format in GEMINI_VISION_OPTIONS:
+            if self._request_vision(model, payload_format, "What colour is this image? Answer in one word.", probe_image):
+                return model, payload_format
+        return None
@@ -0,0 +1,146 @@
+"""
+Local verification of Google ID tokens against cached signing certificates
+
+google.oauth2.id_token.verify_oauth2_token fetches Google's certificates
+over a new connection on every call. Here they are kept in memory for as
+long as Google's Cache-Control allows, refreshed in the background before
+they expire over the pooled HTTP client, and tokens are checked locally,
+so a login costs one signature check. A token signed with a key id not in
+the cached set (Google rotated keys) triggers one refresh, rate-limited so
+forged key ids cannot cause a fetch per request.
+
+GOOGLE_CERTS_URL can point at a stand-in key server, e.g. in tests.
+"""
+import asyncio
+import base64
+import json
+import logging
+import re
+import time
+
+from google.auth import jwt as google_jwt
+
+from auth_pool import auth_pool
+from config import (
+    GOOGLE_CLIENT_ID, GOOGLE_CERTS_URL, GOOGLE_CERTS_DEFAULT_TTL, GOOGLE_CERTS_REFRESH_MARGIN,
+    GOOGLE_TOKEN_CLOCK_SKEW
+)
+from http_clients import get_async_client
+
+logger = logging.getLogger(__name__)
+
+GOOGLE_ISSUERS = ("accounts.google.com", "https://accounts.google.com")
+
+# Shortest gap between refreshes forced by an unknown key id
+MIN_FORCED_REFRESH_SECONDS = 30
+
+
+def certs_ttl(headers, default=GOOGLE_CERTS_DEFAULT_TTL):
+    """Seconds the response may be cached: Cache-Control max-age minus Age"""
+    match = re.search(r"max-age=(\d+)", headers.get("cache-control", ""))
+    if not match:
+        return default
+    age = headers.get("age", "0")
+    return max(int(match.group(1)) - (int(age) if age.isdigit() else 0), 0)
+
+
+def token_key_id(token):
+    """The key id ("kid") from a JWT's header, without verifying anything"""
+    try:
+        header = token.split(".")[0]
+        return json.loads(base64.urlsafe_b64decode(header + "=" * (-len(header) % 4))).get("kid")
+    except Exception:
+        raise ValueError("Malformed token")
+
+
+class GoogleTokenVerifier:
+    """Google certificate cache plus local ID-token verification"""
+
+    def __init__(self, client_id=GOOGLE_CLIENT_ID, certs_url=GOOGLE_CERTS_URL,
+                 refresh_margin=GOOGLE_CERTS_REFRESH_MARGIN, clock_skew=GOOGLE_TOKEN_CLOCK_SKEW):
+        self.client_id = client_id
+        self.certs_url = certs_url
+        self.refresh_margin = refresh_margin
+        self.clock_skew = clock_skew
+        self._certs = {}
+        self._expires_at = 0.0
+        self._last_refresh = 0.0
+        self._refreshing = None  # In-flight refresh task, shared by concurrent callers
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    async def verify(self, token):
+        """Return the token's claims, raising ValueError if it is not a valid Google ID token for this app"""
+        certs = await self.certs()
+        key_id = token_key_id(token)
+        if key_id not in certs and time.monotonic() - self._last_refresh > MIN_FORCED_REFRESH_SECONDS:
+            logger.info(f"Unknown Google key id {key_id}, refreshing certificates")
+            certs = await self.refresh()
+
+        idinfo = await auth_pool.run(
+            "google_verify",
+            google_jwt.decode,
+            token,
+            certs=certs,
+            audience=self.client_id,
+            clock_skew_in_seconds=self.clock_skew
+        )
+        if idinfo.get("iss") not in GOOGLE_ISSUERS:
+            raise ValueError(f"Wrong issuer: {idinfo.get('iss')}")
+        return idinfo
+
+    async def certs(self):
+        """The cached certificates, fetched first if missing or expired"""
+        if not self._certs or time.monotonic() >= self._expires_at:
+            return await self.refresh()
+        return self._certs
+
+    async def refresh(self):
+        task = self._refreshing
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            task = self._refreshing = asyncio.create_task(self._fetch())
+        return await asyncio.shield(task)
+
+    async def _fetch(self):
+        self._last_refresh = time.monotonic()
+        try:
+            response = await get_async_client("google_certs").get(self.certs_url)
+            response.raise_for_status()
+            certs = response.json()
+        except Exception as e:
+            self.refresh_errors += 1
+            logger.error(f"Fetching Google certificates failed: {str(e)}")
+            if self._certs:
+                # Keep verifying with the old set and retry shortly, not on every login
+                self._expires_at = time.monotonic() + MIN_FORCED_REFRESH_SECONDS
+                return self._certs
+            raise
+        ttl = certs_ttl(response.headers)
+        self._certs = certs
+        self._expires_at = time.monotonic() + ttl
+        self.refreshes += 1
+        logger.info(f"Loaded {len(certs)} Google signing certificates, cached for {ttl}s")
+        return certs
+
+    async def run_refresher(self):
+        """Keep the certificates fresh ahead of expiry forever (started from the app lifespan)"""
+        while True:
+            try:
+                if not self._certs or time.monotonic() >= self._expires_at - self.refresh_margin:
+                    await self.refresh()
+            except Exception as e:
+                logger.error(f"Error refreshing Google certificates: {str(e)}")
+            delay = self._expires_at - self.refresh_margin - time.monotonic()
+            await asyncio.sleep(min(max(delay, MIN_FORCED_REFRESH_SECONDS), GOOGLE_CERTS_DEFAULT_TTL))
+
+    def stats(self):
+        return {
+            "certificates": len(self._certs),
+            "expires_in": round(max(self._expires_at - time.monotonic(), 0.0), 1) if self._certs else 0.0,
+            "refreshes": self.refreshes,
+            "refresh_errors": self.refresh_errors
+        }
+
+
+# Shared instance used by the login routes
+google_verifier = GoogleTokenVerifier()
@@ -0,0 +1,169 @@
+"""
+Hedged provider requests
+
+The requested provider gets a head start. If it has not produced its first
+token by a deadline taken from its recent time-to-first-token percentile,
+the fallback provider is started concurrently. Whichever produces a first
+token first wins and the other request is cancelled. A provider that fails
+outright hands over to the next one immediately. Each provider's circuit
+breaker is consulted only when it is about to be started, so a half-open
+breaker's single trial is not spent on a fallback that never runs.
+Outcomes are reported to the breakers; cancelled losers count as neither.
+"""
+import asyncio
+import contextlib
+import logging
+import threading
+import time
+from collections import deque
+
+from circuit_breaker import circuit_breakers
+from config import (
+    HEDGING_ENABLED, HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES,
+    HEDGE_DEFAULT_DELAY, HEDGE_MIN_DELAY, HEDGE_MAX_DELAY
+)
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyTracker:
+    """Rolling window of time-to-first-token samples per provider"""
+
+    def __init__(self, window=200):
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, provider, seconds):
+        with self._lock:
+            self._samples.setdefault(provider, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, provider, fraction):
+        with self._lock:
+            samples = sorted(self._samples.get(provider, ()))
+        if not samples:
+            return None
+        index = min(int(fraction * len(samples)), len(samples) - 1)
+        return samples[index]
+
+    def sample_count(self, provider):
+        with self._lock:
+            return len(self._samples.get(provider, ()))
+
+    def hedge_deadline(self, provider):
+        """Seconds to wait for the provider's first token before hedging"""
+        if self.sample_count(provider) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        deadline = self.percentile(provider, HEDGE_PERCENTILE)
+        return min(max(deadline, HEDGE_MIN_DELAY), HEDGE_MAX_DELAY)
+
+
+# Shared tracker used by the chat routes
+latency_tracker = LatencyTracker()
+
+
+async def _first_chunk(stream):
+    async for text in stream:
+        if text:
+            return text
+    raise RuntimeError("Stream finished without any text")
+
+
+async def _replay(first, stream):
+    yield first
+    async for text in stream:
+        yield text
+
+
+class _Attempt:
+    """One in-flight provider stream, waiting for its first token"""
+
+    def __init__(self, provider, label, service, conversation_history):
+        self.provider = provider
+        self.label = label
+        self.stream = service.stream_response(conversation_history)
+        self.started = time.monotonic()
+        self.task = asyncio.create_task(_first_chunk(self.stream))
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    async def cancel(self):
+        self.task.cancel()
+        with contextlib.suppress(asyncio.CancelledError, Exception):
+            await self.task
+        with contextlib.suppress(Exception):
+            await self.stream.aclose()
+
+
+async def hedged_stream(candidates, conversation_history, tracker=latency_tracker):
+    """
+    Race provider streams for the first token
+    candidates is a list of (provider, service) pairs, requested provider
+    first. Returns (label, stream) where stream yields the winner's text
+    chunks, starting with the first one. The label is the provider name,
+    suffixed with "(hedged)" if it won a race it joined on the deadline or
+    "(fallback)" if it replaced a failed or open-circuit provider. Raises
+    RuntimeError if every provider is skipped or fails before producing text.
+    """
+    waiting = list(candidates)
+    pending = {}
+    errors = []
+
+    def launch(suffix=""):
+        """Start the next candidate whose circuit allows it, or return None"""
+        while waiting:
+            provider, service = waiting.pop(0)
+            if not circuit_breakers.allow_request(provider):
+                logger.warning(f"Skipping {provider}: circuit is open")
+                errors.append(f"{provider}: circuit open")
+                suffix = suffix or "fallback"
+                continue
+            label = f"{provider} ({suffix})" if suffix else provider
+            attempt = _Attempt(provider, label, service, conversation_history)
+            pending[attempt.task] = attempt
+            return attempt
+        return None
+
+    def next_deadline(attempt):
+        if not (HEDGING_ENABLED and waiting and attempt):
+            return None
+        return tracker.hedge_deadline(attempt.provider)
+
+    latest = launch()
+    timeout = next_deadline(latest)
+
+    while pending:
+        done, _ = await asyncio.wait(pending.keys(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+        if not done:
+            logger.info(f"No first token from {latest.label} after {timeout:.2f}s, hedging with {waiting[0][0]}")
+            latest = launch("hedged") or latest
+            timeout = next_deadline(latest)
+            continue
+
+        for task in done:
+            attempt = pending.pop(task)
+            if task.exception() is None:
+                tracker.record(attempt.provider, attempt.elapsed())
+                circuit_breakers.record_success(attempt.provider)
+                for loser in list(pending.values()):
+                    # The loser ran at least this long without a token
+                    tracker.record(loser.provider, loser.elapsed())
+                    logger.info(f"Cancelling {loser.label}, {attempt.label} answered first")
+                    await loser.cancel()
+                pending.clear()
+                logger.info(f"First token from {attempt.label} after {attempt.elapsed():.2f}s")
+                return attempt.label, _replay(task.result(), attempt.stream)
+
+            logger.warning(f"{attempt.label} failed before its first token: {str(task.exception())}")
+            errors.append(f"{attempt.label}: {task.exception()}")
+            circuit_breakers.record_failure(attempt.provider)
+            with contextlib.suppress(Exception):
+                await attempt.stream.aclose()
+
+        if not pending and waiting:
+            latest = launch("fallback") or latest
+            timeout = next_deadline(latest)
+
+    raise RuntimeError("All providers failed: " + "; ".join(errors))
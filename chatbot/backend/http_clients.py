@@ -0,0 +1,87 @@
+"""
+Pooled async HTTP clients shared by the AI provider services
+"""
+import asyncio
+import logging
+import threading
+import weakref
+
+import httpx
+
+from config import PROVIDER_MAX_CONNECTIONS, PROVIDER_MAX_KEEPALIVE_CONNECTIONS, PROVIDER_KEEPALIVE_EXPIRY
+
+logger = logging.getLogger(__name__)
+
+# One set of clients per event loop - an httpx.AsyncClient must not be shared across loops
+_clients_by_loop = weakref.WeakKeyDictionary()
+
+# Background loop used to run async provider calls from synchronous code
+_sync_loop = None
+_sync_loop_lock = threading.Lock()
+
+
+def _build_client(name):
+    """Create a pooled async client for one provider"""
+    limits = httpx.Limits(
+        max_connections=PROVIDER_MAX_CONNECTIONS,
+        max_keepalive_connections=PROVIDER_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=PROVIDER_KEEPALIVE_EXPIRY
+    )
+    logger.info(f"Creating pooled HTTP client for {name} (max {PROVIDER_MAX_CONNECTIONS} connections)")
+    return httpx.AsyncClient(
+        limits=limits,
+        timeout=httpx.Timeout(30.0, connect=10.0),
+        headers={"Content-Type": "application/json"}
+    )
+
+
+def get_async_client(name):
+    """Return the pooled client for a provider, bound to the running event loop"""
+    loop = asyncio.get_running_loop()
+    clients = _clients_by_loop.setdefault(loop, {})
+
+    client = clients.get(name)
+    if client is None or client.is_closed:
+        client = _build_client(name)
+        clients[name] = client
+    return client
+
+
+async def close_async_clients():
+    """Close every client created on the running event loop"""
+    loop = asyncio.get_running_loop()
+    clients = _clients_by_loop.pop(loop, {})
+    for name, client in clients.items():
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.warning(f"Error closing HTTP client for {name}: {str(e)}")
+
+
+def _get_sync_loop():
+    """Start (once) the background loop that serves synchronous callers"""
+    global _sync_loop
+    with _sync_loop_lock:
+        if _sync_loop is None:
+            _sync_loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_sync_loop.run_forever, name="provider-sync-loop", daemon=True)
+            thread.start()
+        return _sync_loop
+
+
+def run_sync(coro):
+    """Run a provider coroutine to completion from synchronous code"""
+    future = asyncio.run_coroutine_threadsafe(coro, _get_sync_loop())
+    return future.result()
+
+
+async def iter_sse_data(response):
+    """Yield the data payload of each Server-Sent Event in a streaming response"""
+    async for line in response.aiter_lines():
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if data == "[DONE]":
+            break
+        if data:
+            yield data
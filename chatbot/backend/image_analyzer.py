@@ -1,17 +1,121 @@
+import asyncio
 import logging
 import base64
+import hashlib
 import io
 import requests
 import json
 import os
-from PIL import Image
+from PIL import Image, ImageOps
 import base64
 from io import BytesIO
 import numpy as np
 import traceback
+from alternatives import analysis_succeeded
+from content_cache import content_cache
 
 logger = logging.getLogger(__name__)
 
+# Largest side (pixels) and encoded size (bytes) of the JPEG sent to each provider.
+# Providers downscale big images themselves, so sending more only costs upload time.
+PROVIDER_IMAGE_LIMITS = {
+    "gemini": (2048, 4 * 1024 * 1024),
+    "openai": (2048, 4 * 1024 * 1024),
+    "claude": (1568, 4 * 1024 * 1024),
+    "vision": (1600, 4 * 1024 * 1024),
+}
+JPEG_QUALITY_STEPS = (85, 75, 65, 55, 45)
+
+
+def decode_image(image_data):
+    """Decode once, applying the EXIF orientation, or raise if the bytes are not an image"""
+    image = Image.open(BytesIO(image_data))
+    image.load()
+    ImageOps.exif_transpose(image, in_place=True)
+    return image
+
+
+def pixel_digest(image):
+    """SHA-256 of an orientation-corrected image's pixels"""
+    image = image.convert("RGBA")
+    hasher = hashlib.sha256(f"{image.width}x{image.height}:".encode("ascii"))
+    hasher.update(image.tobytes())
+    return hasher.hexdigest()
+
+
+def image_digest(image_data):
+    """SHA-256 of the decoded, orientation-corrected pixels, or None if the bytes are not an image
+    
+    Metadata-only differences and lossless re-encodes of a picture hash the same.
+    """
+    try:
+        return pixel_digest(decode_image(image_data))
+    except Exception:
+        return None
+
+
+class PreparedImage:
+    """An upload decoded once, re-encoded on demand to each provider's limits
+    
+    Alpha is flattened onto white and the output is a fresh JPEG, so EXIF and
+    other metadata (GPS position, thumbnails) never leave the server.
+    """
+    
+    def __init__(self, image_data):
+        self.original = image_data
+        image = decode_image(image_data)
+        self.format = image.format
+        self.width, self.height = image.size
+        self.digest = pixel_digest(image)
+        # The upload can go out untouched when it already is a JPEG with no metadata to strip
+        self._passthrough = image.format == "JPEG" and not any(key in image.info for key in ("exif", "xmp", "photoshop", "comment"))
+        if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.split()[3])
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+        self.image = image
+        self._encoded = {}
+    
+    def base64_for(self, provider):
+        """Base64 JPEG within the provider's dimension and byte budget"""
+        limits = PROVIDER_IMAGE_LIMITS.get(provider, PROVIDER_IMAGE_LIMITS["gemini"])
+        if limits not in self._encoded:
+            data = self._encode(*limits)
+            self._encoded[limits] = base64.b64encode(data).decode('utf-8')
+        return self._encoded[limits]
+    
+    def _encode(self, max_dimension, max_bytes):
+        if self._passthrough and max(self.width, self.height) <= max_dimension and len(self.original) <= max_bytes:
+            return self.original
+        
+        dimension = min(max_dimension, max(self.width, self.height))
+        while True:
+            image = self.image
+            if max(image.size) > dimension:
+                image = image.copy()
+                image.thumbnail((dimension, dimension), Image.Resampling.LANCZOS)
+            for quality in JPEG_QUALITY_STEPS:
+                output = BytesIO()
+                image.save(output, format="JPEG", quality=quality, optimize=True)
+                if output.tell() <= max_bytes:
+                    break
+            # Smallest quality still over budget: shrink the picture and try again
+            if output.tell() <= max_bytes or dimension <= 256:
+                break
+            dimension = int(dimension * 0.75)
+        
+        logger.info(f"Prepared image {self.width}x{self.height} {len(self.original) / 1024:.1f}KB -> "
+                    f"{image.width}x{image.height} JPEG q{quality} {output.tell() / 1024:.1f}KB")
+        return output.getvalue()
+
+
+def prepare_image(image_data):
+    return PreparedImage(image_data)
+
+
 class ImageAnalyzer:
     """Handles image analysis using multiple methods with fallbacks"""
     
@@ -23,25 +127,30 @@ class ImageAnalyzer:
     async def analyze_image(self, image_data, preferred_model="gemini"):
         """
         Analyze image using available services with fallbacks
-        Returns a standardized analysis result
+        Returns a standardized analysis result (the per-provider encodings
+        are made only for the providers actually called)
         """
         try:
             # Validate image data
             if not image_data:
                 logger.error("Empty image data received")
-                return "", {"error": "No image data provided"}
+                return {"error": "No image data provided"}
                 
-            # Convert to PIL Image to validate and get basic info
+            # Decode once; each provider gets a downscaled, metadata-free JPEG within its budget
             try:
-                image = Image.open(BytesIO(image_data))
-                width, height = image.size
-                format_name = image.format
+                prepared = await asyncio.to_thread(prepare_image, image_data)
+                width, height = prepared.width, prepared.height
+                format_name = prepared.format
             except Exception as e:
                 logger.error(f"Invalid image format: {str(e)}")
-                return "", {"error": "Invalid image format", "description": str(e)}
+                return {"error": "Invalid image format", "description": str(e)}
             
-            # Get base64 encoding for APIs
-            image_base64 = base64.b64encode(image_data).decode('utf-8')
+            # The same picture analyzed before comes back from the store with no upstream calls
+            digest = prepared.digest
+            cached_analysis = await asyncio.to_thread(content_cache.get, "image_analysis", digest, preferred_model)
+            if cached_analysis is not None:
+                logger.info(f"Using stored {preferred_model} analysis for image {digest[:12]}")
+                return cached_analysis
             
             # Default analysis structure
             analysis = {
@@ -61,16 +170,18 @@ class ImageAnalyzer:
             
             # Set success flag
             successful = False
+            served_by = None
             
             # Try the preferred model first
             if preferred_model == "gemini" and self.gemini_service:
                 try:
                     logger.info("Using Gemini for image analysis")
-                    description = self.gemini_service.analyze_image(image_base64)
-                    if description and not description.startswith("As Gemini, I couldn't analyze"):
+                    description = await asyncio.to_thread(self.gemini_service.analyze_image, await self._encode_for(prepared, "gemini"))
+                    if analysis_succeeded(description):
                         analysis["description"] = description
                         analysis["labels"] = self._extract_labels_from_description(description)
                         successful = True
+                        served_by = "gemini"
                         logger.info("Gemini image analysis successful")
                     else:
                         logger.warning("Gemini returned error response")
@@ -80,11 +191,15 @@ class ImageAnalyzer:
             elif preferred_model == "openai" and self.openai_service:
                 try:
                     logger.info("Using OpenAI for image analysis")
-                    description = self.openai_service.analyze_image(image_base64)
-                    analysis["description"] = description
-                    analysis["labels"] = self._extract_labels_from_description(description)
-                    successful = True
-                    logger.info("OpenAI image analysis successful")
+                    description = await asyncio.to_thread(self.openai_service.analyze_image, await self._encode_for(prepared, "openai"))
+                    if analysis_succeeded(description):
+                        analysis["description"] = description
+                        analysis["labels"] = self._extract_labels_from_description(description)
+                        successful = True
+                        served_by = "openai"
+                        logger.info("OpenAI image analysis successful")
+                    else:
+                        logger.warning("OpenAI returned error response")
                 except Exception as e:
                     logger.warning(f"OpenAI image analysis failed: {str(e)}")
             
@@ -92,11 +207,12 @@ class ImageAnalyzer:
             if not successful and self.vision_api_key:
                 try:
                     logger.info("Trying Google Vision API")
-                    vision_analysis = await self._analyze_with_vision_api(image_base64)
+                    vision_analysis = await self._analyze_with_vision_api(await self._encode_for(prepared, "vision"))
                     if vision_analysis:
                         analysis.update(vision_analysis)
                         analysis["description"] = self._generate_description(analysis)
                         successful = True
+                        served_by = "vision"
                         logger.info("Google Vision API analysis successful")
                 except Exception as e:
                     logger.warning(f"Google Vision API failed: {str(e)}")
@@ -106,42 +222,55 @@ class ImageAnalyzer:
                 if preferred_model != "openai" and self.openai_service:
                     try:
                         logger.info("Trying OpenAI as fallback")
-                        description = self.openai_service.analyze_image(image_base64)
-                        analysis["description"] = description
-                        analysis["labels"] = self._extract_labels_from_description(description)
-                        successful = True
-                        logger.info("OpenAI fallback successful")
+                        description = await asyncio.to_thread(self.openai_service.analyze_image, await self._encode_for(prepared, "openai"))
+                        if analysis_succeeded(description):
+                            analysis["description"] = description
+                            analysis["labels"] = self._extract_labels_from_description(description)
+                            successful = True
+                            served_by = "openai"
+                            logger.info("OpenAI fallback successful")
                     except Exception as e:
                         logger.warning(f"OpenAI fallback failed: {str(e)}")
                 
                 if not successful and preferred_model != "gemini" and self.gemini_service:
                     try:
                         logger.info("Trying Gemini as fallback")
-                        description = self.gemini_service.analyze_image(image_base64)
-                        if description and not description.startswith("As Gemini, I couldn't analyze"):
+                        description = await asyncio.to_thread(self.gemini_service.analyze_image, await self._encode_for(prepared, "gemini"))
+                        if analysis_succeeded(description):
                             analysis["description"] = description
                             analysis["labels"] = self._extract_labels_from_description(description)
                             successful = True
+                            served_by = "gemini"
                             logger.info("Gemini fallback successful")
                     except Exception as e:
                         logger.warning(f"Gemini fallback failed: {str(e)}")
             
+            # Keep only the preferred model's own analyses; a fallback's answer or the
+            # basic fallback below is worth retrying with that model next time
+            if served_by == preferred_model:
+                await asyncio.to_thread(content_cache.put, "image_analysis", digest, preferred_model, analysis)
+            
             # Basic fallback if everything else fails
             if not successful:
                 logger.warning("All image analysis methods failed, using basic fallback")
                 analysis["description"] = f"An image of format {format_name}, dimensions {width}x{height}. I couldn't analyze it in detail."
                 analysis["labels"] = ["image"]
+                analysis["fallback"] = True
                 
                 # Add details about the format as detection
                 if format_name:
                     analysis["labels"].append(format_name.lower())
             
-            return image_base64, analysis
+            return analysis
             
         except Exception as e:
             logger.error(f"Image analysis failed: {str(e)}")
             logger.error(traceback.format_exc())
-            return "", {"error": "Failed to analyze image", "description": str(e)}
+            return {"error": "Failed to analyze image", "description": str(e)}
+    
+    async def _encode_for(self, prepared, provider):
+        """Resizing and JPEG encoding are CPU-bound, so keep them off the event loop"""
+        return await asyncio.to_thread(prepared.base64_for, provider)
     
     async def _analyze_with_vision_api(self, image_base64):
         """Direct HTTP request to Vision API without using client library"""
@@ -170,7 +299,8 @@ class ImageAnalyzer:
         headers = {"Content-Type": "application/json"}
         
         try:
-            response = requests.post(url, headers=headers, json=payload, timeout=10)
+            # requests blocks, so the call runs in a worker thread
+            response = await asyncio.to_thread(requests.post, url, headers=headers, json=payload, timeout=10)
             response.raise_for_status()
             result = response.json()
             
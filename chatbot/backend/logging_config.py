@@ -1,48 +1,167 @@
+"""
+Logging pipeline: handlers run on a background thread behind a queue
+
+Request code only appends the record to a queue (QueueHandler); merging
+the message arguments, JSON formatting and the console/file writes happen
+on the QueueListener thread, so a slow disk never blocks a request.
+Records below WARNING can be sampled per call site (LOG_SAMPLE_RATE),
+levels are set per logger from LOG_LEVEL/LOG_LEVELS, and prompt/payload
+dumps are skipped unless payload logging is switched on (LOG_PAYLOADS, or
+SIGUSR1 at runtime).
+"""
+import atexit
+import json
 import logging
-import sys
 import os
+import queue
+import signal
+import sys
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from config import LOG_LEVEL, LOG_LEVELS, LOG_FORMAT, LOG_SAMPLE_RATE, LOG_DIR, LOG_PAYLOADS
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Attributes every LogRecord has; anything else was passed with extra= and goes into the JSON
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "color_message"}
+
+_listener = None
+_payload_logging = LOG_PAYLOADS
+
+
+def payload_logging_enabled():
+    """Whether full prompts and request payloads may be logged (checked before building them)"""
+    return _payload_logging
+
+
+def log_payload(logger, label, payload, limit=500):
+    """Log (part of) a prompt or request payload if payload logging is on; nothing is serialized otherwise"""
+    if _payload_logging:
+        logger.info(f"{label}: {json.dumps(payload, ensure_ascii=False, default=str)[:limit]}")
+
+
+def set_payload_logging(enabled):
+    global _payload_logging
+    _payload_logging = enabled
+    logging.getLogger(__name__).warning(f"Payload logging {'enabled' if enabled else 'disabled'}")
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep every WARNING and above, and 1 in n of the records below it from each call site"""
+
+    def __init__(self, rate=LOG_SAMPLE_RATE):
+        super().__init__()
+        self.every = max(int(round(1 / rate)), 1) if rate > 0 else 0
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.every == 1:
+            return True
+        if self.every == 0:
+            return False
+        site = (record.name, record.lineno)
+        with self._lock:
+            count = self._counts.get(site, 0)
+            self._counts[site] = count + 1
+        return count % self.every == 0
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Enqueue records as they are; the listener formats them
+
+    The stock QueueHandler formats in the calling thread so the record can
+    be pickled; this queue never leaves the process, so that work is
+    deferred. The message arguments are still resolved on the listener
+    thread, which is fine for the immutable values logged here.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def parse_levels(spec):
+    """"name=LEVEL,name=LEVEL" -> {name: LEVEL}"""
+    levels = {}
+    for item in spec.split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
 
 def setup_logging():
-    """Configure detailed logging for better troubleshooting"""
-    
-    # Create logs directory if it doesn't exist
-    if not os.path.exists("logs"):
-        os.makedirs("logs")
-        
-    # Configure root logger
-    logging.basicConfig(
-        level=logging.DEBUG,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            # Console handler with color formatting for development
-            logging.StreamHandler(sys.stdout),
-            # File handler for persistent logs
-            logging.FileHandler("logs/app.log")
-        ]
-    )
-    
-    # Set specific loggers to more appropriate levels
-    logging.getLogger("uvicorn.access").setLevel(logging.INFO)
-    logging.getLogger("uvicorn.error").setLevel(logging.INFO)
-    logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
-    
-    # Create a specific logger for API calls that will show in console
-    api_logger = logging.getLogger("api.calls")
-    api_logger.setLevel(logging.INFO)
-    
-    # Add a file handler specifically for model API calls for debugging
-    model_api_handler = logging.FileHandler("logs/model_api_calls.log")
-    model_api_handler.setFormatter(logging.Formatter(
-        '%(asctime)s - %(levelname)s - MODEL: %(message)s'
-    ))
-    
-    model_logger = logging.getLogger("model.api")
-    model_logger.setLevel(logging.DEBUG)
-    model_logger.addHandler(model_api_handler)
-    
-    # Return the configured loggers
+    """Route all logging through a queue to console and file handlers on a background thread"""
+    global _listener
+    if _listener is not None:
+        return _loggers()
+
+    os.makedirs(LOG_DIR, exist_ok=True)
+    formatter = JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT)
+
+    console_handler = logging.StreamHandler(sys.stdout)
+    file_handler = logging.FileHandler(os.path.join(LOG_DIR, "app.log"))
+    # Model API calls also get their own file
+    model_api_handler = logging.FileHandler(os.path.join(LOG_DIR, "model_api_calls.log"))
+    model_api_handler.addFilter(logging.Filter("model.api"))
+    for handler in (console_handler, file_handler, model_api_handler):
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+
+    # Replace whatever handlers an earlier basicConfig installed
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+    for name, level in parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = QueueListener(log_queue, console_handler, file_handler, model_api_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+    # kill -USR1 <pid> flips payload logging without a restart
+    if hasattr(signal, "SIGUSR1") and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR1, lambda *_: set_payload_logging(not _payload_logging))
+
+    return _loggers()
+
+
+def stop_logging():
+    """Flush the queue and stop the listener thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _loggers():
     return {
         "main": logging.getLogger("app"),
-        "api": api_logger,
-        "model": model_logger
+        "api": logging.getLogger("api.calls"),
+        "model": logging.getLogger("model.api")
     }
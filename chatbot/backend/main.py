@@ -1,11 +1,16 @@
 from fastapi import FastAPI, Depends, HTTPException, Request, File, UploadFile
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
-from sqlalchemy.exc import SQLAlchemyError
-from database import SessionLocal, engine, Base
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from database import get_async_db
 from models import User, Message, ChatThread
-from auth import router as auth_router
+from auth import router as auth_router, check_password, verify_google_token, get_current_user
+from schemas import Principal
+from principal_cache import principal_cache
+from auth_pool import auth_pool
+from google_verifier import google_verifier
 import openai
 from datetime import timedelta, datetime
 from jose import JWTError, jwt
@@ -13,17 +18,21 @@ from passlib.context import CryptContext
 from pydantic import BaseModel
 import logging
 import os
-from openai_service import OpenAIService
-from gemini_service import GeminiService
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 import traceback
-from chat_endpoint import app as chat_app
-from google.oauth2 import id_token
-from google.auth.transport import requests
+from chat_endpoint import app as chat_app, get_stats
+from metrics import metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
 import base64
 from PIL import Image
 import io
-from image_analyzer import ImageAnalyzer
+from http_clients import close_async_clients
+from circuit_breaker import circuit_breakers
+from providers import providers
+from attachment_store import attachment_store
+from config import PROVIDER_WARMUP_ENABLED, DB_AUTO_MIGRATE
+from db_migrations import upgrade_database
+import asyncio
+from contextlib import asynccontextmanager
 
 
 from dotenv import load_dotenv
@@ -40,18 +49,33 @@ logger = loggers["main"]
 model_logger = loggers["model"]
 
 logger.info("Starting application with enhanced logging")
-
-# Configure logging with more detail
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
-# Create database tables
-Base.metadata.create_all(bind=engine)
-
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create or upgrade the database schema before serving requests
+    if DB_AUTO_MIGRATE:
+        await asyncio.to_thread(upgrade_database)
+    # Test provider connections concurrently without holding up startup
+    warm_up_task = asyncio.create_task(providers.warm_up()) if PROVIDER_WARMUP_ENABLED else None
+    # Probe providers whose circuit is open in the background
+    probe_task = asyncio.create_task(circuit_breakers.run_probes())
+    # Remove attachments nobody has used for the retention period
+    sweep_task = asyncio.create_task(attachment_store.run_sweeper())
+    # Keep Google's signing certificates loaded so logins verify locally
+    certs_task = asyncio.create_task(google_verifier.run_refresher()) if GOOGLE_CLIENT_ID else None
+    yield
+    probe_task.cancel()
+    sweep_task.cancel()
+    if certs_task:
+        certs_task.cancel()
+    if warm_up_task:
+        warm_up_task.cancel()
+    # Release pooled provider connections on shutdown
+    await close_async_clients()
+    auth_pool.shutdown()
+
+app = FastAPI(lifespan=lifespan)
 
 # Include the chat endpoint with explicit prefix
 app.mount("/chat_api", chat_app)
@@ -69,7 +93,7 @@ GOOGLE_CLIENT_SECRET=os.getenv("GOOGLE_CLIENT_SECRET")
 # Environment variables
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
-ACCESS_TOKEN_EXPIRE_MINUTES = os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES")
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES") or 15)
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -77,21 +101,10 @@ pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 os.environ["OPENAI_API_KEY"] = OPENAI_API_KEY
 openai.api_key = OPENAI_API_KEY
 
-# Initialize OpenAI service
-openai_service = OpenAIService(OPENAI_API_KEY)
-
-# Initialize Gemini service
-gemini_service = GeminiService(os.environ.get("GEMINI_API_KEY"))
-
 # Set default image analysis model to Gemini
 os.environ["PREFERRED_IMAGE_MODEL"] = "gemini"
 
-# Initialize our own ImageAnalyzer with both services
-image_analyzer = ImageAnalyzer(
-    openai_service=openai_service,
-    gemini_service=gemini_service,
-    vision_api_key=os.environ.get("GOOGLE_VISION_API_KEY")
-)
+# AI services and the ImageAnalyzer are built lazily by the provider registry
 
 # Request models
 class MessageRequest(BaseModel):
@@ -128,18 +141,14 @@ app.add_middleware(
 # Middleware to log all requests for debugging
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
+    # Nothing is formatted unless DEBUG is enabled for this logger
+    if not logger.isEnabledFor(logging.DEBUG):
+        return await call_next(request)
     logger.debug(f"Incoming request: {request.method} {request.url}")
     response = await call_next(request)
     logger.debug(f"Response status: {response.status_code}")
     return response
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
@@ -161,30 +170,27 @@ async def root():
     return {"message": "Welcome to the ChatBot API"}
 
 @app.post("/token")
-async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
     try:
-        user = db.query(User).filter(User.email == form_data.username).first()
-        if not user or not verify_password(form_data.password, user.hashed_password):
+        user = (await db.execute(select(User).where(User.email == form_data.username))).scalars().first()
+        if not user or not await check_password(form_data.password, user.hashed_password):
             raise HTTPException(status_code=400, detail="Incorrect email or password")
         access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
         access_token = create_access_token(data={"sub": user.email}, expires_delta=access_token_expires)
         return {"access_token": access_token, "token_type": "bearer"}
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logger.error(f"Login error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Login error: {str(e)}")
 
 @app.post("/google-login", response_model=dict)
-async def google_login(request: GoogleLoginRequest, db: Session = Depends(get_db)):
+async def google_login(request: GoogleLoginRequest, db: AsyncSession = Depends(get_async_db)):
     try:
         logger.debug(f"Received Google login request")
         
-        # Add clock skew parameter to handle time synchronization issues
-        idinfo = id_token.verify_oauth2_token(
-            request.token,
-            requests.Request(),
-            GOOGLE_CLIENT_ID,
-            clock_skew_in_seconds=10  # Allow 10 seconds of clock skew
-        )
+        # Verified locally against the cached Google certificates, allowing some clock skew
+        idinfo = await verify_google_token(request.token)
         
         # Log token info for debugging (excluding sensitive data)
         logger.debug(f"Token verified. Subject: {idinfo.get('sub')}, Issuer: {idinfo.get('iss')}")
@@ -203,7 +209,7 @@ async def google_login(request: GoogleLoginRequest, db: Session = Depends(get_db
         given_name = idinfo.get('given_name', '')
         
         # Find or create user
-        user = db.query(User).filter(User.email == email).first()
+        user = (await db.execute(select(User).where(User.email == email))).scalars().first()
         if not user:
             # Create minimal user - don't include display_name if it's not in the model
             try:
@@ -219,19 +225,25 @@ async def google_login(request: GoogleLoginRequest, db: Session = Depends(get_db
                     logger.info("User model doesn't have display_name attribute, skipping")
                 
                 db.add(user)
-                db.commit()
-                db.refresh(user)
+                await db.commit()
+                await db.refresh(user)
                 logger.debug(f"Created new user: {user.email}")
+            except IntegrityError:
+                # A concurrent first login for the same account created the user first
+                await db.rollback()
+                user = (await db.execute(select(User).where(User.email == email))).scalars().first()
             except Exception as e:
                 logger.error(f"Error creating user: {str(e)}")
                 raise
         elif hasattr(user, 'login_method') and user.login_method != 'google':
             # Update login method for existing users if the field exists
             user.login_method = 'google'
-            db.commit()
+            await db.commit()
+            await db.refresh(user)
+            principal_cache.invalidate_user(user.id)
 
         # Create access token
-        access_token_expires = timedelta(minutes=int(ACCESS_TOKEN_EXPIRE_MINUTES or 15))
+        access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
         access_token = create_access_token(
             data={"sub": user.email, "login_method": "google" if hasattr(user, 'login_method') else None},
             expires_delta=access_token_expires
@@ -252,6 +264,8 @@ async def google_login(request: GoogleLoginRequest, db: Session = Depends(get_db
             "email": user.email,
             "login_method": login_method
         }
+    except HTTPException as he:
+        raise he
     except ValueError as e:
         error_msg = str(e)
         logger.error(f"Google login validation error: {error_msg}")
@@ -262,24 +276,17 @@ async def google_login(request: GoogleLoginRequest, db: Session = Depends(get_db
         raise HTTPException(status_code=500, detail="Internal server error during authentication")
 
 @app.get("/users/me")
-async def read_users_me(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    if token is None:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email = payload.get("sub")
-        if email is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        user = db.query(User).filter(User.email == email).first()
-        if user is None:
-            raise HTTPException(status_code=404, detail="User not found")
-        return {
-            "id": user.id,
-            "email": user.email,
-            "username": user.username
-        }
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
+async def read_users_me(user: Principal = Depends(get_current_user)):
+    return {
+        "id": user.id,
+        "email": user.email,
+        "username": user.username
+    }
+
+@app.get("/metrics")
+def get_metrics():
+    """Provider latency, token and fallback metrics plus the runtime stats, for Prometheus to scrape"""
+    return Response(metrics.render(get_stats()), media_type=METRICS_CONTENT_TYPE)
 
 @app.post("/debug-google-login")
 async def debug_google_login(request: GoogleLoginRequest):
@@ -296,9 +303,9 @@ async def api_test():
             {"path": "/chat_api/analyze_image/", "method": "POST", "description": "Analyze image"}
         ],
         "services": {
-            "openai": openai_service is not None,
-            "gemini": gemini_service is not None,
-            "image_analyzer": image_analyzer is not None 
+            "openai": providers.is_available("openai"),
+            "gemini": providers.is_available("gemini"),
+            "image_analyzer": providers.is_available("openai") and providers.is_available("gemini")
         }
     }
 
@@ -0,0 +1,171 @@
+"""
+Full-text search over message content
+
+SQLite uses an external-content FTS5 table (messages_fts) that triggers on
+messages keep in sync. It also indexes an owner token per message, so the
+MATCH itself is restricted to one user's messages and its cost follows the
+size of that user's history rather than the whole table. MySQL uses a
+FULLTEXT index on messages.content, which InnoDB maintains itself; the
+match is ranked inside a derived table already limited to the user's
+threads, and terms shorter than the server's minimum token size (which
+the index never holds) are matched with LIKE instead. Both structures are
+created by migration 0004. Other databases fall back to a LIKE scan,
+which is correct but not fast.
+
+Results are ranked (bm25 on SQLite, MATCH relevance on MySQL) and carry a
+snippet with the matched terms wrapped in SNIPPET_MARKS.
+"""
+import logging
+import re
+
+from sqlalchemy import text, DateTime, Float
+
+from database import engine
+
+logger = logging.getLogger(__name__)
+
+# Search structures created by migration 0004 rather than the models
+FTS_TABLE = "messages_fts"
+FULLTEXT_INDEX = "ft_messages_content"
+
+SNIPPET_MARKS = ("<mark>", "</mark>")
+SNIPPET_TOKENS = 12  # Words of context FTS5 keeps around a match
+SNIPPET_CHARS = 80  # Characters of context kept around a match elsewhere
+
+MAX_QUERY_TERMS = 8
+
+SQLITE_SEARCH = text(f"""
+    SELECT m.id AS message_id, m.thread_id, t.title AS thread_title, m.sender AS role, m.created_at,
+           snippet({FTS_TABLE}, 0, :mark_open, :mark_close, '…', :snippet_tokens) AS snippet,
+           bm25({FTS_TABLE}, 1.0, 0.0) AS score
+    FROM {FTS_TABLE}
+    JOIN messages m ON m.id = {FTS_TABLE}.rowid
+    JOIN chat_threads t ON t.id = m.thread_id
+    WHERE {FTS_TABLE} MATCH :query AND t.user_id = :user_id AND t.is_deleted = 0
+    ORDER BY score
+    LIMIT :limit
+""").columns(created_at=DateTime, score=Float)
+
+# The user filter sits inside the ranked subquery, so only their messages are scored and limited
+MYSQL_SEARCH = """
+    SELECT ranked.message_id, ranked.thread_id, t.title AS thread_title, ranked.role, ranked.created_at,
+           ranked.content, ranked.score
+    FROM (
+        SELECT m.id AS message_id, m.thread_id, m.sender AS role, m.created_at, m.content, {score} AS score
+        FROM messages m
+        WHERE m.thread_id IN (SELECT id FROM chat_threads WHERE user_id = :user_id AND is_deleted = 0)
+          AND {conditions}
+        ORDER BY score DESC, m.id DESC
+        LIMIT :limit
+    ) ranked
+    JOIN chat_threads t ON t.id = ranked.thread_id
+    ORDER BY ranked.score DESC, ranked.message_id DESC
+"""
+MYSQL_MATCH = "MATCH(m.content) AGAINST (:query IN BOOLEAN MODE)"
+
+FALLBACK_SEARCH = """
+    SELECT m.id AS message_id, m.thread_id, t.title AS thread_title, m.sender AS role, m.created_at,
+           m.content, 0.0 AS score
+    FROM messages m
+    JOIN chat_threads t ON t.id = m.thread_id
+    WHERE t.user_id = :user_id AND t.is_deleted = false AND {conditions}
+    ORDER BY m.id DESC
+    LIMIT :limit
+"""
+
+# InnoDB's default innodb_ft_min_token_size, used if the server cannot be asked
+DEFAULT_MIN_TOKEN_SIZE = 3
+_mysql_min_token_size = None
+
+
+def query_terms(query):
+    """Split a user query into plain word terms, dropping search syntax characters"""
+    return re.findall(r"\w+", query.lower())[:MAX_QUERY_TERMS]
+
+
+def fts5_query(user_id, terms):
+    """All terms must match, the last one as a prefix so results update while typing"""
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += "*"
+    return f"owner:u{int(user_id)} AND content:({' '.join(quoted)})"
+
+
+def mysql_boolean_query(terms):
+    return " ".join(f"+{term}*" for term in terms)
+
+
+def like_conditions(terms):
+    """One LIKE per term, all required; '_' in a term is matched literally"""
+    conditions = [f"lower(m.content) LIKE :term{index} ESCAPE '!'" for index in range(len(terms))]
+    params = {f"term{index}": f"%{term.replace('_', '!_')}%" for index, term in enumerate(terms)}
+    return " AND ".join(conditions), params
+
+
+def mysql_search(terms, min_token_size):
+    """The MySQL statement and parameters: MATCH for indexable terms, LIKE for shorter ones"""
+    indexed = [term for term in terms if len(term) >= min_token_size]
+    short = [term for term in terms if len(term) < min_token_size]
+    conditions, params = like_conditions(short) if short else ("", {})
+    if indexed:
+        conditions = " AND ".join(filter(None, [MYSQL_MATCH, conditions]))
+        params["query"] = mysql_boolean_query(indexed)
+    statement = MYSQL_SEARCH.format(score=MYSQL_MATCH if indexed else "0.0", conditions=conditions)
+    return text(statement).columns(created_at=DateTime, score=Float), params
+
+
+async def mysql_min_token_size(db):
+    """The server's full-text minimum token size, read once per process"""
+    global _mysql_min_token_size
+    if _mysql_min_token_size is None:
+        try:
+            _mysql_min_token_size = int((await db.execute(text("SELECT @@innodb_ft_min_token_size"))).scalar())
+        except Exception as e:
+            logger.warning(f"Could not read innodb_ft_min_token_size, assuming {DEFAULT_MIN_TOKEN_SIZE}: {str(e)}")
+            _mysql_min_token_size = DEFAULT_MIN_TOKEN_SIZE
+    return _mysql_min_token_size
+
+
+def make_snippet(content, terms):
+    """Excerpt around the first matched term, with every term occurrence marked"""
+    content = content or ""
+    pattern = re.compile("|".join(re.escape(term) for term in terms), re.IGNORECASE)
+    match = pattern.search(content)
+    start = max(match.start() - SNIPPET_CHARS, 0) if match else 0
+    end = min((match.end() if match else 0) + SNIPPET_CHARS, len(content))
+    excerpt = pattern.sub(lambda found: f"{SNIPPET_MARKS[0]}{found.group(0)}{SNIPPET_MARKS[1]}", content[start:end])
+    return ("…" if start > 0 else "") + excerpt + ("…" if end < len(content) else "")
+
+
+async def search_messages(db, user_id, query, limit=20):
+    """Return a user's best matching messages as dicts, best first"""
+    terms = query_terms(query)
+    if not terms:
+        return []
+
+    dialect = engine.dialect.name
+    if dialect == "sqlite":
+        rows = (await db.execute(SQLITE_SEARCH, {
+            "query": fts5_query(user_id, terms),
+            "user_id": user_id,
+            "limit": limit,
+            "mark_open": SNIPPET_MARKS[0],
+            "mark_close": SNIPPET_MARKS[1],
+            "snippet_tokens": SNIPPET_TOKENS,
+        })).mappings().all()
+        # bm25 is lower-is-better; flip it so every backend ranks higher-is-better
+        return [dict(row, score=-row["score"]) for row in rows]
+
+    if dialect == "mysql":
+        statement, params = mysql_search(terms, await mysql_min_token_size(db))
+    else:
+        logger.warning(f"No full-text index for {dialect}, falling back to a LIKE scan")
+        conditions, params = like_conditions(terms)
+        statement = text(FALLBACK_SEARCH.format(conditions=conditions)).columns(created_at=DateTime, score=Float)
+
+    rows = (await db.execute(statement, dict(params, user_id=user_id, limit=limit))).mappings().all()
+    results = []
+    for row in rows:
+        result = dict(row)
+        result["snippet"] = make_snippet(result.pop("content"), terms)
+        results.append(result)
+    return results
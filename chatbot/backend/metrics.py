@@ -0,0 +1,265 @@
+"""
+In-process metrics in the Prometheus text exposition format
+
+Counters and histograms are kept per label set in this process and
+rendered by the /metrics route, followed by the /chat_api/stats/ values
+as gauges. Each provider request is timed with a ProviderCall, which
+records its latency, time to first token, tokens in and out and request
+and response bytes per provider and model.
+
+There is no prometheus_client dependency. With several worker processes
+each one reports its own values, so scrape them individually or sum
+across instances in the query.
+"""
+import asyncio
+import math
+import re
+import threading
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+FIRST_TOKEN_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536)
+BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+_INVALID_NAME_CHARS = re.compile(r"[^a-zA-Z0-9_]")
+
+
+def metric_name(*parts):
+    return _INVALID_NAME_CHARS.sub("_", "_".join(parts))
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in labels) + "}"
+
+
+class Counter:
+    """Monotonic count per label set"""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name, tuple(zip(self.labelnames, key)), value
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count per label set"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values = {}  # key -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * len(self.buckets) + [0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, list(entry)) for key, entry in self._values.items())
+        for key, entry in values:
+            labels = tuple(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets, entry):
+                yield f"{self.name}_bucket", labels + (("le", format_value(float(bound))),), count
+            yield f"{self.name}_sum", labels, entry[-2]
+            yield f"{self.name}_count", labels, entry[-1]
+
+
+def stats_gauges(prefix, stats, labels=()):
+    """
+    Flatten a stats() dict into (name, labels, value) gauge samples
+    Numbers (and booleans, as 0/1) become gauges named after their key path;
+    a string becomes a gauge of 1 labelled with its value (a circuit's
+    state); a dict of dicts is a set of named entries (circuit breakers,
+    auth pool operations) whose name becomes the "name" label.
+    """
+    for key, value in stats.items():
+        name = metric_name(prefix, key)
+        if isinstance(value, bool):
+            yield name, labels, int(value)
+        elif isinstance(value, (int, float)):
+            yield name, labels, value
+        elif isinstance(value, str):
+            yield name, labels + ((key, value),), 1
+        elif isinstance(value, dict) and value and all(isinstance(entry, dict) for entry in value.values()):
+            for entry_name, entry in value.items():
+                yield from stats_gauges(name, entry, labels + (("name", entry_name),))
+        elif isinstance(value, dict):
+            yield from stats_gauges(name, value, labels)
+
+
+class MetricsRegistry:
+    """The counters and histograms rendered by the /metrics route"""
+
+    def __init__(self, namespace="chatbot"):
+        self.namespace = namespace
+        self._metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(metric_name(self.namespace, name), documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(metric_name(self.namespace, name), documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self, stats=None):
+        """Every metric, then the stats dict (if given) as gauges, in the text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+
+        gauges = {}
+        for name, labels, value in stats_gauges(self.namespace, stats or {}):
+            gauges.setdefault(name, []).append((labels, value))
+        for name, samples in gauges.items():
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# Shared registry rendered by the /metrics route
+metrics = MetricsRegistry()
+
+provider_latency = metrics.histogram(
+    "provider_request_duration_seconds", "Time from sending a provider request to its last byte",
+    ("provider", "model", "outcome"), LATENCY_BUCKETS
+)
+provider_first_token = metrics.histogram(
+    "provider_time_to_first_token_seconds", "Time from sending a streaming request to its first text",
+    ("provider", "model"), FIRST_TOKEN_BUCKETS
+)
+provider_input_tokens = metrics.histogram(
+    "provider_input_tokens", "Prompt tokens per request, as reported by the provider",
+    ("provider", "model"), TOKEN_BUCKETS
+)
+provider_output_tokens = metrics.histogram(
+    "provider_output_tokens", "Completion tokens per request, as reported by the provider",
+    ("provider", "model"), TOKEN_BUCKETS
+)
+provider_request_bytes = metrics.histogram(
+    "provider_request_bytes", "Request body size per provider request",
+    ("provider", "model"), BYTE_BUCKETS
+)
+provider_response_bytes = metrics.histogram(
+    "provider_response_bytes", "Response body size per provider request (as downloaded)",
+    ("provider", "model"), BYTE_BUCKETS
+)
+fallbacks = metrics.counter(
+    "fallbacks_total", "Replies served by something other than the requested provider or model",
+    ("requested", "served", "kind")
+)
+error_fallback_replies = metrics.counter(
+    "error_fallback_replies_total", "Canned apology replies stored because no provider answered",
+    ("route",)
+)
+rule_based_replies = metrics.counter(
+    "rule_based_replies_total", "Replies generated by the rule-based fallback",
+    ("source",)
+)
+
+
+class ProviderCall:
+    """
+    Times one provider request and records it on exit
+    The outcome is "ok", "error" (an exception or an error status) or
+    "cancelled" (a stream closed early, e.g. a hedging loser).
+    """
+
+    def __init__(self, provider, model):
+        self.provider = provider
+        self.model = model
+        self.started = time.monotonic()
+        self.first_token_at = None
+        self.response = None
+        self.input_tokens = None
+        self.output_tokens = None
+
+    def record_response(self, response):
+        """Remember the httpx response, for its status and body sizes"""
+        self.response = response
+
+    def first_token(self):
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+
+    def usage(self, input_tokens=None, output_tokens=None):
+        """Token counts from the provider's usage report; later reports replace earlier ones"""
+        if input_tokens is not None:
+            self.input_tokens = input_tokens
+        if output_tokens is not None:
+            self.output_tokens = output_tokens
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            outcome = "error" if self.response is not None and self.response.is_error else "ok"
+        elif issubclass(exc_type, (GeneratorExit, asyncio.CancelledError)):
+            outcome = "cancelled"
+        else:
+            outcome = "error"
+
+        labels = {"provider": self.provider, "model": self.model}
+        provider_latency.observe(time.monotonic() - self.started, outcome=outcome, **labels)
+        if self.first_token_at is not None:
+            provider_first_token.observe(self.first_token_at - self.started, **labels)
+        if self.input_tokens is not None:
+            provider_input_tokens.observe(self.input_tokens, **labels)
+        if self.output_tokens is not None:
+            provider_output_tokens.observe(self.output_tokens, **labels)
+        if self.response is not None:
+            provider_request_bytes.observe(len(self.response.request.content), **labels)
+            provider_response_bytes.observe(self.response.num_bytes_downloaded, **labels)
+        return False
@@ -0,0 +1,58 @@
+"""Initial schema (users, chat_threads, messages) as created by create_all
+
+Databases created before migrations existed are stamped at this revision
+instead of running it (see db_migrations.upgrade_database).
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "users",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("email", sa.String(255)),
+        sa.Column("username", sa.String(255)),
+        sa.Column("hashed_password", sa.String(255), nullable=True),
+        sa.Column("login_method", sa.String(255)),
+    )
+    op.create_index("ix_users_id", "users", ["id"])
+    op.create_index("ix_users_email", "users", ["email"], unique=True)
+
+    op.create_table(
+        "chat_threads",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id")),
+        sa.Column("title", sa.String(255)),
+        sa.Column("is_deleted", sa.Boolean(), nullable=False),
+        sa.Column("created_at", sa.DateTime()),
+    )
+    op.create_index("ix_chat_threads_id", "chat_threads", ["id"])
+
+    op.create_table(
+        "messages",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("thread_id", sa.Integer(), sa.ForeignKey("chat_threads.id")),
+        sa.Column("sender", sa.String(255)),
+        sa.Column("role", sa.String(255), nullable=True),
+        sa.Column("content", sa.Text()),
+        sa.Column("created_at", sa.DateTime()),
+        sa.Column("model", sa.String(50), nullable=True),
+    )
+    op.create_index("ix_messages_id", "messages", ["id"])
+
+
+def downgrade():
+    op.drop_table("messages")
+    op.drop_table("chat_threads")
+    op.drop_table("users")
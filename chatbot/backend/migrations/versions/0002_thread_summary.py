@@ -0,0 +1,36 @@
+"""Rolling summary columns on chat_threads
+
+create_all never adds columns to an existing table, so databases created
+before the rolling summary was introduced are missing these.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def _existing_columns():
+    return {column["name"] for column in sa.inspect(op.get_bind()).get_columns("chat_threads")}
+
+
+def upgrade():
+    existing = _existing_columns()
+    with op.batch_alter_table("chat_threads") as batch_op:
+        if "summary" not in existing:
+            batch_op.add_column(sa.Column("summary", sa.Text(), nullable=True))
+        if "summary_message_id" not in existing:
+            batch_op.add_column(sa.Column("summary_message_id", sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table("chat_threads") as batch_op:
+        batch_op.drop_column("summary_message_id")
+        batch_op.drop_column("summary")
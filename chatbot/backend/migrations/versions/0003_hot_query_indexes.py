@@ -0,0 +1,33 @@
+"""Composite indexes for thread lists and history loads
+
+- messages (thread_id, id): history loads, message pages and the
+  max(id) per thread lookup behind the thread list previews
+- chat_threads (user_id, is_deleted, created_at, id): thread lists,
+  filtered by owner and deleted flag and ordered newest first
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index("ix_messages_thread_id_id", "messages", ["thread_id", "id"])
+    op.create_index(
+        "ix_chat_threads_user_deleted_created",
+        "chat_threads",
+        ["user_id", "is_deleted", "created_at", "id"],
+    )
+
+
+def downgrade():
+    op.drop_index("ix_chat_threads_user_deleted_created", table_name="chat_threads")
+    op.drop_index("ix_messages_thread_id_id", table_name="messages")
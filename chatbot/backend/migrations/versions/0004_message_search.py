@@ -0,0 +1,76 @@
+"""Full-text search index on message content
+
+- SQLite: external-content FTS5 table messages_fts plus insert, update and
+  delete triggers on messages, backfilled with a rebuild. Besides the
+  content it indexes an owner token ('u<user_id>'), so a search is an
+  intersection with the user's own doclist instead of a ranking of every
+  match in the database. Prefix indexes keep search-as-you-type fast.
+  A batch migration that recreates messages drops the triggers, so it
+  has to recreate them.
+- MySQL: FULLTEXT index ft_messages_content on messages.content
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+# Owner token of the thread a messages row belongs to
+OWNER_TOKEN = "(SELECT 'u' || user_id FROM chat_threads WHERE id = {row}.thread_id)"
+
+SQLITE_UPGRADE = [
+    """CREATE VIEW IF NOT EXISTS messages_fts_source AS
+        SELECT m.id AS id, m.content AS content, 'u' || t.user_id AS owner
+        FROM messages m JOIN chat_threads t ON t.id = m.thread_id""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        content, owner, content='messages_fts_source', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3 4'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, content, owner) VALUES (new.id, new.content, {OWNER_TOKEN.format(row="new")});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content, owner)
+        VALUES ('delete', old.id, old.content, {OWNER_TOKEN.format(row="old")});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content, owner)
+        VALUES ('delete', old.id, old.content, {OWNER_TOKEN.format(row="old")});
+        INSERT INTO messages_fts(rowid, content, owner) VALUES (new.id, new.content, {OWNER_TOKEN.format(row="new")});
+    END""",
+    "INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')",
+]
+
+SQLITE_DOWNGRADE = [
+    "DROP TRIGGER IF EXISTS messages_fts_update",
+    "DROP TRIGGER IF EXISTS messages_fts_delete",
+    "DROP TRIGGER IF EXISTS messages_fts_insert",
+    "DROP TABLE IF EXISTS messages_fts",
+    "DROP VIEW IF EXISTS messages_fts_source",
+]
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == "sqlite":
+        for statement in SQLITE_UPGRADE:
+            op.execute(statement)
+    elif dialect == "mysql":
+        op.create_index("ft_messages_content", "messages", ["content"], mysql_prefix="FULLTEXT")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == "sqlite":
+        for statement in SQLITE_DOWNGRADE:
+            op.execute(statement)
+    elif dialect == "mysql":
+        op.drop_index("ft_messages_content", table_name="messages")
@@ -0,0 +1,99 @@
+"""
+Per-model fallback for the streaming chat path
+
+A provider's reply is streamed from its preferred model and, if that
+model's circuit is open or it fails before producing any text, from each
+of the provider's other chat models in turn. This is the same chain the
+blocking generate_response_async paths walk: outcomes go to the per-model
+circuit breakers ("openai/gpt-4o-mini") and the model that answered is
+confirmed in the capability registry, so the next request starts on it.
+"""
+import contextlib
+import logging
+
+from capability_registry import capability_registry
+from circuit_breaker import circuit_breakers
+from metrics import fallbacks
+
+logger = logging.getLogger(__name__)
+
+# How much of a reply's opening is searched for the provider's identity
+IDENTITY_WINDOW_CHARS = 60
+
+
+async def _first_text(stream):
+    async for text in stream:
+        if text:
+            return text
+    raise RuntimeError("Stream finished without any text")
+
+
+async def stream_models(provider, models, open_stream):
+    """
+    Yield the text chunks of the first model that streams any
+    models is the chain to try, preferred first; open_stream(model)
+    returns that model's text stream. Raises RuntimeError if every model
+    is skipped or fails before its first chunk. A failure after the first
+    chunk is recorded on the model's breaker and raised, since text has
+    already been sent on.
+    """
+    errors = []
+    for model in models:
+        breaker = circuit_breakers.get(f"{provider}/{model}")
+        if not breaker.allow_request():
+            logger.info(f"Skipping {provider}/{model}: circuit is open")
+            errors.append(f"{model}: circuit open")
+            continue
+
+        stream = open_stream(model)
+        try:
+            try:
+                first = await _first_text(stream)
+            except Exception as e:
+                breaker.record_failure()
+                logger.warning(f"{provider}/{model} failed before its first token: {str(e)}")
+                errors.append(f"{model}: {e}")
+                continue
+
+            breaker.record_success()
+            capability_registry.confirm(provider, "chat", model)
+            if model != models[0]:
+                logger.info(f"{provider} fallback successful with {model}")
+                fallbacks.inc(requested=f"{provider}/{models[0]}", served=f"{provider}/{model}", kind="model")
+
+            yield first
+            try:
+                async for text in stream:
+                    yield text
+            except Exception:
+                breaker.record_failure()
+                raise
+            return
+        finally:
+            with contextlib.suppress(Exception):
+                await stream.aclose()
+
+    raise RuntimeError(f"Every {provider} model failed: " + "; ".join(errors))
+
+
+async def with_identity(stream, markers, prefix, window=IDENTITY_WINDOW_CHARS):
+    """
+    Prefix a reply stream unless its opening mentions one of the markers
+    The opening (up to window characters) is held back until it can be
+    checked, as the blocking paths check the whole reply.
+    """
+    opening = ""
+    async for text in stream:
+        if opening is None:
+            yield text
+            continue
+        opening += text
+        if len(opening) >= window:
+            if not any(marker in opening.lower() for marker in markers):
+                yield prefix
+            yield opening
+            opening = None
+    if opening:
+        if not any(marker in opening.lower() for marker in markers):
+            yield prefix
+        yield opening
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Text, DateTime, Boolean, Enum
+from sqlalchemy import Column, Integer, String, ForeignKey, Text, DateTime, Boolean, Enum, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
@@ -24,12 +24,18 @@ class User(Base):
 
 class ChatThread(Base):
     __tablename__ = "chat_threads"
+    __table_args__ = (
+        # Thread lists: WHERE user_id = ? AND is_deleted = ? ORDER BY created_at DESC, id DESC
+        Index("ix_chat_threads_user_deleted_created", "user_id", "is_deleted", "created_at", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     title = Column(String(255))
     is_deleted = Column(Boolean, default=False, nullable=False)  # Make sure this exists
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    summary = Column(Text, nullable=True)  # Rolling summary of turns that left the context window
+    summary_message_id = Column(Integer, nullable=True)  # Last message folded into the summary
     
     # Relationships
     user = relationship("User", back_populates="threads")
@@ -37,6 +43,10 @@ class ChatThread(Base):
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        # History loads and message pages: WHERE thread_id = ? ORDER BY id
+        Index("ix_messages_thread_id_id", "thread_id", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     thread_id = Column(Integer, ForeignKey("chat_threads.id"))
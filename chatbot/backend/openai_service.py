@@ -1,14 +1,29 @@
 import logging
+import json
 import time
 import os
 import traceback
-from alternatives import get_rule_based_response
+from alternatives import AnalysisFailure, get_rule_based_response
 import openai
 from config import OPENAI_API_KEY
+from http_clients import get_async_client, iter_sse_data, run_sync
+from circuit_breaker import circuit_breakers
+from capability_registry import capability_registry
+from context_window import fit_to_budget
+from metrics import ProviderCall, fallbacks
+from model_fallback import stream_models, with_identity
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
+OPENAI_CHAT_COMPLETIONS_URL = "https://api.openai.com/v1/chat/completions"
+
+# Chat models in order of preference
+OPENAI_CHAT_MODELS = ["gpt-4o-mini", "gpt-3.5-turbo"]
+
+# Sampling settings for chat replies
+OPENAI_GENERATION_CONFIG = {"max_tokens": 800, "temperature": 0.7}
+
 class OpenAIService:
     """Service class to handle OpenAI API interactions with fallbacks"""
     
@@ -31,16 +46,24 @@ class OpenAIService:
                 logger.info("OpenAI modern client available")
             except ImportError:
                 logger.info("Using legacy OpenAI client")
-                
-            # Test the connection
-            self._test_connection()
+            
+            # The connection test runs in the provider warm-up, not here
             
         except ImportError:
             logger.error("OpenAI library not installed")
             self.openai = None
     
+    @property
+    def generation_config(self):
+        """Everything besides the prompt that shapes a reply"""
+        return {"model": self.model, **OPENAI_GENERATION_CONFIG}
+    
     def _get_best_model(self):
-        """Get the best working model from test file or default list"""
+        """Get the best working model from the capability registry, test file or default list"""
+        remembered = capability_registry.remembered("openai", "chat")
+        if remembered:
+            return remembered["model"]
+        
         # Try to read from our test file
         try:
             model_file = os.path.join(os.path.dirname(__file__), "working_openai_model.txt")
@@ -53,7 +76,7 @@ class OpenAIService:
             pass
             
         # Default to a reliable model
-        return "gpt-4o-mini"
+        return OPENAI_CHAT_MODELS[0]
     
     def _test_connection(self):
         """Test the API connection silently"""
@@ -61,7 +84,7 @@ class OpenAIService:
             logger.warning("No OpenAI API key provided - will use fallbacks")
             return False
             
-        models_to_try = [self.model, "gpt-4o-mini", "gpt-3.5-turbo"]
+        models_to_try = [self.model] + [m for m in OPENAI_CHAT_MODELS if m != self.model]
         
         for model in models_to_try:
             try:
@@ -76,6 +99,7 @@ class OpenAIService:
                     )
                     logger.info("✅ OpenAI API connection test successful (modern client)")
                     self.model = model  # Update to working model
+                    capability_registry.confirm("openai", "chat", model)
                     return True
                 else:  # Legacy client
                     response = self.openai.ChatCompletion.create(
@@ -86,6 +110,7 @@ class OpenAIService:
                     )
                     logger.info("✅ OpenAI API connection test successful (legacy client)")
                     self.model = model  # Update to working model
+                    capability_registry.confirm("openai", "chat", model)
                     return True
                     
             except Exception as e:
@@ -95,15 +120,10 @@ class OpenAIService:
         logger.error("❌ All OpenAI models failed connection test")
         return False
         
-    def generate_response(self, conversation_history):
-        """Generate a response using OpenAI API with clear model identification"""
-        # Check if OpenAI library is available
-        if not self.openai:
-            logger.error("OpenAI library not available")
-            return get_rule_based_response(conversation_history[-1]['content'] if conversation_history else "Hello")
-        
-        # Log very clearly that we're using OpenAI
-        logger.info("🤖 USING OPENAI MODEL FOR RESPONSE GENERATION")
+    def _build_messages(self, conversation_history):
+        """Prepend the ChatGPT identity system message to the conversation"""
+        # Keep the prompt inside this model's token budget
+        conversation_history = fit_to_budget(conversation_history, self.model)
         
         # Add system message to identify as OpenAI/ChatGPT
         formatted_messages = []
@@ -115,6 +135,28 @@ class OpenAIService:
         # Add the user conversation history
         for msg in conversation_history:
             formatted_messages.append(msg)
+        return formatted_messages
+    
+    def generate_response(self, conversation_history):
+        """Synchronous wrapper around generate_response_async for non-async callers"""
+        return run_sync(self.generate_response_async(conversation_history))
+        
+    async def generate_response_async(self, conversation_history):
+        """Generate a response using OpenAI API with clear model identification"""
+        # Check if we can reach OpenAI at all
+        if not self.api_key:
+            logger.error("OpenAI API key not available")
+            return get_rule_based_response(conversation_history[-1]['content'] if conversation_history else "Hello", source="openai")
+        
+        # Log very clearly that we're using OpenAI
+        logger.info("🤖 USING OPENAI MODEL FOR RESPONSE GENERATION")
+        
+        # Pick up the remembered model (re-validated in the background once stale)
+        remembered = capability_registry.remembered("openai", "chat", self._discover_chat_model)
+        if remembered:
+            self.model = remembered["model"]
+        
+        formatted_messages = self._build_messages(conversation_history)
             
         # Try with primary model first
         try:
@@ -123,45 +165,116 @@ class OpenAIService:
             # Add timestamp for logging
             request_time = time.time()
             
-            if self.client:  # Modern client
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=formatted_messages,
-                    max_tokens=800,
-                    temperature=0.7
-                )
-                
-                response_time = time.time() - request_time
-                logger.info(f"OpenAI API responded in {response_time:.2f} seconds")
-                
-                response_text = response.choices[0].message.content.strip()
-            else:  # Legacy client
-                response = self.openai.ChatCompletion.create(
-                    model=self.model,
-                    messages=formatted_messages,
-                    max_tokens=800,
-                    temperature=0.7
-                )
-                
-                response_time = time.time() - request_time
-                logger.info(f"OpenAI API responded in {response_time:.2f} seconds")
-                
-                response_text = response["choices"][0]["message"]["content"].strip()
+            response_text = await self._create_chat_completion(self.model, formatted_messages)
+            
+            response_time = time.time() - request_time
+            logger.info(f"OpenAI API responded in {response_time:.2f} seconds")
+            capability_registry.confirm("openai", "chat", self.model)
             
             # Force identification as ChatGPT if not present
             if "chatgpt" not in response_text.lower() and "openai" not in response_text.lower():
                 response_text = "I am ChatGPT, OpenAI's assistant.\n\n" + response_text
                 
-            logger.info(f"✅ OpenAI response successful ({len(response_text)} chars)")
+            logger.info(f"OpenAI response successful ({len(response_text)} chars)")
             return response_text
             
         except Exception as e:
             logger.warning(f"Failed with {self.model}: {str(e)}")
             
             # Try with fallback models
-            return self._try_fallback_models(formatted_messages)
+            return await self._try_fallback_models(formatted_messages)
+    
+    def _discover_chat_model(self):
+        """Return the first chat model that answers, in order of preference (used for re-validation)"""
+        for model in OPENAI_CHAT_MODELS:
+            try:
+                run_sync(self._create_chat_completion(model, [{"role": "user", "content": "Hello"}]))
+                return model, None
+            except Exception as e:
+                logger.warning(f"Re-validation of {model} failed: {str(e)}")
+        return None
+    
+    async def _create_chat_completion(self, model, formatted_messages):
+        """Call the chat completions REST endpoint on the pooled async client"""
+        # Models with an open circuit fail fast so the fallback chain moves on
+        breaker = circuit_breakers.get(f"openai/{model}")
+        if not breaker.allow_request():
+            raise RuntimeError(f"Circuit for openai/{model} is open")
+        
+        client = get_async_client("openai")
+        with ProviderCall("openai", model) as call:
+            try:
+                response = await client.post(
+                    OPENAI_CHAT_COMPLETIONS_URL,
+                    headers={"Authorization": f"Bearer {self.api_key}"},
+                    json={
+                        "model": model,
+                        "messages": formatted_messages,
+                        **OPENAI_GENERATION_CONFIG
+                    },
+                    timeout=60
+                )
+                call.record_response(response)
+                response.raise_for_status()
+            except Exception:
+                breaker.record_failure()
+                raise
+            breaker.record_success()
+            result = response.json()
+            usage = result.get("usage") or {}
+            call.usage(usage.get("prompt_tokens"), usage.get("completion_tokens"))
+        return result["choices"][0]["message"]["content"].strip()
+    
+    async def stream_response(self, conversation_history):
+        """Stream response text chunks, falling back through the chat models like generate_response_async"""
+        if not self.api_key:
+            raise ValueError("OpenAI API key not available")
+        
+        # Pick up the remembered model (re-validated in the background once stale)
+        remembered = capability_registry.remembered("openai", "chat", self._discover_chat_model)
+        if remembered:
+            self.model = remembered["model"]
+        
+        formatted_messages = self._build_messages(conversation_history)
+        models = [self.model] + [m for m in OPENAI_CHAT_MODELS if m != self.model]
+        stream = stream_models("openai", models, lambda model: self._stream_chat_completion(model, formatted_messages))
+        async for text in with_identity(stream, ("chatgpt", "openai"), "I am ChatGPT, OpenAI's assistant.\n\n"):
+            yield text
+    
+    async def _stream_chat_completion(self, model, formatted_messages):
+        """Stream one model's reply from the chat completions endpoint"""
+        client = get_async_client("openai")
+        with ProviderCall("openai", model) as call:
+            async with client.stream(
+                "POST",
+                OPENAI_CHAT_COMPLETIONS_URL,
+                headers={"Authorization": f"Bearer {self.api_key}"},
+                json={
+                    "model": model,
+                    "messages": formatted_messages,
+                    **OPENAI_GENERATION_CONFIG,
+                    "stream": True,
+                    # The last chunk then carries the token usage, with no choices
+                    "stream_options": {"include_usage": True}
+                },
+                timeout=60
+            ) as response:
+                call.record_response(response)
+                if response.status_code != 200:
+                    await response.aread()
+                    raise RuntimeError(f"OpenAI streaming request failed: {response.status_code} {response.text[:200]}")
+                async for data in iter_sse_data(response):
+                    chunk = json.loads(data)
+                    usage = chunk.get("usage") or {}
+                    call.usage(usage.get("prompt_tokens"), usage.get("completion_tokens"))
+                    choices = chunk.get("choices") or []
+                    if choices:
+                        text = choices[0].get("delta", {}).get("content")
+                        if text:
+                            call.first_token()
+                            yield text
     
-    def _try_fallback_models(self, formatted_messages):
+    async def _try_fallback_models(self, formatted_messages):
         """Try fallback models if the primary one fails"""
         fallback_models = ["gpt-3.5-turbo", "gpt-4o-mini", "gpt-3.5-turbo-instruct"]
         
@@ -172,28 +285,18 @@ class OpenAIService:
             try:
                 logger.debug(f"Trying fallback with model {model}")
                 
-                if self.client:  # Modern client
-                    response = self.client.chat.completions.create(
-                        model=model,
-                        messages=formatted_messages,
-                        max_tokens=800,
-                        temperature=0.7
-                    )
-                    response_text = response.choices[0].message.content.strip()
-                else:  # Legacy client
-                    response = self.openai.ChatCompletion.create(
-                        model=model,
-                        messages=formatted_messages,
-                        max_tokens=800,
-                        temperature=0.7
-                    )
-                    response_text = response["choices"][0]["message"]["content"].strip()
+                response_text = await self._create_chat_completion(model, formatted_messages)
                 
                 # Force identification as ChatGPT if not present
                 if "chatgpt" not in response_text.lower() and "openai" not in response_text.lower():
                     response_text = "I am ChatGPT, OpenAI's assistant.\n\n" + response_text
                 
-                logger.info(f"✅ OpenAI fallback successful with {model}")
+                logger.info(f"OpenAI fallback successful with {model}")
+                fallbacks.inc(requested=f"openai/{self.model}", served=f"openai/{model}", kind="model")
+                
+                # Use this model directly from now on instead of failing over on every call
+                self.model = model
+                capability_registry.confirm("openai", "chat", model)
                 return response_text
                 
             except Exception as e:
@@ -214,7 +317,7 @@ class OpenAIService:
         if not last_user_message:
             last_user_message = "Help me"
             
-        fallback_response = "I am ChatGPT, but I'm having trouble connecting to my knowledge base. " + get_rule_based_response(last_user_message)
+        fallback_response = "I am ChatGPT, but I'm having trouble connecting to my knowledge base. " + get_rule_based_response(last_user_message, source="openai")
         return fallback_response
 
     def analyze_image(self, image_data, prompt="Analyze this image in detail"):
@@ -252,4 +355,4 @@ class OpenAIService:
             
         except Exception as e:
             logger.error(f"Image analysis error: {str(e)}")
-            return f"I apologize, but I couldn't analyze the image due to an error: {str(e)}"
+            return AnalysisFailure(f"I apologize, but I couldn't analyze the image due to an error: {str(e)}")
@@ -0,0 +1,84 @@
+"""
+Per-process TTL cache of authenticated users keyed by access token
+
+Resolving a bearer token means checking its signature and reading the
+user row. Entries map the token's id (a SHA-256 of the token, so the
+token itself is not kept) to the resolved Principal until the TTL or the
+token's own expiry, whichever comes first, so repeat requests with the
+same token skip both.
+"""
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from config import AUTH_PRINCIPAL_CACHE_TTL, AUTH_PRINCIPAL_CACHE_MAX_ENTRIES
+
+logger = logging.getLogger(__name__)
+
+
+def token_id(token):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+class PrincipalCache:
+    """LRU of token id -> (expires_at, principal)"""
+
+    def __init__(self, ttl=AUTH_PRINCIPAL_CACHE_TTL, max_entries=AUTH_PRINCIPAL_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token):
+        key = token_id(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, token, principal, token_expires_at=None):
+        """Cache a principal; token_expires_at is the token's exp claim (epoch seconds)"""
+        if self.ttl <= 0:
+            return
+        expires_at = time.time() + self.ttl
+        if token_expires_at:
+            expires_at = min(expires_at, float(token_expires_at))
+        key = token_id(token)
+        with self._lock:
+            self._entries[key] = (expires_at, principal)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, user_id):
+        """Drop every cached token of a user (e.g. after the account changes)"""
+        with self._lock:
+            for key in [key for key, (_, principal) in self._entries.items() if principal.id == user_id]:
+                del self._entries[key]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        with self._lock:
+            entries = len(self._entries)
+        return {
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+# Shared instance used by the authentication dependency
+principal_cache = PrincipalCache()
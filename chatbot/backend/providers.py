@@ -0,0 +1,108 @@
+"""
+Process-wide registry of the AI provider services
+
+Each service is built once per process, lazily on first use, instead of at
+import time in every module that needs it. Constructors make no network
+calls; the connection tests run in warm_up(), which the app lifespan starts
+in the background so all providers are checked concurrently.
+"""
+import asyncio
+import logging
+import os
+import threading
+
+from config import OPENAI_API_KEY, GEMINI_API_KEY
+
+logger = logging.getLogger(__name__)
+
+
+def _build_openai():
+    from openai_service import OpenAIService
+    return OpenAIService(OPENAI_API_KEY)
+
+
+def _build_gemini():
+    from gemini_service import GeminiService
+    return GeminiService(GEMINI_API_KEY)
+
+
+def _build_claude():
+    from services.claude_service import ClaudeService
+    return ClaudeService()
+
+
+class ProviderRegistry:
+    """Lazily built, shared provider services"""
+
+    factories = {
+        "openai": _build_openai,
+        "gemini": _build_gemini,
+        "claude": _build_claude,
+    }
+
+    def __init__(self):
+        self._services = {}
+        self._image_analyzer = None
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """Return the service for a provider, building it on first use"""
+        service = self._services.get(name)
+        if service is not None:
+            return service
+        with self._lock:
+            # Another request may have built it while we waited for the lock
+            service = self._services.get(name)
+            if service is None:
+                logger.info(f"Initializing {name} service")
+                service = self.factories[name]()
+                self._services[name] = service
+            return service
+
+    def is_available(self, name):
+        """True if the provider's service can be built (e.g. its API key is set)"""
+        try:
+            self.get(name)
+            return True
+        except Exception as e:
+            logger.warning(f"{name} service unavailable: {str(e)}")
+            return False
+
+    def image_analyzer(self):
+        """Return the shared ImageAnalyzer, built on the OpenAI and Gemini services"""
+        if self._image_analyzer is None:
+            from image_analyzer import ImageAnalyzer
+            openai_service = self.get("openai")
+            gemini_service = self.get("gemini")
+            with self._lock:
+                if self._image_analyzer is None:
+                    self._image_analyzer = ImageAnalyzer(
+                        openai_service=openai_service,
+                        gemini_service=gemini_service,
+                        vision_api_key=os.environ.get("GOOGLE_VISION_API_KEY")
+                    )
+        return self._image_analyzer
+
+    def _warm(self, name):
+        service = self.get(name)
+        test_connection = getattr(service, "_test_connection", None)
+        if test_connection:
+            test_connection()
+
+    async def warm_up(self, names=None):
+        """Build every provider and run its connection test concurrently"""
+        names = list(names or self.factories)
+        results = await asyncio.gather(
+            *(asyncio.to_thread(self._warm, name) for name in names),
+            return_exceptions=True
+        )
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Warm-up of {name} failed: {str(result)}")
+            else:
+                logger.info(f"{name} service warmed up")
+
+
+# Shared registry used by the routes
+providers = ProviderRegistry()
+
@@ -0,0 +1,208 @@
+"""
+Opt-in cache of complete model replies for identical prompts
+
+The key hashes the provider, its generation config (model, sampling
+settings, system prompt) and the normalized context window, so the same
+prompt from any user or thread maps to one entry. Only complete replies
+from the requested provider itself are stored, never fallbacks, hedged
+replies or interrupted streams. Hits are labelled "<model> (cached)".
+
+Backends: "memory" is a per-process LRU with a TTL and entry/byte limits;
+"redis" is shared by every worker process and needs the redis package.
+A backend error is logged and treated as a miss.
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from config import (
+    RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_BACKEND, RESPONSE_CACHE_URL, RESPONSE_CACHE_TTL_SECONDS,
+    RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES
+)
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever the key layout changes so old shared entries are ignored
+KEY_VERSION = 1
+
+
+def normalize_messages(messages):
+    """Role and content only, Unicode NFC with runs of whitespace collapsed"""
+    return [
+        {"role": message["role"], "content": " ".join(unicodedata.normalize("NFC", message["content"] or "").split())}
+        for message in messages
+    ]
+
+
+def cache_key(provider, generation_config, messages):
+    payload = json.dumps(
+        [KEY_VERSION, provider, generation_config, normalize_messages(messages)],
+        sort_keys=True, ensure_ascii=False, separators=(",", ":")
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MemoryBackend:
+    """Per-process LRU with per-entry expiry"""
+
+    name = "memory"
+
+    def __init__(self, max_entries=RESPONSE_CACHE_MAX_ENTRIES, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, text)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    async def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                self._discard(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    async def set(self, key, text, ttl):
+        size = len(text.encode("utf-8"))
+        with self._lock:
+            self._discard(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (time.monotonic() + ttl, text)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._discard(oldest)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions
+            }
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[1].encode("utf-8"))
+
+
+class RedisBackend:
+    """Shared across worker processes; Redis handles expiry and eviction (maxmemory-policy)"""
+
+    name = "redis"
+    prefix = "chatbot:response:"
+
+    def __init__(self, url=RESPONSE_CACHE_URL):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("RESPONSE_CACHE_BACKEND=redis needs the redis package (pip install redis)")
+        self.client = redis.from_url(url, decode_responses=True)
+
+    async def get(self, key):
+        return await self.client.get(self.prefix + key)
+
+    async def set(self, key, text, ttl):
+        await self.client.set(self.prefix + key, text, ex=ttl)
+
+    def stats(self):
+        return {}
+
+
+BACKENDS = {
+    "memory": MemoryBackend,
+    "redis": RedisBackend,
+}
+
+
+class ResponseCache:
+    """Reply cache in front of the chat providers, with hit/miss accounting"""
+
+    def __init__(self, backend=None, ttl=RESPONSE_CACHE_TTL_SECONDS, enabled=RESPONSE_CACHE_ENABLED):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.backend = backend
+        if enabled and backend is None:
+            self.backend = BACKENDS[RESPONSE_CACHE_BACKEND]()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.errors = 0
+
+    def key_for(self, provider, service, messages):
+        """Cache key for a prompt to one provider, or None when caching is off"""
+        if not self.enabled:
+            return None
+        return cache_key(provider, getattr(service, "generation_config", {}), messages)
+
+    async def get(self, key):
+        if key is None:
+            return None
+        try:
+            text = await self.backend.get(key)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Response cache lookup failed: {str(e)}")
+            return None
+        if text is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return text
+
+    async def put(self, key, text):
+        if key is None or not text:
+            return
+        try:
+            await self.backend.set(key, text, self.ttl)
+            self.stores += 1
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Response cache store failed: {str(e)}")
+
+    async def recording(self, key, stream):
+        """Pass a reply stream through, storing the text only if it runs to completion"""
+        chunks = []
+        try:
+            async for text in stream:
+                chunks.append(text)
+                yield text
+        finally:
+            await stream.aclose()
+        await self.put(key, "".join(chunks))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "backend": self.backend.name if self.backend else None,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "stores": self.stores,
+            "errors": self.errors,
+            **(self.backend.stats() if self.backend else {})
+        }
+
+
+async def replay(text):
+    """A cached reply as a one-chunk text stream"""
+    yield text
+
+
+# Shared instance used by the chat routes
+response_cache = ResponseCache()
@@ -21,8 +21,9 @@ class ChatThreadBase(BaseModel):
     title: str
     user_id: int
 
-class ChatThreadCreate(ChatThreadBase):
-    pass
+class ChatThreadCreate(BaseModel):
+    title: str
+    user_id: Optional[int] = None  # Ignored; the thread belongs to the authenticated user
 
 class ChatThread(ChatThreadBase):
     id: int
@@ -33,8 +34,42 @@ class ChatThread(ChatThreadBase):
     class Config:
         orm_mode: True
 
-class ChatRequest(BaseModel):
+class ChatThreadListItem(BaseModel):
+    id: int
+    title: Optional[str] = None
     user_id: int
+    is_deleted: bool = False
+    created_at: Optional[datetime] = None
+    lastMessage: Optional[str] = None
+
+class ChatThreadLists(BaseModel):
+    active: List[ChatThreadListItem]
+    deleted: List[ChatThreadListItem]
+    next_cursor: Optional[str] = None
+
+class ChatThreadPage(BaseModel):
+    items: List[ChatThreadListItem]
+    next_cursor: Optional[str] = None
+
+class MessagePage(BaseModel):
+    items: List[dict]
+    next_cursor: Optional[str] = None
+
+class MessageSearchHit(BaseModel):
+    message_id: int
+    thread_id: int
+    thread_title: Optional[str] = None
+    role: str
+    snippet: str
+    created_at: Optional[datetime] = None
+    score: float
+
+class MessageSearchResults(BaseModel):
+    query: str
+    items: List[MessageSearchHit]
+
+class ChatRequest(BaseModel):
+    user_id: Optional[int] = None  # Ignored; the authenticated user is used
     message: str
     update_title: Optional[bool] = False
     suggested_title: Optional[str] = None
@@ -48,6 +83,14 @@ class ChatResponse(BaseModel):
 class UserBase(BaseModel):
     email: str
 
+class Principal(BaseModel):
+    """The authenticated user behind an access token"""
+    id: int
+    email: str
+    username: Optional[str] = None
+    display_name: Optional[str] = None
+    login_method: Optional[str] = None
+
 class UserCreate(UserBase):
     password: str
 
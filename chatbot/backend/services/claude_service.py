@@ -6,6 +6,12 @@ from fastapi import HTTPException
 import base64
 from typing import Optional
 from dotenv import load_dotenv
+from http_clients import get_async_client, iter_sse_data, run_sync
+from context_window import fit_to_budget
+from logging_config import log_payload
+from metrics import ProviderCall
+from model_fallback import stream_models, with_identity
+from alternatives import AnalysisFailure
 
 # Load environment variables from .env file
 load_dotenv()
@@ -14,6 +20,13 @@ logger = logging.getLogger(__name__)
 
 
 CLAUDE_API_KEY = os.getenv("CLAUDE_API_KEY")
+CLAUDE_MESSAGES_URL = "https://api.anthropic.com/v1/messages"
+
+# Instructions for Claude - make it clearly identify as Claude
+CLAUDE_SYSTEM_PROMPT = "You are Claude, an AI assistant by Anthropic. Always make it clear that you are Claude in your responses. Be helpful, concise, and clear."
+
+# Sampling settings for chat replies
+CLAUDE_GENERATION_CONFIG = {"max_tokens": 2000}
 
 class ClaudeService:
     def __init__(self):
@@ -24,62 +37,80 @@ class ClaudeService:
         
         logger.info(f"Claude service initialized with model: {self.model}")
     
+    @property
+    def generation_config(self):
+        """Everything besides the prompt that shapes a reply"""
+        return {"model": self.model, "system": CLAUDE_SYSTEM_PROMPT, **CLAUDE_GENERATION_CONFIG}
+    
+    def _headers(self):
+        """Headers required by the Anthropic messages API"""
+        return {
+            "x-api-key": self.api_key,
+            "anthropic-version": "2023-06-01",
+            "content-type": "application/json"
+        }
+    
+    def _build_payload(self, messages):
+        """Convert the conversation into a Claude messages payload"""
+        # Keep the prompt inside this model's token budget
+        messages = fit_to_budget(messages, self.model)
+        
+        # Format the conversation history for Claude
+        # Claude expects a different format than OpenAI
+        formatted_messages = []
+        
+        # Debug the incoming messages
+        log_payload(logger, "Claude received messages", messages[:2])
+        
+        for msg in messages:
+            role = "user" if msg["role"] == "user" else "assistant"
+            content = msg["content"]
+            
+            # Check if the content might contain an image
+            if isinstance(content, list):
+                # This is a multimodal message, we need to extract the text part
+                text_parts = []
+                for part in content:
+                    if part.get("type") == "text":
+                        text_parts.append(part["text"])
+                content = " ".join(text_parts)
+            
+            formatted_messages.append({
+                "role": role,
+                "content": content
+            })
+        
+        return {
+            "model": self.model,
+            "system": CLAUDE_SYSTEM_PROMPT,
+            "messages": formatted_messages,
+            **CLAUDE_GENERATION_CONFIG
+        }
+    
     def generate_response(self, messages):
+        """Synchronous wrapper around generate_response_async for non-async callers"""
+        return run_sync(self.generate_response_async(messages))
+    
+    async def generate_response_async(self, messages):
         """Generate a response from Claude using the anthropic API directly"""
         try:
-            # Format the conversation history for Claude
-            # Claude expects a different format than OpenAI
-            formatted_messages = []
-            
-            # Debug the incoming messages
-            logger.debug(f"Claude received messages: {json.dumps(messages[:2])}...")
-            
-            for msg in messages:
-                role = "user" if msg["role"] == "user" else "assistant"
-                content = msg["content"]
-                
-                # Check if the content might contain an image
-                if isinstance(content, list):
-                    # This is a multimodal message, we need to extract the text part
-                    text_parts = []
-                    for part in content:
-                        if part.get("type") == "text":
-                            text_parts.append(part["text"])
-                    content = " ".join(text_parts)
-                
-                formatted_messages.append({
-                    "role": role,
-                    "content": content
-                })
-            
-            url = "https://api.anthropic.com/v1/messages"
+            payload = self._build_payload(messages)
             
-            # Instructions for Claude - make it clearly identify as Claude
-            system_prompt = "You are Claude, an AI assistant by Anthropic. Always make it clear that you are Claude in your responses. Be helpful, concise, and clear."
-            
-            payload = {
-                "model": self.model,
-                "system": system_prompt,
-                "messages": formatted_messages,
-                "max_tokens": 2000
-            }
-            
-            headers = {
-                "x-api-key": self.api_key,
-                "anthropic-version": "2023-06-01",
-                "content-type": "application/json"
-            }
-            
-            logger.info(f"Sending request to Claude API with {len(formatted_messages)} messages")
+            logger.info(f"Sending request to Claude API with {len(payload['messages'])} messages")
             
             # Debug output the actual request payload
-            logger.debug(f"Claude API request payload: {json.dumps(payload)[:500]}...")
+            log_payload(logger, "Claude API request payload", payload)
             
-            response = requests.post(url, headers=headers, json=payload, timeout=60)
-            response.raise_for_status()
-            
-            # Parse the response
-            result = response.json()
+            client = get_async_client("claude")
+            with ProviderCall("claude", self.model) as call:
+                response = await client.post(CLAUDE_MESSAGES_URL, headers=self._headers(), json=payload, timeout=60)
+                call.record_response(response)
+                response.raise_for_status()
+                
+                # Parse the response
+                result = response.json()
+                usage = result.get("usage") or {}
+                call.usage(usage.get("input_tokens"), usage.get("output_tokens"))
             
             # Debug the response structure
             logger.debug(f"Claude API response structure: {list(result.keys())}")
@@ -115,6 +146,42 @@ class ClaudeService:
                     
             raise HTTPException(status_code=500, detail=f"Claude API error: {str(e)}")
     
+    async def stream_response(self, messages):
+        """Stream response text chunks from the Anthropic messages API"""
+        payload = self._build_payload(messages)
+        payload["stream"] = True
+        
+        logger.info(f"Streaming from Claude API with {len(payload['messages'])} messages")
+        
+        # Claude has a single chat model, but it still reports to its own per-model breaker
+        stream = stream_models("claude", [self.model], lambda model: self._stream_model(model, payload))
+        async for text in with_identity(stream, ("claude", "anthropic"), "As Claude, I'll address your question: "):
+            yield text
+    
+    async def _stream_model(self, model, payload):
+        """Stream one model's reply from the messages API"""
+        client = get_async_client("claude")
+        with ProviderCall("claude", model) as call:
+            async with client.stream("POST", CLAUDE_MESSAGES_URL, headers=self._headers(), json={**payload, "model": model}, timeout=60) as response:
+                call.record_response(response)
+                if response.status_code != 200:
+                    await response.aread()
+                    raise RuntimeError(f"Claude streaming request failed: {response.status_code} {response.text[:200]}")
+                async for data in iter_sse_data(response):
+                    event = json.loads(data)
+                    if event.get("type") == "content_block_delta":
+                        text = event.get("delta", {}).get("text")
+                        if text:
+                            call.first_token()
+                            yield text
+                    elif event.get("type") == "message_start":
+                        usage = event.get("message", {}).get("usage") or {}
+                        call.usage(usage.get("input_tokens"), usage.get("output_tokens"))
+                    elif event.get("type") == "message_delta":
+                        call.usage(output_tokens=(event.get("usage") or {}).get("output_tokens"))
+                    elif event.get("type") == "error":
+                        raise RuntimeError(f"Claude stream error: {event.get('error')}")
+    
     def analyze_image(self, image_base64):
         """Process an image with Claude and return a description"""
         try:
@@ -129,7 +196,7 @@ class ClaudeService:
             # Validate image_base64 is a string
             if not isinstance(image_base64, str):
                 logger.error("Image data must be a base64-encoded string")
-                return "Unable to analyze the image: invalid format"
+                return AnalysisFailure("Unable to analyze the image: invalid format")
             
             # Convert base64 to Claude's expected message format
             payload = {
@@ -182,8 +249,8 @@ class ClaudeService:
                 return text_content
             else:
                 logger.error("Claude API returned invalid response format for image analysis")
-                return "As Claude, I apologize, but I'm having trouble analyzing this image right now."
+                return AnalysisFailure("As Claude, I apologize, but I'm having trouble analyzing this image right now.")
                 
         except Exception as e:
             logger.error(f"Claude image analysis error: {str(e)}")
-            return f"As Claude, I'm unable to analyze the image: {str(e)[:100]}"
+            return AnalysisFailure(f"As Claude, I'm unable to analyze the image: {str(e)[:100]}")
@@ -0,0 +1,84 @@
+"""Tests for the content-addressed attachment store"""
+import os
+import time
+
+import pytest
+
+from attachment_store import AttachmentStore
+
+DAY = 24 * 3600
+
+
+@pytest.fixture
+def store(tmp_path):
+    return AttachmentStore(root=str(tmp_path), retention=30 * DAY, max_bytes=1000)
+
+
+def age(store, attachment_id, seconds):
+    """Pretend the attachment was last used the given number of seconds ago"""
+    path, _ = store.open(attachment_id)
+    used_at = time.time() - seconds
+    os.utime(path, (used_at, used_at))
+
+
+def test_same_bytes_are_stored_once(store, tmp_path):
+    first = store.save(b"hello", "text/plain")
+    assert store.save(b"hello", "text/plain") == first
+    assert first.endswith(".txt")
+    path, media_type = store.open(first)
+    assert media_type == "text/plain"
+    with open(path, "rb") as f:
+        assert f.read() == b"hello"
+    assert sum(len(names) for _, _, names in os.walk(tmp_path)) == 1
+
+
+def test_unknown_and_malformed_ids_miss(store):
+    assert store.open("0" * 64 + ".png") is None
+    assert store.open("../../etc/passwd") is None
+
+
+def test_sweep_removes_attachments_past_retention(store):
+    old = store.save(b"old", "image/png")
+    recent = store.save(b"recent", "image/png")
+    age(store, old, 31 * DAY)
+    age(store, recent, 29 * DAY)
+
+    assert store.sweep() == 1
+    assert store.open(old) is None
+    assert store.open(recent) is not None
+    assert store.stats()["files"] == 1
+
+
+def test_reupload_and_fetch_keep_an_attachment(store):
+    uploaded = store.save(b"uploaded again", "image/png")
+    fetched = store.save(b"fetched", "image/png")
+    age(store, uploaded, 31 * DAY)
+    age(store, fetched, 31 * DAY)
+
+    store.save(b"uploaded again", "image/png")
+    store.open(fetched)
+    assert store.sweep() == 0
+
+
+def test_sweep_evicts_least_recently_used_over_the_size_limit(store):
+    ids = [store.save(bytes([n]) * 400, "image/png") for n in range(3)]
+    for n, attachment_id in enumerate(ids):
+        age(store, attachment_id, (3 - n) * DAY)
+
+    assert store.sweep() == 1
+    assert store.open(ids[0]) is None
+    assert store.open(ids[1]) is not None
+    assert store.stats()["bytes"] == 800
+
+
+def test_sweep_removes_stale_temporary_files(store, tmp_path):
+    stale = tmp_path / "ab" / "partial.tmp"
+    stale.parent.mkdir()
+    stale.write_bytes(b"partial")
+    os.utime(stale, (time.time() - DAY, time.time() - DAY))
+    fresh = tmp_path / "ab" / "writing.tmp"
+    fresh.write_bytes(b"in progress")
+
+    store.sweep()
+    assert not stale.exists()
+    assert fresh.exists()
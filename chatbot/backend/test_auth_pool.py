@@ -0,0 +1,102 @@
+"""Tests for the bounded login worker pool"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+from auth_pool import AuthPool, AuthPoolBusy
+
+
+class Gate:
+    """A blocking callable that records how many calls run at once"""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def __call__(self, value):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            self.release.wait(5)
+            return value
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+async def wait_until(condition):
+    for _ in range(200):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("condition never became true")
+
+
+@pytest.mark.asyncio
+async def test_runs_no_more_than_the_worker_count_at_once():
+    pool = AuthPool(workers=2, max_waiting=10)
+    gate = Gate()
+    calls = [asyncio.ensure_future(pool.run("bcrypt", gate, n)) for n in range(6)]
+    await wait_until(lambda: gate.running == 2)
+    await asyncio.sleep(0.05)
+    assert gate.running == 2
+    assert pool.stats()["pending"] == 6
+
+    gate.release.set()
+    assert await asyncio.gather(*calls) == list(range(6))
+    assert gate.max_running == 2
+    assert pool.stats()["pending"] == 0
+    pool.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_rejects_work_beyond_the_waiting_limit():
+    pool = AuthPool(workers=1, max_waiting=1)
+    gate = Gate()
+    calls = [asyncio.ensure_future(pool.run("bcrypt", gate, n)) for n in range(2)]
+    await wait_until(lambda: gate.running == 1)
+
+    with pytest.raises(AuthPoolBusy):
+        await pool.run("bcrypt", gate, 2)
+
+    gate.release.set()
+    await asyncio.gather(*calls)
+    stats = pool.stats()["operations"]["bcrypt"]
+    assert stats["rejected"] == 1
+    assert stats["calls"] == 2
+    pool.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_queued_work_records_its_wait():
+    pool = AuthPool(workers=1, max_waiting=5)
+
+    def slow():
+        time.sleep(0.05)
+
+    await asyncio.gather(*(pool.run("google_verify", slow) for _ in range(3)))
+    stats = pool.stats()["operations"]["google_verify"]
+    assert stats["calls"] == 3
+    assert stats["max_wait_ms"] >= 50
+    assert stats["max_run_ms"] >= 50
+    pool.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_exceptions_reach_the_caller():
+    pool = AuthPool(workers=1, max_waiting=1)
+
+    def fail():
+        raise ValueError("bad token")
+
+    with pytest.raises(ValueError, match="bad token"):
+        await pool.run("google_verify", fail)
+    stats = pool.stats()
+    assert stats["operations"]["google_verify"]["errors"] == 1
+    assert stats["pending"] == 0
+    pool.shutdown()
@@ -0,0 +1,166 @@
+"""Tests for the provider circuit breakers"""
+import asyncio
+
+import pytest
+
+import circuit_breaker
+import hedging
+from circuit_breaker import CircuitBreaker, CircuitBreakerRegistry, CLOSED, OPEN, HALF_OPEN
+from hedging import LatencyTracker, hedged_stream
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_breaker(monkeypatch, clock):
+    monkeypatch.setattr(circuit_breaker.time, "monotonic", clock)
+    return CircuitBreaker("test", window_seconds=60, min_requests=4, error_rate=0.5, open_seconds=30)
+
+
+def test_stays_closed_below_min_requests(monkeypatch):
+    breaker = make_breaker(monkeypatch, FakeClock())
+    for _ in range(3):
+        breaker.record_failure()
+    assert breaker.state == CLOSED
+    assert breaker.allow_request()
+
+
+def test_opens_at_error_rate(monkeypatch):
+    breaker = make_breaker(monkeypatch, FakeClock())
+    breaker.record_success()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow_request()
+    assert breaker.times_opened == 1
+
+
+def test_old_outcomes_leave_the_window(monkeypatch):
+    clock = FakeClock()
+    breaker = make_breaker(monkeypatch, clock)
+    for _ in range(3):
+        breaker.record_failure()
+    clock.now += 61
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+    assert breaker.stats()["requests"] == 1
+
+
+def test_half_open_allows_one_trial(monkeypatch):
+    clock = FakeClock()
+    breaker = make_breaker(monkeypatch, clock)
+    for _ in range(4):
+        breaker.record_failure()
+    clock.now += 30
+    assert breaker.state == HALF_OPEN
+    assert breaker.probe_due()
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+
+
+def test_unreported_trial_expires(monkeypatch):
+    clock = FakeClock()
+    breaker = make_breaker(monkeypatch, clock)
+    for _ in range(4):
+        breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow_request()
+    clock.now += 31
+    assert breaker.allow_request()
+
+
+def test_trial_success_closes(monkeypatch):
+    clock = FakeClock()
+    breaker = make_breaker(monkeypatch, clock)
+    for _ in range(4):
+        breaker.record_failure()
+    clock.now += 30
+    breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.stats()["failures"] == 0
+
+
+def test_trial_failure_reopens(monkeypatch):
+    clock = FakeClock()
+    breaker = make_breaker(monkeypatch, clock)
+    for _ in range(4):
+        breaker.record_failure()
+    clock.now += 30
+    breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert breaker.times_opened == 2
+
+
+class ReplyService:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.started = 0
+
+    async def stream_response(self, conversation_history):
+        self.started += 1
+        await asyncio.sleep(self.delay)
+        yield "reply"
+
+
+class SlowStartTracker(LatencyTracker):
+    def hedge_deadline(self, provider):
+        return 0.05
+
+
+def tripped_registry(monkeypatch, **open_seconds):
+    """A registry whose named breakers have just opened; open_seconds=0 leaves them half-open"""
+    registry = CircuitBreakerRegistry()
+    for name, seconds in open_seconds.items():
+        breaker = registry.get(name)
+        breaker.min_requests = 1
+        breaker.open_seconds = seconds
+        breaker.record_failure()
+    monkeypatch.setattr(hedging, "circuit_breakers", registry)
+    monkeypatch.setattr(hedging, "HEDGING_ENABLED", True)
+    return registry
+
+
+@pytest.mark.asyncio
+async def test_hedge_fallback_trial_is_kept_when_it_never_starts(monkeypatch):
+    registry = tripped_registry(monkeypatch, fallback=0)
+    fallback = ReplyService()
+    label, _ = await hedged_stream([("primary", ReplyService()), ("fallback", fallback)], [], SlowStartTracker())
+    assert label == "primary"
+    assert fallback.started == 0
+    assert registry.get("fallback").state == HALF_OPEN
+    assert registry.allow_request("fallback")
+
+
+@pytest.mark.asyncio
+async def test_hedge_spends_the_trial_when_the_fallback_starts(monkeypatch):
+    registry = tripped_registry(monkeypatch, fallback=0)
+    label, _ = await hedged_stream(
+        [("primary", ReplyService(delay=1)), ("fallback", ReplyService())], [], SlowStartTracker()
+    )
+    assert label == "fallback (hedged)"
+    assert registry.get("fallback").state == CLOSED
+
+
+@pytest.mark.asyncio
+async def test_open_primary_is_skipped_for_the_fallback(monkeypatch):
+    tripped_registry(monkeypatch, primary=60)
+    primary = ReplyService()
+    label, _ = await hedged_stream([("primary", primary), ("fallback", ReplyService())], [], SlowStartTracker())
+    assert label == "fallback (fallback)"
+    assert primary.started == 0
+
+
+@pytest.mark.asyncio
+async def test_every_circuit_open_raises(monkeypatch):
+    tripped_registry(monkeypatch, primary=60, fallback=60)
+    with pytest.raises(RuntimeError, match="circuit open"):
+        await hedged_stream([("primary", ReplyService()), ("fallback", ReplyService())], [], SlowStartTracker())
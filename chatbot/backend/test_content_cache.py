@@ -0,0 +1,72 @@
+"""Tests for the persistent content-addressed result store"""
+import pytest
+
+import content_cache
+from content_cache import ContentCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def __call__(self):
+        self.now += 1
+        return self.now
+
+
+@pytest.fixture
+def make_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(content_cache.time, "time", FakeClock())
+
+    def make(**options):
+        options = {"max_entries": 100, "max_bytes": 100_000, "enabled": True, **options}
+        return ContentCache(path=str(tmp_path / "content.db"), **options)
+    return make
+
+
+def test_hit_and_miss(make_cache):
+    cache = make_cache()
+    assert cache.get("image_analysis", "abc", "gemini") is None
+    cache.put("image_analysis", "abc", "gemini", {"description": "a red square"})
+    assert cache.get("image_analysis", "abc", "gemini") == {"description": "a red square"}
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+
+
+def test_namespace_and_variant_are_part_of_the_key(make_cache):
+    cache = make_cache()
+    cache.put("image_analysis", "abc", "gemini", "from gemini")
+    assert cache.get("image_analysis", "abc", "openai") is None
+    assert cache.get("image_description", "abc", "gemini") is None
+
+
+def test_entries_survive_a_restart(make_cache):
+    make_cache().put("image_analysis", "abc", "gemini", "stored")
+    assert make_cache().get("image_analysis", "abc", "gemini") == "stored"
+
+
+def test_least_recently_used_entry_is_evicted(make_cache):
+    cache = make_cache(max_entries=2)
+    cache.put("ns", "a", "", 1)
+    cache.put("ns", "b", "", 2)
+    cache.get("ns", "a")
+    cache.put("ns", "c", "", 3)
+    assert cache.get("ns", "b") is None
+    assert cache.get("ns", "a") == 1
+    assert cache.get("ns", "c") == 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_byte_limit_evicts_oldest(make_cache):
+    cache = make_cache(max_bytes=250)
+    cache.put("ns", "a", "", "x" * 100)
+    cache.put("ns", "b", "", "y" * 100)
+    cache.put("ns", "c", "", "z" * 100)
+    assert cache.get("ns", "a") is None
+    assert cache.stats()["bytes"] <= 250
+
+
+def test_disabled_store_keeps_nothing(make_cache):
+    cache = make_cache(enabled=False)
+    cache.put("ns", "a", "", 1)
+    assert cache.get("ns", "a") is None
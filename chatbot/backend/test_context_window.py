@@ -0,0 +1,45 @@
+"""Tests for context window packing and the rolling summary"""
+import context_window
+from context_window import attach_summary, fit_to_budget, pack_recent_turns, split_summary, update_rolling_summary
+
+
+def turns(count, size=400):
+    roles = ("user", "assistant")
+    return [{"role": roles[i % 2], "content": f"turn {i} " + "x" * size} for i in range(count)]
+
+
+def test_window_keeps_newest_and_opens_with_a_user_turn():
+    history = turns(10)
+    window, first_index = pack_recent_turns(history, 350)
+    assert window == history[first_index:]
+    assert window[0]["role"] == "user"
+    assert window[-1] == history[-1]
+
+
+def test_oversized_latest_message_is_truncated():
+    window, _ = pack_recent_turns([{"role": "user", "content": "x" * 10_000}], 100)
+    assert len(window) == 1
+    assert window[0]["content"].endswith("... [truncated]")
+
+
+def test_summary_round_trips():
+    window = attach_summary(turns(2), "- User: hi")
+    summary, history = split_summary(window)
+    assert summary == "- User: hi"
+    assert history == turns(2)
+
+
+def test_fit_to_budget_pins_the_summary(monkeypatch):
+    monkeypatch.setitem(context_window.CONTEXT_TOKEN_BUDGETS, "openai", 400)
+    window = attach_summary(turns(12), "- User: the earlier topic")
+    trimmed = fit_to_budget(window, "openai")
+    assert len(trimmed) < 12
+    assert trimmed[0]["role"] == "user"
+    assert split_summary(trimmed)[0] == "- User: the earlier topic"
+
+
+def test_rolling_summary_stays_bounded():
+    summary = None
+    for _ in range(100):
+        summary = update_rolling_summary(summary, turns(2, size=50), max_tokens=100)
+    assert context_window.estimate_tokens(summary) <= 100
@@ -0,0 +1,50 @@
+"""Tests for the per-thread history cache"""
+from conversation_cache import ConversationCache
+
+
+def entry(message_id, content="hello"):
+    return {"id": message_id, "role": "user", "content": content}
+
+
+def test_get_returns_a_copy():
+    cache = ConversationCache(max_threads=10, max_bytes=10_000, enabled=True)
+    cache.put(1, [entry(1)])
+    cache.get(1).append(entry(2))
+    assert cache.get(1) == [entry(1)]
+
+
+def test_least_recently_used_thread_is_evicted():
+    cache = ConversationCache(max_threads=2, max_bytes=10_000, enabled=True)
+    cache.put(1, [entry(1)])
+    cache.put(2, [entry(2)])
+    cache.get(1)
+    cache.put(3, [entry(3)])
+    assert cache.get(2) is None
+    assert cache.get(1) is not None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_byte_limit_and_oversized_threads():
+    cache = ConversationCache(max_threads=10, max_bytes=300, enabled=True)
+    cache.put(1, [entry(1, "x" * 100)])
+    cache.put(2, [entry(2, "y" * 100)])
+    assert cache.get(1) is None
+    cache.put(3, [entry(3, "z" * 1000)])
+    assert cache.get(3) is None
+    assert cache.get(2) is not None
+
+
+def test_append_extends_and_out_of_order_invalidates():
+    cache = ConversationCache(max_threads=10, max_bytes=10_000, enabled=True)
+    cache.put(1, [entry(1)])
+    cache.append(1, entry(2), entry(3))
+    assert [e["id"] for e in cache.get(1)] == [1, 2, 3]
+    cache.append(1, entry(2))
+    assert cache.get(1) is None
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_disabled_cache_stores_nothing():
+    cache = ConversationCache(max_threads=10, max_bytes=10_000, enabled=False)
+    cache.put(1, [entry(1)])
+    assert cache.get(1) is None
@@ -0,0 +1,49 @@
+"""Tests for the stored document text and analyses"""
+import pytest
+
+import document_store
+from content_cache import ContentCache
+from document_store import DocumentExtractionError, load_pages, save_analysis, stored_analysis
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    cache = ContentCache(path=str(tmp_path / "content.db"), max_entries=100, max_bytes=100_000, enabled=True)
+    monkeypatch.setattr(document_store, "content_cache", cache)
+    return cache
+
+
+def test_text_is_extracted_once_per_document(store, monkeypatch):
+    extracted = []
+    real_extract = document_store.extract_pages
+
+    def counting_extract(contents, file_type):
+        extracted.append(contents)
+        return real_extract(contents, file_type)
+
+    monkeypatch.setattr(document_store, "extract_pages", counting_extract)
+    digest, pages = load_pages(b"hello world", "text/plain")
+    assert pages == ["hello world"]
+    assert load_pages(b"hello world", "text/plain") == (digest, pages)
+    assert len(extracted) == 1
+
+    load_pages(b"something else", "text/plain")
+    assert len(extracted) == 2
+
+
+def test_analyses_are_kept_per_model_and_question(store):
+    digest, _ = load_pages(b"hello world", "text/plain")
+    assert stored_analysis(digest, "gemini") is None
+
+    save_analysis(digest, "gemini", "A greeting.")
+    save_analysis(digest, "gemini", "Two words.", question="How long is it?")
+    assert stored_analysis(digest, "gemini") == "A greeting."
+    assert stored_analysis(digest, "gemini", "  How long is it? ") == "Two words."
+    assert stored_analysis(digest, "claude") is None
+    assert stored_analysis(digest, "gemini", "Who wrote it?") is None
+
+
+def test_unreadable_documents_are_not_stored(store):
+    with pytest.raises(DocumentExtractionError):
+        load_pages(b"not a pdf", "application/pdf")
+    assert store.stats()["entries"] == 0
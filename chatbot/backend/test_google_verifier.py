@@ -0,0 +1,183 @@
+"""Tests for Google ID-token verification against a local stand-in key server"""
+import asyncio
+import datetime
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from google.auth import crypt
+from google.auth import jwt as google_jwt
+
+import google_verifier
+from google_verifier import GoogleTokenVerifier, certs_ttl
+from http_clients import close_async_clients
+
+CLIENT_ID = "test-client.apps.googleusercontent.com"
+
+
+class SigningKey:
+    """An RSA key with the self-signed certificate Google would publish for it"""
+
+    def __init__(self, key_id):
+        self.key_id = key_id
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, key_id)])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        certificate = (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=1))
+            .sign(key, hashes.SHA256())
+        )
+        self.certificate = certificate.public_bytes(serialization.Encoding.PEM).decode("ascii")
+        private_pem = key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+        )
+        self.signer = crypt.RSASigner.from_string(private_pem, key_id=key_id)
+
+    def token(self, audience=CLIENT_ID, issuer="https://accounts.google.com"):
+        now = int(time.time())
+        claims = {"iss": issuer, "aud": audience, "sub": "1234", "email": "user@example.com", "iat": now, "exp": now + 300}
+        return google_jwt.encode(self.signer, claims).decode("ascii")
+
+
+class KeyServer:
+    """Serves a certs document with Cache-Control, counting the fetches"""
+
+    def __init__(self):
+        self.certs = {}
+        self.max_age = 3600
+        self.failing = False
+        self.fetches = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.fetches += 1
+                if server.failing:
+                    self.send_response(500)
+                    self.end_headers()
+                    return
+                body = json.dumps(server.certs).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Cache-Control", f"public, max-age={server.max_age}")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/certs"
+
+    def publish(self, *keys):
+        self.certs = {key.key_id: key.certificate for key in keys}
+
+
+@pytest.fixture(scope="module")
+def keys():
+    return SigningKey("key-a"), SigningKey("key-b"), SigningKey("key-c")
+
+
+@pytest.fixture
+def key_server():
+    server = KeyServer()
+    thread = threading.Thread(target=server.httpd.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.httpd.shutdown()
+    server.httpd.server_close()
+
+
+@pytest.fixture
+def verifier(key_server):
+    return GoogleTokenVerifier(client_id=CLIENT_ID, certs_url=key_server.url, clock_skew=0)
+
+
+def test_certs_ttl_subtracts_age():
+    assert certs_ttl({"cache-control": "public, max-age=100", "age": "40"}) == 60
+    assert certs_ttl({"cache-control": "max-age=10", "age": "99"}) == 0
+    assert certs_ttl({}, default=5) == 5
+
+
+@pytest.mark.asyncio
+async def test_certs_are_reused_until_max_age(key_server, verifier, keys):
+    key_server.publish(keys[0])
+    for _ in range(3):
+        claims = await verifier.verify(keys[0].token())
+        assert claims["email"] == "user@example.com"
+    assert key_server.fetches == 1
+    assert verifier.stats()["expires_in"] > 3500
+    await close_async_clients()
+
+
+@pytest.mark.asyncio
+async def test_expired_certs_are_fetched_again(key_server, verifier, keys):
+    key_server.publish(keys[0])
+    key_server.max_age = 0
+    await verifier.verify(keys[0].token())
+    await verifier.verify(keys[0].token())
+    assert key_server.fetches == 2
+    await close_async_clients()
+
+
+@pytest.mark.asyncio
+async def test_unknown_key_id_refreshes_at_most_once(monkeypatch, key_server, verifier, keys):
+    monkeypatch.setattr(google_verifier, "MIN_FORCED_REFRESH_SECONDS", 0.2)
+    key_server.publish(keys[0])
+    await verifier.verify(keys[0].token())
+    await asyncio.sleep(0.3)
+
+    # Google rotated in key-b: one forced refresh picks it up
+    key_server.publish(keys[0], keys[1])
+    await verifier.verify(keys[1].token())
+    assert key_server.fetches == 2
+
+    # A key id nobody publishes does not cause another fetch so soon
+    with pytest.raises(ValueError):
+        await verifier.verify(keys[2].token())
+    assert key_server.fetches == 2
+    await close_async_clients()
+
+
+@pytest.mark.asyncio
+async def test_wrong_audience_is_rejected(key_server, verifier, keys):
+    key_server.publish(keys[0])
+    with pytest.raises(ValueError):
+        await verifier.verify(keys[0].token(audience="someone-else.apps.googleusercontent.com"))
+    await close_async_clients()
+
+
+@pytest.mark.asyncio
+async def test_wrong_issuer_is_rejected(key_server, verifier, keys):
+    key_server.publish(keys[0])
+    with pytest.raises(ValueError, match="issuer"):
+        await verifier.verify(keys[0].token(issuer="https://evil.example.com"))
+    await close_async_clients()
+
+
+@pytest.mark.asyncio
+async def test_failed_refresh_keeps_old_certs_and_backs_off(key_server, verifier, keys):
+    key_server.publish(keys[0])
+    key_server.max_age = 0
+    await verifier.verify(keys[0].token())
+
+    key_server.failing = True
+    await verifier.verify(keys[0].token())
+    await verifier.verify(keys[0].token())
+    assert key_server.fetches == 2
+    assert verifier.refresh_errors == 1
+    assert verifier.stats()["expires_in"] > google_verifier.MIN_FORCED_REFRESH_SECONDS - 5
+    await close_async_clients()
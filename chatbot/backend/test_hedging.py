@@ -0,0 +1,112 @@
+"""Tests for hedged provider requests"""
+import asyncio
+
+import pytest
+
+import hedging
+from hedging import LatencyTracker, hedged_stream
+
+
+class FixedDeadlineTracker(LatencyTracker):
+    def __init__(self, deadline):
+        super().__init__()
+        self.deadline = deadline
+
+    def hedge_deadline(self, provider):
+        return self.deadline
+
+
+class FakeService:
+    """Streams the given chunks after a delay, or raises before the first one"""
+
+    def __init__(self, chunks, delay=0.0, error=None):
+        self.chunks = chunks
+        self.delay = delay
+        self.error = error
+        self.started = 0
+        self.closed = False
+
+    async def stream_response(self, conversation_history):
+        self.started += 1
+        try:
+            await asyncio.sleep(self.delay)
+            if self.error:
+                raise self.error
+            for chunk in self.chunks:
+                yield chunk
+        finally:
+            self.closed = True
+
+
+@pytest.fixture(autouse=True)
+def hedging_enabled(monkeypatch):
+    monkeypatch.setattr(hedging, "HEDGING_ENABLED", True)
+
+
+async def collect(stream):
+    return [text async for text in stream]
+
+
+@pytest.mark.asyncio
+async def test_fast_primary_is_not_hedged():
+    primary, fallback = FakeService(["a", "b"]), FakeService(["x"])
+    label, stream = await hedged_stream(
+        [("test-primary", primary), ("test-fallback", fallback)], [], FixedDeadlineTracker(0.5)
+    )
+    assert label == "test-primary"
+    assert await collect(stream) == ["a", "b"]
+    assert fallback.started == 0
+
+
+@pytest.mark.asyncio
+async def test_slow_primary_loses_and_is_cancelled():
+    primary, fallback = FakeService(["slow"], delay=5), FakeService(["fast", "er"])
+    label, stream = await hedged_stream(
+        [("test-primary", primary), ("test-fallback", fallback)], [], FixedDeadlineTracker(0.05)
+    )
+    assert label == "test-fallback (hedged)"
+    assert await collect(stream) == ["fast", "er"]
+    assert primary.closed
+
+
+@pytest.mark.asyncio
+async def test_slow_primary_that_answers_first_keeps_the_reply():
+    primary, fallback = FakeService(["mine"], delay=0.1), FakeService(["late"], delay=5)
+    label, stream = await hedged_stream(
+        [("test-primary", primary), ("test-fallback", fallback)], [], FixedDeadlineTracker(0.05)
+    )
+    assert label == "test-primary"
+    assert await collect(stream) == ["mine"]
+    assert fallback.started == 1
+    assert fallback.closed
+
+
+@pytest.mark.asyncio
+async def test_failed_primary_hands_over_immediately():
+    primary = FakeService([], error=RuntimeError("boom"))
+    fallback = FakeService(["ok"])
+    label, stream = await hedged_stream(
+        [("test-primary", primary), ("test-fallback", fallback)], [], FixedDeadlineTracker(10)
+    )
+    assert label == "test-fallback (fallback)"
+    assert await collect(stream) == ["ok"]
+
+
+@pytest.mark.asyncio
+async def test_every_provider_failing_raises():
+    candidates = [
+        ("test-primary", FakeService([], error=RuntimeError("one"))),
+        ("test-fallback", FakeService([], error=RuntimeError("two"))),
+    ]
+    with pytest.raises(RuntimeError, match="All providers failed"):
+        await hedged_stream(candidates, [], FixedDeadlineTracker(10))
+
+
+def test_deadline_follows_the_percentile(monkeypatch):
+    monkeypatch.setattr(hedging, "HEDGE_MIN_SAMPLES", 3)
+    monkeypatch.setattr(hedging, "HEDGE_DEFAULT_DELAY", 4.0)
+    tracker = LatencyTracker()
+    assert tracker.hedge_deadline("p") == 4.0
+    for seconds in (1.5, 2.0, 3.0):
+        tracker.record("p", seconds)
+    assert tracker.hedge_deadline("p") == 3.0
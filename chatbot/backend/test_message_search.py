@@ -0,0 +1,127 @@
+"""Tests for message search on the SQLite FTS5 index, and the MySQL query it falls back from"""
+import pytest
+from alembic import command
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+import message_search
+from database import ThreadedSession
+from db_migrations import alembic_config
+from message_search import mysql_search, query_terms, search_messages
+from models import ChatThread, Message, User
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    url = f"sqlite:///{tmp_path / 'search.db'}"
+    config = alembic_config()
+    config.set_main_option("sqlalchemy.url", url)
+    command.upgrade(config, "head")
+
+    engine = create_engine(url, connect_args={"check_same_thread": False})
+    monkeypatch.setattr(message_search, "engine", engine)
+    session = Session(engine)
+    yield session
+    session.close()
+    engine.dispose()
+
+
+def add_thread(session, user, title, messages, is_deleted=False):
+    thread = ChatThread(user_id=user.id, title=title, is_deleted=is_deleted)
+    session.add(thread)
+    session.flush()
+    for sender, content in messages:
+        session.add(Message(thread_id=thread.id, sender=sender, content=content))
+    session.commit()
+    return thread
+
+
+@pytest.fixture
+def users(db):
+    alice = User(email="alice@example.com", username="alice", hashed_password="x")
+    bob = User(email="bob@example.com", username="bob", hashed_password="x")
+    db.add_all([alice, bob])
+    db.commit()
+    return alice, bob
+
+
+async def search(db, user, query):
+    return await search_messages(ThreadedSession(db), user.id, query)
+
+
+@pytest.mark.asyncio
+async def test_finds_only_the_users_own_messages(db, users):
+    alice, bob = users
+    thread = add_thread(db, alice, "Trip", [("user", "Where should I go hiking in Norway?"), ("bot", "Try the fjords.")])
+    add_thread(db, bob, "Other trip", [("user", "Hiking in Norway is great")])
+
+    results = await search(db, alice, "norway hiking")
+    assert [r["thread_id"] for r in results] == [thread.id]
+    assert results[0]["thread_title"] == "Trip"
+    assert results[0]["role"] == "user"
+    assert "<mark>Norway</mark>" in results[0]["snippet"]
+
+
+@pytest.mark.asyncio
+async def test_last_term_matches_as_a_prefix(db, users):
+    alice, _ = users
+    add_thread(db, alice, "Cooking", [("user", "How long do I bake sourdough bread?")])
+    assert len(await search(db, alice, "sourd")) == 1
+    assert await search(db, alice, "sourd bake") == []
+
+
+@pytest.mark.asyncio
+async def test_better_matches_rank_first(db, users):
+    alice, _ = users
+    add_thread(db, alice, "A", [("user", "python tips"), ("user", "python python python decorators")])
+    results = await search(db, alice, "python")
+    assert len(results) == 2
+    assert results[0]["score"] >= results[1]["score"]
+    assert "decorators" in results[0]["snippet"]
+
+
+@pytest.mark.asyncio
+async def test_index_follows_edits_and_deleted_threads(db, users):
+    alice, _ = users
+    thread = add_thread(db, alice, "Edits", [("user", "original wording")])
+    message = db.query(Message).filter(Message.thread_id == thread.id).one()
+    message.content = "rewritten text"
+    db.commit()
+    assert await search(db, alice, "original") == []
+    assert len(await search(db, alice, "rewritten")) == 1
+
+    thread.is_deleted = True
+    db.commit()
+    assert await search(db, alice, "rewritten") == []
+
+
+@pytest.mark.asyncio
+async def test_search_syntax_is_not_passed_through(db, users):
+    alice, _ = users
+    add_thread(db, alice, "Syntax", [("user", "quotes and stars")])
+    assert len(await search(db, alice, '"quotes" OR *stars*')) == 0
+    assert len(await search(db, alice, '"quotes" stars*')) == 1
+    assert await search(db, alice, "  ***  ") == []
+
+
+def test_query_terms_are_capped():
+    assert query_terms("One two, THREE!") == ["one", "two", "three"]
+    assert len(query_terms(" ".join(["word"] * 20))) == message_search.MAX_QUERY_TERMS
+
+
+def test_mysql_filters_by_user_before_ranking():
+    statement, params = mysql_search(["norway", "hiking"], min_token_size=3)
+    inner = str(statement).split(") ranked")[0]
+    assert "user_id = :user_id" in inner
+    assert "MATCH(m.content) AGAINST" in inner
+    assert params == {"query": "+norway* +hiking*"}
+
+
+def test_mysql_short_terms_use_like():
+    statement, params = mysql_search(["ai", "models"], min_token_size=3)
+    assert "LIKE :term0" in str(statement)
+    assert params == {"term0": "%ai%", "query": "+models*"}
+
+    statement, params = mysql_search(["ai"], min_token_size=3)
+    assert "MATCH" not in str(statement)
+    assert params == {"term0": "%ai%"}
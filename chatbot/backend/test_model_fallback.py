@@ -0,0 +1,64 @@
+"""Tests for the streaming per-model fallback chain"""
+import pytest
+
+import model_fallback
+from circuit_breaker import circuit_breakers
+from model_fallback import stream_models, with_identity
+
+
+async def chunks(*texts, error=None):
+    for text in texts:
+        yield text
+    if error:
+        raise error
+
+
+async def collect(stream):
+    return [text async for text in stream]
+
+
+@pytest.fixture(autouse=True)
+def no_registry_writes(monkeypatch):
+    confirmed = []
+    monkeypatch.setattr(model_fallback.capability_registry, "confirm", lambda *args: confirmed.append(args))
+    return confirmed
+
+
+@pytest.mark.asyncio
+async def test_next_model_answers_when_the_first_fails(no_registry_writes):
+    streams = {
+        "m1": lambda: chunks(error=RuntimeError("down")),
+        "m2": lambda: chunks("hello", " there"),
+    }
+    result = await collect(stream_models("test-chain", ["m1", "m2"], lambda model: streams[model]()))
+    assert result == ["hello", " there"]
+    assert circuit_breakers.get("test-chain/m1").stats()["failures"] == 1
+    assert no_registry_writes == [("test-chain", "chat", "m2")]
+
+
+@pytest.mark.asyncio
+async def test_open_circuit_is_skipped():
+    for _ in range(10):
+        circuit_breakers.record_failure("test-open/m1")
+    opened = []
+
+    def open_stream(model):
+        opened.append(model)
+        return chunks("ok")
+
+    assert await collect(stream_models("test-open", ["m1", "m2"], open_stream)) == ["ok"]
+    assert opened == ["m2"]
+
+
+@pytest.mark.asyncio
+async def test_every_model_failing_raises():
+    with pytest.raises(RuntimeError, match="Every test-fail model failed"):
+        await collect(stream_models("test-fail", ["m1"], lambda model: chunks(error=RuntimeError("down"))))
+
+
+@pytest.mark.asyncio
+async def test_identity_prefixed_only_when_missing():
+    assert await collect(with_identity(chunks("Hi", " there"), ("chatgpt",), "I am ChatGPT. ")) == ["I am ChatGPT. ", "Hi there"]
+    assert await collect(with_identity(chunks("I am ChatGPT", ", hi"), ("chatgpt",), "X")) == ["I am ChatGPT, hi"]
+    long_reply = ["word " * 20, "more"]
+    assert await collect(with_identity(chunks(*long_reply), ("gemini",), "P ", window=10)) == ["P ", long_reply[0], "more"]
@@ -0,0 +1,19 @@
+"""Tests for the opaque keyset pagination cursors"""
+import pytest
+from fastapi import HTTPException
+
+from chat_endpoint import decode_cursor, encode_cursor
+
+
+def test_cursor_round_trips():
+    position = {"created_at": "2026-01-01T12:00:00.123456", "id": 42}
+    cursor = encode_cursor(position)
+    assert "=" not in cursor
+    assert decode_cursor(cursor) == position
+
+
+@pytest.mark.parametrize("cursor", ["not-base64!", "%%%", "bm90IGpzb24"])
+def test_bad_cursor_is_a_400(cursor):
+    with pytest.raises(HTTPException) as raised:
+        decode_cursor(cursor)
+    assert raised.value.status_code == 400
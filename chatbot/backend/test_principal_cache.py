@@ -0,0 +1,74 @@
+"""Tests for the bearer-token principal cache"""
+import principal_cache
+from principal_cache import PrincipalCache, token_id
+from schemas import Principal
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+def principal(user_id):
+    return Principal(id=user_id, email=f"user{user_id}@example.com")
+
+
+def make_cache(monkeypatch, clock, ttl=60, max_entries=10):
+    monkeypatch.setattr(principal_cache.time, "time", clock)
+    return PrincipalCache(ttl=ttl, max_entries=max_entries)
+
+
+def test_hit_until_ttl_then_miss(monkeypatch):
+    clock = FakeClock()
+    cache = make_cache(monkeypatch, clock)
+    cache.put("token-1", principal(1))
+    clock.now += 59
+    assert cache.get("token-1").id == 1
+    clock.now += 1
+    assert cache.get("token-1") is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 0)
+
+
+def test_token_expiry_shortens_the_ttl(monkeypatch):
+    clock = FakeClock()
+    cache = make_cache(monkeypatch, clock)
+    cache.put("token-1", principal(1), token_expires_at=clock.now + 10)
+    clock.now += 10
+    assert cache.get("token-1") is None
+
+
+def test_least_recently_used_token_is_evicted(monkeypatch):
+    cache = make_cache(monkeypatch, FakeClock(), max_entries=2)
+    cache.put("token-1", principal(1))
+    cache.put("token-2", principal(2))
+    cache.get("token-1")
+    cache.put("token-3", principal(3))
+    assert cache.get("token-2") is None
+    assert cache.get("token-1") is not None
+    assert cache.stats()["entries"] == 2
+
+
+def test_invalidate_user_drops_all_their_tokens(monkeypatch):
+    cache = make_cache(monkeypatch, FakeClock())
+    cache.put("token-1", principal(1))
+    cache.put("token-2", principal(1))
+    cache.put("token-3", principal(2))
+    cache.invalidate_user(1)
+    assert cache.get("token-1") is None
+    assert cache.get("token-2") is None
+    assert cache.get("token-3").id == 2
+
+
+def test_zero_ttl_disables_the_cache(monkeypatch):
+    cache = make_cache(monkeypatch, FakeClock(), ttl=0)
+    cache.put("token-1", principal(1))
+    assert cache.get("token-1") is None
+
+
+def test_tokens_are_not_kept_in_the_clear():
+    assert token_id("secret-token") != "secret-token"
+    assert len(token_id("secret-token")) == 64
@@ -0,0 +1,67 @@
+"""Tests for the reply cache and its in-memory backend"""
+import pytest
+
+import response_cache
+from response_cache import MemoryBackend, ResponseCache, cache_key
+
+
+async def chunks(*texts, error=None):
+    for text in texts:
+        yield text
+    if error:
+        raise error
+
+
+def test_key_ignores_whitespace_and_extra_fields():
+    first = cache_key("openai", {"model": "m"}, [{"role": "user", "content": "Hello   world ", "id": 1}])
+    second = cache_key("openai", {"model": "m"}, [{"role": "user", "content": "Hello world", "id": 2}])
+    assert first == second
+    assert first != cache_key("gemini", {"model": "m"}, [{"role": "user", "content": "Hello world"}])
+
+
+@pytest.mark.asyncio
+async def test_entries_expire(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(response_cache.time, "monotonic", lambda: now[0])
+    backend = MemoryBackend(max_entries=10, max_bytes=1000)
+    await backend.set("k", "reply", ttl=60)
+    assert await backend.get("k") == "reply"
+    now[0] += 61
+    assert await backend.get("k") is None
+    assert backend.stats()["bytes"] == 0
+
+
+@pytest.mark.asyncio
+async def test_least_recently_used_is_evicted():
+    backend = MemoryBackend(max_entries=2, max_bytes=1000)
+    await backend.set("a", "1", ttl=60)
+    await backend.set("b", "2", ttl=60)
+    await backend.get("a")
+    await backend.set("c", "3", ttl=60)
+    assert await backend.get("b") is None
+    assert await backend.get("a") == "1"
+    assert backend.evictions == 1
+
+
+@pytest.mark.asyncio
+async def test_byte_limit_evicts_and_skips_oversized():
+    backend = MemoryBackend(max_entries=10, max_bytes=10)
+    await backend.set("a", "12345", ttl=60)
+    await backend.set("b", "123456", ttl=60)
+    assert await backend.get("a") is None
+    await backend.set("huge", "x" * 11, ttl=60)
+    assert await backend.get("huge") is None
+    assert backend.stats()["bytes"] == 6
+
+
+@pytest.mark.asyncio
+async def test_only_complete_streams_are_stored():
+    cache = ResponseCache(backend=MemoryBackend(), ttl=60, enabled=True)
+    assert [text async for text in cache.recording("done", chunks("a", "b"))] == ["a", "b"]
+    assert await cache.get("done") == "ab"
+
+    with pytest.raises(RuntimeError):
+        async for _ in cache.recording("broken", chunks("a", error=RuntimeError("cut"))):
+            pass
+    assert await cache.get("broken") is None
+    assert cache.stats()["stores"] == 1
@@ -30,6 +30,19 @@ import Sidebar from './components/Sidebar';
 import VoiceInput from './components/VoiceInput';
 import ImageUploader from './components/ImageUploader';
 
+// Every backend request carries the access token (the chat API authenticates with it).
+// Registered at module load so it is in place before any component's first request.
+axios.interceptors.request.use(
+  config => {
+    const token = localStorage.getItem('access_token');
+    if (token) {
+      config.headers['Authorization'] = `Bearer ${token}`;
+    }
+    return config;
+  },
+  error => Promise.reject(error)
+);
+
 // Configure marked to enable tables and other features
 marked.setOptions({
   gfm: true,  // GitHub Flavored Markdown
@@ -170,17 +183,13 @@ function Chat({ setIsAuthenticated }) {
   const fetchChatThreads = useCallback(async () => {
     setLoading(true);
     try {
-      const [activeResponse, deletedResponse] = await Promise.all([
-        axios.get(`http://localhost:8000/chat_api/chat/`, {
-          params: { user_id: userId, show_deleted: false }
-        }),
-        axios.get(`http://localhost:8000/chat_api/chat/`, {
-          params: { user_id: userId, show_deleted: true }
-        })
-      ]);
-
-      setThreads(activeResponse.data);
-      setDeletedThreads(deletedResponse.data.filter(thread => thread.is_deleted));
+      // One request returns both the active and the deleted threads
+      const response = await axios.get(`http://localhost:8000/chat_api/chat/`, {
+        params: { user_id: userId, include_deleted: true }
+      });
+
+      setThreads(response.data.active);
+      setDeletedThreads(response.data.deleted);
       setError(null);
     } catch (error) {
       console.error("Error fetching chat threads", error);
@@ -436,6 +445,9 @@ const sendMessage = async () => {
       model: modelToUse,
       update_title: isNewThread || shouldUpdateTitle,
       suggested_title: generateTitleFromMessage(newMessage)
+    }, {
+      // Only the new user and assistant messages come back; they are appended locally
+      params: { response_mode: 'delta' }
     });
 
     // Debug logging for model response
@@ -460,7 +472,10 @@ const sendMessage = async () => {
          font-weight: bold; font-size: 14px;`);
     }
 
-    setMessages(response.data);
+    setMessages(prevMessages => [
+      ...prevMessages.filter(m => !m.isLoading),
+      ...response.data
+    ]);
     setNewMessage('');
     
     // Update thread title if needed
@@ -581,12 +596,17 @@ const sendMessage = async () => {
           user_id: userId,
           message: newContent,
           model: modelToUse  // Send lowercase model name
-        }
+        },
+        { params: { response_mode: 'delta' } }
       );
 
-      // Verify response contains updated messages
+      // The response holds the edited message and the new reply; later messages were removed
       if (Array.isArray(response.data)) {
-        setMessages(response.data);
+        setMessages(prevMessages => {
+          const editedIndex = prevMessages.findIndex(m => m.id === messageId);
+          const kept = editedIndex === -1 ? prevMessages : prevMessages.slice(0, editedIndex);
+          return [...kept, ...response.data];
+        });
       } else {
         throw new Error('Invalid response format');
       }
@@ -852,18 +872,6 @@ const handleImageResult = (resultData, autoSend = false) => {
 
   // Add a global error handler for axios to manage API errors
 useEffect(() => {
-  // Add request interceptor for authentication token
-  const requestInterceptor = axios.interceptors.request.use(
-    config => {
-      const token = localStorage.getItem('access_token');
-      if (token) {
-        config.headers['Authorization'] = `Bearer ${token}`;
-      }
-      return config;
-    },
-    error => Promise.reject(error)
-  );
-  
   // Add response interceptor for error handling
   const responseInterceptor = axios.interceptors.response.use(
     response => response,
@@ -898,7 +906,6 @@ useEffect(() => {
   
   // Clean up interceptors and event listeners when component unmounts
   return () => {
-    axios.interceptors.request.eject(requestInterceptor);
     axios.interceptors.response.eject(responseInterceptor);
     window.removeEventListener('auth_error', handleAuthError);
   };
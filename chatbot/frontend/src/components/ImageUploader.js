@@ -168,17 +168,15 @@ const ImageUploader = ({ onResult, onError, disabled, selectedModel }) => {
       
       let messageContent = '';
       
-      // Check for image_base64 and analysis fields which should be in all responses
-      if (response.data.image_base64 && response.data.analysis) {
+      // Check for attachment_url and analysis fields which should be in all responses
+      if (response.data.attachment_url && response.data.analysis) {
         // Handle standardized response format
-        const imageId = `img-${Date.now()}-${Math.floor(Math.random() * 1000)}`;
         let imageMarkdown = '';
         
         // Only include image in the message if it's an image file
         if (type === 'image') {
-          imageMarkdown = `![Uploaded Image](image://${imageId})`;
-          // Store the image data temporarily
-          sessionStorage.setItem(imageId, response.data.image_base64);
+          // The backend keeps the upload and serves it (cacheably) from this URL
+          imageMarkdown = `![Uploaded Image](${response.data.attachment_url})`;
         }
         
         // Get analysis from the response
@@ -34,6 +34,14 @@ const SearchModal = ({
     return () => clearTimeout(delaySearch);
   }, [query, onSearch]);
 
+  // Matched terms come back wrapped in <mark> tags
+  const renderSnippet = (snippet) =>
+    snippet.split(/<mark>|<\/mark>/).map((part, index) =>
+      index % 2 === 1 ? (
+        <strong key={index} style={{ color: theme === 'dark' ? '#9c56ff' : '#7c4dff' }}>{part}</strong>
+      ) : part
+    );
+
   const handleKeyDown = (e) => {
     if (e.key === 'Escape') {
       onClose();
@@ -70,7 +78,7 @@ const SearchModal = ({
         <TextField
           autoFocus
           margin="dense"
-          placeholder="Search for conversations..."
+          placeholder="Search titles and messages..."
           type="text"
           fullWidth
           variant="outlined"
@@ -98,7 +106,7 @@ const SearchModal = ({
           {searchResults.length > 0 ? (
             searchResults.map((thread) => (
               <div
-                key={thread.id}
+                key={thread.messageId ? `message-${thread.messageId}` : `thread-${thread.id}`}
                 onClick={() => onSelectResult(thread.id)}
                 style={{
                   padding: '12px',
@@ -114,6 +122,15 @@ const SearchModal = ({
                 }}
               >
                 <div style={{ fontWeight: 'bold' }}>{thread.title}</div>
+                {thread.snippet && (
+                  <div style={{
+                    fontSize: '0.85em',
+                    marginTop: '4px',
+                    color: theme === 'dark' ? '#a0a0a0' : '#6b6b6b'
+                  }}>
+                    {renderSnippet(thread.snippet)}
+                  </div>
+                )}
               </div>
             ))
           ) : query ? (
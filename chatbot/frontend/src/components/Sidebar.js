@@ -1,4 +1,5 @@
-import React, { useState } from 'react';
+import React, { useState, useRef } from 'react';
+import axios from 'axios';
 import { Button, IconButton } from '@mui/material';
 import AddIcon from '@mui/icons-material/Add';
 import SearchIcon from '@mui/icons-material/Search';
@@ -33,19 +34,40 @@ const Sidebar = ({
 }) => {
   const [showSearchModal, setShowSearchModal] = useState(false);
   const [searchResults, setSearchResults] = useState([]);
+  const latestQuery = useRef('');
   const { theme } = useTheme();
 
   const handleSearch = async (query) => {
+    latestQuery.current = query;
     if (!query.trim()) {
       setSearchResults([]);
       return;
     }
 
-    // Local search in existing threads
-    const results = threads.filter(thread =>
+    // Title matches in the loaded threads show up immediately
+    const titleResults = threads.filter(thread =>
       thread.title.toLowerCase().includes(query.toLowerCase())
     );
-    setSearchResults(results);
+    setSearchResults(titleResults);
+
+    // Then the messages whose content matches, ranked by the server
+    try {
+      const response = await axios.get('http://localhost:8000/chat_api/chat/search/', {
+        params: { q: query }
+      });
+      if (latestQuery.current !== query) {
+        return; // A newer search is already under way
+      }
+      const messageResults = response.data.items.map(hit => ({
+        id: hit.thread_id,
+        title: hit.thread_title,
+        snippet: hit.snippet,
+        messageId: hit.message_id
+      }));
+      setSearchResults([...titleResults, ...messageResults]);
+    } catch (error) {
+      console.error('Error searching messages:', error);
+    }
   };
 
   return (